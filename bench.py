@@ -0,0 +1,689 @@
+"""Нагрузочный прогон бота против фейкового Bot API.
+
+Бот запускается отдельным процессом (python digi.py) в режиме polling
+с TELEGRAM_API_URL на локальный фейковый сервер и своей базой. Виртуальные
+пользователи проходят сценарий покупки звезд, админ подтверждает и
+выполняет заказ; на выходе - пропускная способность, p50/p95/p99 по шагам
+и рост базы. Переменные окружения (DB_*, NOTIFY_* и т.д.) передаются боту,
+так что настройки можно сравнивать между прогонами:
+
+    python bench.py --users 500 --concurrency 50 --json after.json --baseline before.json
+
+С --webhook бот запускается в режиме webhook, и апдейты приходят POST-запросами
+на его aiohttp-сервер, как от Telegram; --workers N запускает N воркеров на одном
+порту с общей базой. После прогона заказы сверяются с пользователями: ни один не
+должен потеряться или задвоиться (--double-tap нажимает «Перевод на карту» дважды
+одновременно, и нажатия могут попасть в разные воркеры):
+
+    python bench.py --webhook --workers 4 --double-tap
+
+Отдельные замеры без бота и Bot API:
+
+    python bench.py commit    # запись заказов: commit на каждый запрос против группового
+    python bench.py render    # подписи и клавиатуры экранов: кэш против сборки заново
+    python bench.py archive   # поиск заказа при 10M заказов в архиве
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from aiohttp import ClientError, ClientSession, TCPConnector, web
+
+BENCH_TOKEN = "123456:bench"
+ADMIN_ID = 1
+BOT_USER = {"id": 42, "is_bot": True, "first_name": "Digi Bench", "username": "digi_bench_bot"}
+WEBHOOK_SECRET = "digi-bench"
+
+# ========== ФЕЙКОВЫЙ BOT API ==========
+class FakeBotAPI:
+    """Отвечает на getUpdates из очереди сценария, остальные методы - фиктивными сообщениями.
+
+    Сценарий ждет ответ бота через expect(): предикат проверяется на каждом
+    вызове API в нужный чат. Кнопки последнего сообщения в каждом чате
+    запоминаются, чтобы нажимать их как пользователь.
+    """
+
+    def __init__(self):
+        self._updates = []
+        self._has_updates = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._waiters = {}  # chat_id -> [(предикат, future)]
+        self.buttons = {}  # chat_id -> [callback_data]
+        self.calls = {}  # метод -> число вызовов
+        self.polling = asyncio.Event()
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    def next_message_id(self):
+        return next(self._message_ids)
+
+    def push(self, update):
+        update["update_id"] = next(self._update_ids)
+        self._updates.append(update)
+        self._has_updates.set()
+
+    async def deliver(self, update):
+        self.push(update)
+
+    def expect(self, chat_id, predicate):
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(chat_id, []).append((predicate, future))
+        return future
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = dict(await request.post())
+        if method == "getUpdates":
+            return self._ok(await self._get_updates(params))
+        if method == "getMe":
+            return self._ok(BOT_USER)
+
+        chat_id = int(params["chat_id"]) if "chat_id" in params else None
+        markup = json.loads(params["reply_markup"]) if "reply_markup" in params else None
+        if chat_id is not None and markup and "inline_keyboard" in markup:
+            self.buttons[chat_id] = [
+                button["callback_data"] for row in markup["inline_keyboard"]
+                for button in row if "callback_data" in button
+            ]
+
+        result = True
+        if method in ("sendMessage", "sendPhoto", "editMessageCaption", "editMessageText"):
+            message_id = int(params.get("message_id") or self.next_message_id())
+            result = {
+                "message_id": message_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER,
+            }
+            if "text" in params:
+                result["text"] = params["text"]
+            else:
+                result["caption"] = params.get("caption", "")
+        elif method == "answerCallbackQuery":
+            # Ответ на кнопку приходит последним - по нему считаем шаг выполненным
+            chat_id = int(params["callback_query_id"].split(":")[0])
+
+        waiters = self._waiters.get(chat_id)
+        if waiters:
+            for item in waiters:
+                predicate, future = item
+                if predicate(method, params) and not future.done():
+                    future.set_result(result)
+                    waiters.remove(item)
+                    break
+        return self._ok(result)
+
+    async def _get_updates(self, params):
+        self.polling.set()
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates:
+            self._has_updates.clear()
+            try:
+                await asyncio.wait_for(self._has_updates.wait(), float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:limit]
+
+    @staticmethod
+    def _ok(result):
+        return web.json_response({"ok": True, "result": result})
+
+class WebhookSource:
+    """Доставляет апдейты POST-запросом на webhook бота, как Telegram.
+
+    Бот отвечает на запрос, когда апдейт уже обработан. Соединений не больше
+    connections (max_connections у Telegram); при нескольких воркерах их
+    раздает между процессами ядро (reuse_port).
+    """
+
+    def __init__(self, url, secret=WEBHOOK_SECRET, connections=40):
+        self.url = url
+        self.secret = secret
+        self.connections = connections
+        self._update_ids = itertools.count(1)
+        self._session = None
+
+    async def deliver(self, update):
+        if self._session is None:
+            self._session = ClientSession(connector=TCPConnector(limit=self.connections))
+        update["update_id"] = next(self._update_ids)
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.secret}
+        async with self._session.post(self.url, json=update, headers=headers) as response:
+            response.raise_for_status()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+# ========== СЦЕНАРИЙ ==========
+def user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"Bench {user_id}", "username": f"bench{user_id}"}
+
+class Scenario:
+    """Шаги пользователя и админа с замером времени от апдейта до ответа бота"""
+
+    def __init__(self, api, source=None, double_tap=False):
+        self.api = api
+        # Откуда бот получает апдейты: getUpdates фейкового API или webhook
+        self.source = source or api
+        self.double_tap = double_tap
+        self.timings = {}  # шаг -> [секунды]
+        self._callback_ids = itertools.count(1)
+        self.errors = 0
+
+    async def step(self, name, chat_id, update, predicate, timeout=30):
+        started = time.perf_counter()
+        future = self.api.expect(chat_id, predicate)
+        await self.source.deliver(update)
+        result = await asyncio.wait_for(future, timeout)
+        self.timings.setdefault(name, []).append(time.perf_counter() - started)
+        return result
+
+    async def message(self, name, user_id, text, predicate=None):
+        update = {"message": {
+            "message_id": self.api.next_message_id(), "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"}, "from": user(user_id), "text": text,
+        }}
+        predicate = predicate or (lambda method, params: method in ("sendMessage", "sendPhoto"))
+        return await self.step(name, user_id, update, predicate)
+
+    async def press(self, name, user_id, message_id, data):
+        # chat_id в id колбэка - чтобы сопоставить answerCallbackQuery с чатом
+        callback_id = f"{user_id}:{next(self._callback_ids)}"
+        update = {"callback_query": {
+            "id": callback_id, "from": user(user_id), "chat_instance": "bench", "data": data,
+            "message": {
+                "message_id": message_id, "date": int(time.time()), "from": BOT_USER,
+                "chat": {"id": user_id, "type": "private"}, "caption": "bench",
+            },
+        }}
+        return await self.step(
+            name, user_id, update,
+            lambda method, params: method == "answerCallbackQuery" and params["callback_query_id"] == callback_id
+        )
+
+    def button(self, chat_id, prefix):
+        for data in self.api.buttons.get(chat_id, ()):
+            if data.startswith(prefix):
+                return data
+        raise LookupError(f"нет кнопки {prefix}* в чате {chat_id}")
+
+    async def purchase(self, user_id, admin):
+        """/start → buy_stars → получатель → количество → pay_card → card_paid [→ /confirm → /complete]"""
+        menu = await self.message("start", user_id, "/start")
+        await self.press("buy_stars", user_id, menu["message_id"], "buy_stars")
+        await self.press("enter_recipient", user_id, menu["message_id"], "enter_stars_recipient")
+        await self.message("recipient", user_id, f"@bench_recipient_{user_id}")
+        payment = await self.message("amount", user_id, "100")
+        pay_card = self.button(user_id, "pay_card_")
+        await asyncio.gather(*(
+            self.press("pay_card", user_id, payment["message_id"], pay_card)
+            for _ in range(2 if self.double_tap else 1)
+        ))
+        card_paid = self.button(user_id, "card_paid_")
+        await self.press("card_paid", user_id, payment["message_id"], card_paid)
+        if not admin:
+            return
+        order_id = card_paid.rsplit("_", 1)[1]
+        for command, reply in (("confirm", "подтвержден"), ("complete", "выполнен")):
+            expected = f"✅ Заказ #{order_id} {reply}"
+            await self.message(
+                f"admin_{command}", ADMIN_ID, f"/{command}_{order_id}",
+                lambda method, params: method == "sendMessage" and params.get("text") == expected
+            )
+
+    async def run(self, users, concurrency, admin, first_user_id=1000):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(user_id):
+            async with semaphore:
+                try:
+                    await self.purchase(user_id, admin)
+                except (asyncio.TimeoutError, LookupError, ClientError):
+                    self.errors += 1
+
+        await asyncio.gather(*(one(first_user_id + i) for i in range(users)))
+
+# ========== ОТЧЕТ ==========
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def db_stats(db_path):
+    """Размер файлов базы (вместе с WAL) и число строк в основных таблицах"""
+    size = sum(os.path.getsize(p) for p in (db_path, f"{db_path}-wal") if os.path.exists(p))
+    rows = {}
+    if os.path.exists(db_path):
+        connection = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        for table in ("users", "orders", "notifications"):
+            rows[table] = connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        connection.close()
+    return {"bytes": size, "rows": rows}
+
+def check_orders(db_path, first_user_id, users, status):
+    """Сколько пользователей остались без заказа, получили несколько и у скольких заказ не в статусе status"""
+    connection = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    rows = connection.execute("""
+        SELECT COUNT(*), SUM(payment_status != ?) FROM orders
+        WHERE user_id BETWEEN ? AND ? GROUP BY user_id
+    """, (status, first_user_id, first_user_id + users - 1)).fetchall()
+    connection.close()
+    return {
+        "missing": users - len(rows),
+        "duplicated": sum(1 for count, _ in rows if count > 1),
+        "wrong_status": sum(1 for count, wrong in rows if count == 1 and wrong),
+    }
+
+def summarize(scenario, elapsed, flows, before, after, calls):
+    steps = {
+        name: {
+            "count": len(values),
+            "p50_ms": percentile(values, 0.50) * 1000,
+            "p95_ms": percentile(values, 0.95) * 1000,
+            "p99_ms": percentile(values, 0.99) * 1000,
+            "max_ms": max(values) * 1000,
+        }
+        for name, values in scenario.timings.items()
+    }
+    updates = sum(len(values) for values in scenario.timings.values())
+    return {
+        "flows": flows, "errors": scenario.errors, "seconds": elapsed,
+        "flows_per_sec": flows / elapsed, "updates_per_sec": updates / elapsed,
+        "steps": steps, "api_calls": calls,
+        "db_growth_bytes": after["bytes"] - before["bytes"], "db_rows": after["rows"],
+    }
+
+def print_report(result, baseline=None):
+    def delta(key, value, step=None):
+        if baseline is None:
+            return ""
+        old = baseline["steps"].get(step, {}).get(key) if step else baseline.get(key)
+        return f" ({(value - old) / old * 100:+.1f}%)" if old else ""
+
+    print(f"Сценариев: {result['flows']} (ошибок {result['errors']}) за {result['seconds']:.2f} с")
+    print(f"Пропускная способность: {result['flows_per_sec']:.1f} сценариев/с{delta('flows_per_sec', result['flows_per_sec'])}, "
+          f"{result['updates_per_sec']:.1f} апдейтов/с{delta('updates_per_sec', result['updates_per_sec'])}")
+    print(f"{'шаг':<16}{'n':>7}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    for name, step in result["steps"].items():
+        print(f"{name:<16}{step['count']:>7}{step['p50_ms']:>10.2f}{step['p95_ms']:>10.2f}"
+              f"{step['p99_ms']:>10.2f}{step['max_ms']:>10.2f}{delta('p95_ms', step['p95_ms'], name)}")
+    if "orders" in result:
+        orders = result["orders"]
+        print(f"Заказы: без заказа {orders['missing']}, с дублями {orders['duplicated']}, "
+              f"в неверном статусе {orders['wrong_status']}")
+    print(f"Рост базы: {result['db_growth_bytes'] / 1024:.0f} КБ, строк: {result['db_rows']}")
+    print(f"Вызовов Bot API: {result['api_calls']}")
+
+# ========== СКВОЗНОЙ ПРОГОН ==========
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def read_output(process, ready, workers, verbose):
+    """Читает вывод бота; ready - когда все воркеры подняли webhook-сервер"""
+    started = 0
+    async for line in process.stdout:
+        line = line.decode(errors="replace")
+        if verbose:
+            print(line, end="")
+        if line.startswith("🌐 Webhook"):
+            started += 1
+            if started == workers:
+                ready.set()
+
+async def bench(args):
+    api = FakeBotAPI()
+    runner = web.AppRunner(api.app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", args.port)
+    await site.start()
+    port = runner.addresses[0][1]
+
+    workdir = tempfile.mkdtemp(prefix="digi-bench-") if args.db is None else None
+    db_path = args.db or os.path.join(workdir, "bench.db")
+    env = {
+        **os.environ,
+        "BOT_TOKEN": BENCH_TOKEN, "ADMIN_IDS": str(ADMIN_ID),
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{port}",
+        "RUN_MODE": "polling", "WORKERS": "1", "DB_PATH": db_path,
+        "METRICS_PORT": os.environ.get("METRICS_PORT", "0"),
+        "PRICING_SOURCE": os.environ.get("PRICING_SOURCE", "db"),
+        # Готовность воркеров видна по их выводу - без буфера
+        "PYTHONUNBUFFERED": "1",
+    }
+    env.pop("CRYPTOBOT_TOKEN", None)
+    source = None
+    if args.webhook:
+        webapp_port = free_port()
+        env.pop("WEBHOOK_URL", None)
+        env.update({
+            "RUN_MODE": "webhook", "WORKERS": str(args.workers),
+            "WEBAPP_HOST": "127.0.0.1", "WEBAPP_PORT": str(webapp_port),
+            "WEBHOOK_PATH": "/webhook", "WEBHOOK_SECRET": WEBHOOK_SECRET,
+            # Иначе access-лог aiohttp пишет строку на каждый апдейт
+            "LOG_LEVEL": os.environ.get("LOG_LEVEL", "WARNING"),
+        })
+        if args.workers > 1:
+            env["STATE_STORAGE"] = "sqlite"
+        source = WebhookSource(f"http://127.0.0.1:{webapp_port}/webhook", connections=args.connections)
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, str(Path(__file__).with_name("digi.py")), env=env,
+        stdout=asyncio.subprocess.PIPE,
+    )
+    webhook_ready = asyncio.Event()
+    output = asyncio.create_task(read_output(process, webhook_ready, args.workers, args.verbose))
+    try:
+        ready = webhook_ready if args.webhook else api.polling
+        waiter = asyncio.create_task(ready.wait())
+        exited = asyncio.create_task(process.wait())
+        await asyncio.wait({waiter, exited}, timeout=60, return_when=asyncio.FIRST_COMPLETED)
+        waiter.cancel()
+        if not ready.is_set():
+            raise SystemExit("Бот не начал принимать апдейты (см. вывод процесса, --verbose)")
+
+        before = db_stats(db_path)
+        scenario = Scenario(api, source, args.double_tap)
+        if args.warmup:
+            await scenario.run(args.warmup, args.concurrency, args.admin, first_user_id=10 ** 9)
+            scenario = Scenario(api, source, args.double_tap)
+        calls_before = dict(api.calls)
+        started = time.perf_counter()
+        await scenario.run(args.users, args.concurrency, args.admin)
+        elapsed = time.perf_counter() - started
+        calls = {m: n - calls_before.get(m, 0) for m, n in api.calls.items()
+                 if m != "getUpdates" and n > calls_before.get(m, 0)}
+    finally:
+        if source is not None:
+            await source.close()
+        if process.returncode is None:
+            process.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(process.wait(), 30)
+            except asyncio.TimeoutError:
+                process.kill()
+        output.cancel()
+        await runner.cleanup()
+
+    result = summarize(scenario, elapsed, args.users, before, db_stats(db_path), calls)
+    result["transport"] = "webhook" if args.webhook else "polling"
+    result["workers"] = args.workers
+    result["orders"] = check_orders(db_path, 1000, args.users, "completed" if args.admin else "waiting")
+    if workdir is not None:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+# ========== ГРУППОВОЙ КОММИТ ==========
+def import_digi():
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    import digi
+    return digi
+
+async def commit_bench(args):
+    """Одни и те же заказы через AsyncDatabase: пачка из одного запроса против группового коммита"""
+    digi = import_digi()
+    modes = (
+        ("по одной", 0.0, 1),
+        ("групповой", args.window / 1000, args.batch_size),
+    )
+    results = {}
+    for name, window, batch_size in modes:
+        workdir = tempfile.mkdtemp(prefix="digi-bench-")
+        database = digi.AsyncDatabase(os.path.join(workdir, "bench.db"), batch_window=window, batch_size=batch_size)
+        semaphore = asyncio.Semaphore(args.concurrency)
+        latencies = []
+
+        async def write(i):
+            async with semaphore:
+                started = time.perf_counter()
+                await database.add_order(i, "stars", "bench", '{"stars": 100}', 150.0, 1.78, "card", f"bench:{i}")
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(write(i) for i in range(args.orders)))
+        elapsed = time.perf_counter() - started
+        database.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+        results[name] = {
+            "orders_per_sec": args.orders / elapsed,
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+        }
+
+    print(f"Заказов: {args.orders}, одновременно: {args.concurrency}, "
+          f"synchronous={digi.DB_PRAGMAS['synchronous']}")
+    print(f"{'коммит':<12}{'заказов/с':>12}{'p50, мс':>10}{'p99, мс':>10}")
+    for name, result in results.items():
+        print(f"{name:<12}{result['orders_per_sec']:>12.0f}{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}")
+    return results
+
+# ========== КЭШ КЛАВИАТУР ==========
+def screens(digi):
+    """Что рендерит хендлер на каждое нажатие: экран -> функция подписи и клавиатуры.
+    Функции берутся из модуля при вызове, чтобы их можно было подменить некэшированными"""
+    prices = digi.PriceSnapshot.build(**digi.DEFAULT_PRICES)
+    period = next(iter(prices.premium))
+    return {
+        "main_menu": lambda: (digi.main_menu_caption(prices), digi.main_menu(digi.SUPPORT_USER)),
+        "buy_stars": lambda: (digi.buy_stars_caption(prices), digi.buy_stars_kb()),
+        "buy_premium": lambda: (digi.buy_premium_caption(prices), digi.premium_periods_kb()),
+        "premium_period": lambda: (digi.premium_period_caption(prices, period), digi.premium_recipient_kb()),
+        "exchange": lambda: (digi.exchange_caption(prices), digi.back_to_main_kb()),
+        "info": lambda: digi.info_kb(digi.REPUTATION_CHANNEL, digi.NEWS_CHANNEL),
+        "admin_menu": lambda: digi.admin_menu_kb(),
+        "card_payment": lambda: digi.card_payment_kb(12345),
+        "order_actions": lambda: digi.order_actions_kb(12345),
+    }
+
+def measure_render(render, iterations):
+    """(мкс CPU, байт на пике выделения) на один рендер"""
+    render()
+    started = time.process_time()
+    for _ in range(iterations):
+        render()
+    cpu = (time.process_time() - started) / iterations
+    tracemalloc.start()
+    allocated = 0
+    for _ in range(min(iterations, 200)):
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        render()
+        allocated += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    return cpu * 1e6, allocated / min(iterations, 200)
+
+def render_bench(args):
+    """Подписи и клавиатуры экранов: из lru_cache против сборки на каждое нажатие (как до кэша)"""
+    digi = import_digi()
+    cached = {
+        name: fn for name, fn in vars(digi).items()
+        if hasattr(fn, "__wrapped__") and hasattr(fn, "cache_info") and fn.__module__ == digi.__name__
+    }
+    results = {}
+    for mode in ("без кэша", "с кэшем"):
+        if mode == "без кэша":
+            for name, fn in cached.items():
+                setattr(digi, name, fn.__wrapped__)
+        try:
+            for screen, render in screens(digi).items():
+                results.setdefault(screen, {})[mode] = measure_render(render, args.iterations)
+        finally:
+            for name, fn in cached.items():
+                setattr(digi, name, fn)
+
+    print(f"Рендеров на экран: {args.iterations}")
+    print(f"{'экран':<16}{'CPU, мкс':>20}{'выделено, Б':>24}")
+    print(f"{'':<16}{'без кэша':>10}{'с кэшем':>10}{'без кэша':>12}{'с кэшем':>12}")
+    for screen, modes in results.items():
+        (cpu_before, bytes_before), (cpu_after, bytes_after) = modes["без кэша"], modes["с кэшем"]
+        print(f"{screen:<16}{cpu_before:>10.1f}{cpu_after:>10.1f}{bytes_before:>12.0f}{bytes_after:>12.0f}")
+    return results
+
+# ========== АРХИВ ==========
+def sample_ids(connection, table, count):
+    """count случайных существующих id таблицы"""
+    low, high = connection.execute(f"SELECT MIN(id), MAX(id) FROM {table}").fetchone()
+    return [
+        connection.execute(f"SELECT id FROM {table} WHERE id >= ? ORDER BY id LIMIT 1",
+                           (random.randint(low, high),)).fetchone()[0]
+        for _ in range(count)
+    ]
+
+def timed(fn, args_list):
+    """Задержки fn(*args) в миллисекундах"""
+    latencies = []
+    for args in args_list:
+        started = time.perf_counter()
+        fn(*args)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+def archive_bench(args):
+    """Архив: seed, перенос штатным archive_orders, рост архива до args.archived строк, затем
+    get_order_info для заказов из рабочей таблицы и из архива и страницы админки"""
+    digi = import_digi()
+    workdir = tempfile.mkdtemp(prefix="digi-bench-") if args.db is None else None
+    db_path = args.db or os.path.join(workdir, "bench.db")
+    database = digi.Database(db_path, wal=True, pragmas=digi.DB_PRAGMAS, archive_db=args.archive_db)
+    database.create_tables()
+    archive = database.archive_table
+
+    # Заказы старше срока уходят в архив той же пачкой, что и у OrderSweeper
+    database.seed_orders(args.seed, days=30)
+    statuses = ", ".join(f"'{status}'" for status in digi.ARCHIVED_STATUSES)
+    database.conn.execute(f"UPDATE orders SET order_date = datetime(order_date, '-365 days') "
+                          f"WHERE payment_status IN ({statuses})")
+    database.conn.commit()
+    started = time.perf_counter()
+    moved = 0
+    while True:
+        ids = database.archive_orders(30, digi.SWEEP_BATCH_SIZE)
+        if not ids:
+            break
+        database.drop_archived(ids)
+        moved += len(ids)
+    archive_seconds = time.perf_counter() - started
+    print(f"🗄 В архив: {moved} заказов за {archive_seconds:.1f} с ({moved / archive_seconds:.0f} в секунду)")
+
+    # Дальше архив растет копиями самого себя: у orders_archive нет триггеров, это быстро
+    columns = ", ".join(column for column in digi.ARCHIVE_COLUMNS if column != "id")
+    while True:
+        total = database.conn.execute(f"SELECT COUNT(*) FROM {archive}").fetchone()[0]
+        print(f"📦 Архив: {total}/{args.archived}", end="\r")
+        if total >= args.archived:
+            print()
+            break
+        database.conn.execute(f"INSERT INTO {archive} ({columns}) SELECT {columns} FROM {archive} LIMIT ?",
+                              (min(total, args.archived - total, 1_000_000),))
+        database.conn.commit()
+    # Новые заказы не должны получить id, занятые копиями в архиве
+    database.conn.execute(f"UPDATE sqlite_sequence SET seq = MAX(seq, (SELECT MAX(id) FROM {archive})) "
+                          "WHERE name = 'orders'")
+    database.conn.commit()
+    database.seed_orders(args.hot, days=7)
+    hot_rows = database.conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+    hot_ids = sample_ids(database.conn, "orders", args.lookups)
+    archived_ids = sample_ids(database.conn, archive, args.lookups)
+    missing_id = database.conn.execute(f"SELECT MAX(id) + 1 FROM {archive}").fetchone()[0] + 10 ** 9
+    database.close()
+
+    # Замер - свежим читателем, как в пуле AsyncDatabase
+    reader = digi.Database(db_path, pragmas=digi.DB_PRAGMAS, readonly=True, archive_db=args.archive_db)
+    results = {
+        "get_order_info (рабочая)": timed(reader.get_order_info, [(order_id,) for order_id in hot_ids]),
+        "get_order_info (архив)": timed(reader.get_order_info, [(order_id,) for order_id in archived_ids]),
+        "get_order_info (нет)": timed(reader.get_order_info, [(missing_id,)] * args.lookups),
+        "get_pending_orders": timed(reader.get_pending_orders, [()] * min(args.lookups, 500)),
+        "get_active_orders": timed(reader.get_active_orders, [()] * min(args.lookups, 500)),
+    }
+    reader.close()
+
+    print(f"Заказов в рабочей таблице: {hot_rows}, в архиве: {total}")
+    print(f"{'запрос':<28}{'p50, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    for name, latencies in results.items():
+        print(f"{name:<28}{percentile(latencies, 0.50):>10.3f}{percentile(latencies, 0.99):>10.3f}"
+              f"{max(latencies):>10.3f}")
+    if workdir is not None:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+# ========== ЗАПУСК ==========
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    # Без подкоманды - сквозной прогон, как раньше
+    if not argv or argv[0].startswith("-"):
+        argv = ["flow", *argv]
+    parser = argparse.ArgumentParser(description="Нагрузочные прогоны Digi Store Bot")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    flow = commands.add_parser("flow", help="сценарии покупки против фейкового Bot API")
+    flow.add_argument("--users", type=int, default=200, help="сколько пользователей проходят сценарий")
+    flow.add_argument("--concurrency", type=int, default=20, help="сколько сценариев идет одновременно")
+    flow.add_argument("--warmup", type=int, default=10, help="сценариев для прогрева (не учитываются)")
+    flow.add_argument("--no-admin", dest="admin", action="store_false", help="без /confirm и /complete")
+    flow.add_argument("--db", help="файл базы бота (по умолчанию новая во временной папке)")
+    flow.add_argument("--port", type=int, default=0, help="порт фейкового Bot API")
+    flow.add_argument("--json", help="сохранить результат в JSON")
+    flow.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    flow.add_argument("--verbose", action="store_true", help="показывать вывод бота")
+    flow.add_argument("--webhook", action="store_true", help="апдейты POST-запросами на webhook вместо getUpdates")
+    flow.add_argument("--workers", type=int, default=1, help="воркеров бота (только с --webhook)")
+    flow.add_argument("--connections", type=int, default=40, help="соединений к webhook, как max_connections")
+    flow.add_argument("--double-tap", action="store_true", help="нажимать «Перевод на карту» дважды одновременно")
+
+    commit = commands.add_parser("commit", help="запись заказов: commit на каждый запрос против группового")
+    commit.add_argument("--orders", type=int, default=5000)
+    commit.add_argument("--concurrency", type=int, default=200, help="сколько запросов ждут записи одновременно")
+    commit.add_argument("--window", type=float, default=5, help="окно группового коммита, мс")
+    commit.add_argument("--batch-size", type=int, default=100)
+
+    render = commands.add_parser("render", help="подписи и клавиатуры: кэш против сборки заново")
+    render.add_argument("--iterations", type=int, default=5000, help="рендеров каждого экрана")
+
+    archive = commands.add_parser("archive", help="поиск заказа при миллионах заказов в архиве")
+    archive.add_argument("--archived", type=int, default=10_000_000, help="строк в архиве")
+    archive.add_argument("--seed", type=int, default=100_000, help="заказов, переносимых в архив штатным проходом")
+    archive.add_argument("--hot", type=int, default=100_000, help="свежих заказов в рабочей таблице")
+    archive.add_argument("--lookups", type=int, default=5000, help="замеров на каждый запрос")
+    archive.add_argument("--db", help="файл базы (по умолчанию новая во временной папке)")
+    archive.add_argument("--archive-db", help="архив в отдельном файле, как ARCHIVE_DB")
+    args = parser.parse_args(argv)
+    if args.command == "flow" and args.workers > 1 and not args.webhook:
+        parser.error("--workers > 1 работает только с --webhook")
+
+    if args.command == "commit":
+        asyncio.run(commit_bench(args))
+        return
+    if args.command == "render":
+        render_bench(args)
+        return
+    if args.command == "archive":
+        archive_bench(args)
+        return
+
+    result = asyncio.run(bench(args))
+    baseline = json.loads(Path(args.baseline).read_text()) if args.baseline else None
+    print_report(result, baseline)
+    if args.json:
+        Path(args.json).write_text(json.dumps(result, ensure_ascii=False, indent=2))
+    return result
+
+if __name__ == "__main__":
+    main()
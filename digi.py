@@ -1,26 +1,76 @@
+import argparse
 import asyncio
+import bisect
+import csv
+import gzip
+import hashlib
+import heapq
+import hmac
+import itertools
+import json
 import logging
+import multiprocessing
 import sqlite3
 import os
+import queue
+import random
+import signal
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Dict, List, Optional
+from functools import lru_cache
+from pathlib import Path
+from types import MappingProxyType
+from dataclasses import asdict, dataclass, field, fields
+import tempfile
+from typing import ClassVar, Dict, List, Mapping, Optional
 
-from aiogram import Bot, Dispatcher, types, F
+# Отсчет времени запуска: импорт aiogram - самая долгая часть старта
+IMPORT_STARTED = time.perf_counter()
+
+try:
+    import orjson
+except ImportError:  # orjson необязателен, без него работает стандартный json
+    orjson = None
+
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.exceptions import (
+    TelegramAPIError, TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError,
+    TelegramNotFound, TelegramRetryAfter, TelegramServerError
+)
 from aiogram.filters import Command, CommandStart
 from aiogram.types import (
-    InlineKeyboardMarkup, InlineKeyboardButton,
+    FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton,
     ReplyKeyboardRemove
 )
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+import aiohttp
+from aiohttp import web
 
 # ========== КОНФИГУРАЦИЯ ==========
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 ADMIN_IDS = list(map(int, os.environ.get("ADMIN_IDS", "").split(","))) if os.environ.get("ADMIN_IDS") else []
 
+# Адрес Bot API (свой telegram-bot-api сервер или фейковый для bench.py)
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "")
+
+# Уровень логов (DEBUG, INFO, WARNING...)
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+
 # Карта для оплаты
 CARD_NUMBER = "2200700527205453"  # Ваша карта
 
-# Курсы
+# Курсы (значения по умолчанию; актуальные цены - в pricing.current)
 STAR_RATE = 1.5
 USD_RATE = 84.0
 
@@ -39,15 +89,310 @@ SUPPORT_USER = "@swordSar"
 
 # CryptoBot токен (если есть)
 CRYPTOBOT_TOKEN = os.environ.get("CRYPTOBOT_TOKEN", "")
+# API (для тестовой сети - https://testnet-pay.crypt.bot/api), путь вебхука
+# в режиме webhook, как часто сверять открытые счета и сколько живет счет
+CRYPTOBOT_API_URL = os.environ.get("CRYPTOBOT_API_URL", "https://pay.crypt.bot/api")
+CRYPTOBOT_WEBHOOK_PATH = os.environ.get("CRYPTOBOT_WEBHOOK_PATH", "/cryptobot")
+CRYPTOBOT_POLL_INTERVAL = float(os.environ.get("CRYPTOBOT_POLL_INTERVAL", "15"))
+CRYPTOBOT_INVOICE_TTL = int(os.environ.get("CRYPTOBOT_INVOICE_TTL", "3600"))
+
+# Откуда брать цены: db (настройки из админки, по умолчанию), static (константы
+# выше) или URL с JSON {"star_rate": ..., "usd_rate": ..., "premium": {...}};
+# как часто обновлять
+PRICING_SOURCE = os.environ.get("PRICING_SOURCE", "db")
+PRICING_TTL = float(os.environ.get("PRICING_TTL", "300"))
+
+# Как часто перечитывать настройки (правки из других воркеров)
+SETTINGS_RELOAD_INTERVAL = float(os.environ.get("SETTINGS_RELOAD_INTERVAL", "30"))
+
+# База данных: путь, режим WAL, PRAGMA и пул соединений для чтения
+DB_PATH = os.environ.get("DB_PATH", "digistore.db")
+DB_WAL = os.environ.get("DB_WAL", "1") == "1"
+DB_PRAGMAS = {
+    "synchronous": os.environ.get("DB_SYNCHRONOUS", "FULL"),
+    "cache_size": int(os.environ.get("DB_CACHE_SIZE", "-20000")),
+    "mmap_size": int(os.environ.get("DB_MMAP_SIZE", "268435456")),
+    "temp_store": os.environ.get("DB_TEMP_STORE", "MEMORY"),
+}
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_READ_POOL_SIZE = int(os.environ.get("DB_READ_POOL_SIZE", "4"))
+
+# Миграции схемы: строк в одной транзакции дозаполнения, пауза между пачками
+# (чтобы бот успевал писать) и применять ли их при старте (в фоне, воркер 0)
+MIGRATION_BATCH_SIZE = int(os.environ.get("MIGRATION_BATCH_SIZE", "5000"))
+MIGRATION_PAUSE = float(os.environ.get("MIGRATION_PAUSE", "0.01"))
+MIGRATE_ON_START = os.environ.get("MIGRATE_ON_START", "1") == "1"
+
+# Групповой коммит: сколько ждать попутные запросы и максимальный размер пачки
+DB_BATCH_WINDOW_MS = float(os.environ.get("DB_BATCH_WINDOW_MS", "5"))
+DB_BATCH_SIZE = int(os.environ.get("DB_BATCH_SIZE", "100"))
+
+# Режим работы: polling или webhook (aiohttp-сервер за балансировщиком)
+RUN_MODE = os.environ.get("RUN_MODE", "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")  # публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or None
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEBAPP_HOST = os.environ.get("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.environ.get("WEBAPP_PORT", "8080"))
+
+# Горизонтальное масштабирование: WORKERS процессов в режиме webhook на одном порту
+# с общей базой SQLite. WORKER_ID выставляет супервизор для каждого процесса
+WORKERS = int(os.environ.get("WORKERS", "1"))
+WORKER_ID = int(os.environ.get("WORKER_ID", "0"))
+
+# Состояния пользователей: memory или sqlite, время жизни и лимит записей в памяти
+STATE_STORAGE = os.environ.get("STATE_STORAGE", "memory")
+STATE_TTL = int(os.environ.get("STATE_TTL", "86400"))
+STATE_MAX_USERS = int(os.environ.get("STATE_MAX_USERS", "100000"))
+
+# Уведомления: число воркеров, лимиты Telegram (сообщений в секунду всего
+# и пауза между сообщениями в один чат) и число попыток отправки
+NOTIFY_WORKERS = int(os.environ.get("NOTIFY_WORKERS", "8"))
+NOTIFY_RATE = float(os.environ.get("NOTIFY_RATE", "25"))
+NOTIFY_CHAT_INTERVAL = float(os.environ.get("NOTIFY_CHAT_INTERVAL", "1"))
+NOTIFY_MAX_ATTEMPTS = int(os.environ.get("NOTIFY_MAX_ATTEMPTS", "5"))
+
+# Антифлуд: (апдейтов в секунду, запас подряд) на пользователя для сообщений,
+# кнопок и создания заказов; сколько ждать токен, прежде чем отбросить апдейт
+THROTTLE_LIMITS = {
+    "message": (float(os.environ.get("THROTTLE_MESSAGE_RATE", "1")), int(os.environ.get("THROTTLE_MESSAGE_BURST", "5"))),
+    "callback": (float(os.environ.get("THROTTLE_CALLBACK_RATE", "2")), int(os.environ.get("THROTTLE_CALLBACK_BURST", "10"))),
+    "order": (float(os.environ.get("THROTTLE_ORDER_RATE", "0.1")), int(os.environ.get("THROTTLE_ORDER_BURST", "3"))),
+}
+THROTTLE_MAX_DELAY = float(os.environ.get("THROTTLE_MAX_DELAY", "1"))
+THROTTLE_MAX_USERS = int(os.environ.get("THROTTLE_MAX_USERS", "100000"))
+
+# Кэш пользователей для /start: сколько держать в памяти, как часто и какими
+# пачками сохранять новых и сменивших username/имя
+KNOWN_USERS_MAX = int(os.environ.get("KNOWN_USERS_MAX", "100000"))
+USERS_FLUSH_INTERVAL = float(os.environ.get("USERS_FLUSH_INTERVAL", "1"))
+USERS_FLUSH_BATCH = int(os.environ.get("USERS_FLUSH_BATCH", "500"))
+
+# Повторные нажатия «Перевод на карту»: сколько помнить созданные заказы в памяти
+ORDER_DEDUP_TTL = int(os.environ.get("ORDER_DEDUP_TTL", "600"))
+ORDER_DEDUP_SIZE = int(os.environ.get("ORDER_DEDUP_SIZE", "10000"))
+
+# Неоплаченные заказы (pending) старше PENDING_TTL_HOURS помечаются expired;
+# проверка раз в SWEEP_INTERVAL секунд пачками по SWEEP_BATCH_SIZE,
+# при SWEEP_ARCHIVE=1 такие заказы переносятся в orders_archive
+PENDING_TTL_HOURS = float(os.environ.get("PENDING_TTL_HOURS", "24"))
+SWEEP_INTERVAL = float(os.environ.get("SWEEP_INTERVAL", "600"))
+SWEEP_BATCH_SIZE = int(os.environ.get("SWEEP_BATCH_SIZE", "1000"))
+SWEEP_ARCHIVE = os.environ.get("SWEEP_ARCHIVE", "0") == "1"
+
+# Выполненные, отмененные и истекшие заказы старше ARCHIVE_AFTER_DAYS дней
+# переносятся в orders_archive (0 - не переносить); ARCHIVE_DB - отдельный
+# файл для архива, иначе архив лежит в основной базе
+ARCHIVE_AFTER_DAYS = float(os.environ.get("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_DB = os.environ.get("ARCHIVE_DB")
+
+# Периоды отчетов: таблица агрегатов, начало периода для SQLite и подпись
+REPORT_PERIODS = {
+    "24h": ("rollup_hourly", "-23 hours", "24 часа"),
+    "7d": ("rollup_daily", "-6 days", "7 дней"),
+    "30d": ("rollup_daily", "-29 days", "30 дней"),
+}
+
+# Сколько заказов показывать на одной странице админки
+ORDERS_PAGE_SIZE = 10
+
+# Выгрузка заказов: сколько строк читать за раз и предел файла для Telegram
+EXPORT_CHUNK_SIZE = int(os.environ.get("EXPORT_CHUNK_SIZE", "10000"))
+EXPORT_MAX_DOCUMENT = 50 * 1024 * 1024
+
+# Бюджет запуска в секундах: от импорта модуля до готовности принимать апдейты
+# (превышение пишется в лог) и на собственный импорт модуля без aiogram/aiohttp
+# (проверяется командой check-import)
+STARTUP_BUDGET = float(os.environ.get("STARTUP_BUDGET", "5"))
+IMPORT_BUDGET = float(os.environ.get("IMPORT_BUDGET", "0.3"))
+
+# Метрики Prometheus: адрес и порт /metrics (0 - выключено); воркер N
+# слушает METRICS_PORT + N
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9100"))
+
+# ========== МОДЕЛЬ ЗАКАЗА ==========
+if orjson is not None:
+    def dumps_json(obj):
+        return orjson.dumps(obj).decode()
+    
+    loads_json = orjson.loads
+else:
+    def dumps_json(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+    
+    loads_json = json.loads
+
+@dataclass(slots=True, frozen=True)
+class StarsOrder:
+    """Детали заказа звезд"""
+    order_type: ClassVar[str] = "stars"
+    stars: int
+    recipient: str
+
+@dataclass(slots=True, frozen=True)
+class PremiumOrder:
+    """Детали заказа премиума"""
+    order_type: ClassVar[str] = "premium"
+    period: str
+    recipient: str
+
+@dataclass(slots=True, frozen=True)
+class ExchangeOrder:
+    """Детали обмена валют"""
+    order_type: ClassVar[str] = "exchange"
+    amount_rub: float
+    amount_usd: float
+
+ORDER_MODELS = {model.order_type: model for model in (StarsOrder, PremiumOrder, ExchangeOrder)}
+ORDER_STATUSES = ("pending", "waiting", "paid", "completed", "cancelled", "expired")
+# Статусы, в которых повторное нажатие кнопки оплаты показывает тот же заказ
+PAYABLE_STATUSES = ("pending", "waiting")
+
+def order_details(order):
+    """JSON для колонки orders.details"""
+    return dumps_json(asdict(order))
+
+def parse_order_details(order_type, details):
+    """Модель заказа из orders.details (None, если тип неизвестен или JSON битый)"""
+    model = ORDER_MODELS.get(order_type)
+    if model is None or not details:
+        return None
+    try:
+        data = loads_json(details)
+        return model(**{field.name: data[field.name] for field in fields(model)})
+    except (ValueError, KeyError, TypeError):
+        return None
 
 # ========== БАЗА ДАННЫХ С НОВОЙ СИСТЕМОЙ ==========
+STATS_FIELDS = ("total_users", "completed_orders", "total_revenue", "pending_orders", "paid_orders")
+
+def _details_field_sql(field):
+    """Значение из JSON в details (NULL для старых записей с битым JSON)"""
+    return f"CASE WHEN json_valid(details) THEN json_extract(details, '$.{field}') END"
+
+def _rollup_upsert_sql(table, bucket):
+    """Добавляет заказ NEW в агрегат table за период bucket (для триггеров)"""
+    return f"""INSERT INTO {table} (bucket, order_type, status, orders, amount_rub, amount_usd)
+            VALUES ({bucket}, NEW.order_type, NEW.payment_status, 1,
+                    IFNULL(NEW.amount_rub, 0), IFNULL(NEW.amount_usd, 0))
+            ON CONFLICT (bucket, order_type, status) DO UPDATE SET
+                orders = orders + 1,
+                amount_rub = amount_rub + excluded.amount_rub,
+                amount_usd = amount_usd + excluded.amount_usd;"""
+
+HOUR_BUCKET_SQL = "strftime('%Y-%m-%d %H:00:00', {})"
+DAY_BUCKET_SQL = "date({})"
+
+def _rollup_events_sql(table, where="1"):
+    """Переходы заказов table так, как их считают триггеры: (event_date, status, order_type, RUB, USD).
+    
+    Каждый заказ создан (pending по order_date), оплата и выполнение - по payment_date и
+    completed_date. Выполненный сразу, без подтверждения (payment_date = completed_date),
+    оплатой не считается - как и в триггере. У «ждет проверки», отмены и истечения
+    своей даты нет, для них берется order_date; «ждет проверки» у заказов, ушедших
+    дальше, восстановить нельзя.
+    """
+    columns = "order_type, IFNULL(amount_rub, 0) AS amount_rub, IFNULL(amount_usd, 0) AS amount_usd"
+    return f"""
+        SELECT order_date AS event_date, 'pending' AS status, {columns} FROM {table} WHERE {where}
+        UNION ALL
+        SELECT order_date, payment_status, {columns} FROM {table}
+        WHERE ({where}) AND payment_status IN ('waiting', 'cancelled', 'expired')
+        UNION ALL
+        SELECT IFNULL(payment_date, order_date), 'paid', {columns} FROM {table}
+        WHERE ({where}) AND (payment_status = 'paid'
+                             OR payment_date IS NOT NULL AND payment_date IS NOT completed_date)
+        UNION ALL
+        SELECT IFNULL(completed_date, order_date), 'completed', {columns} FROM {table}
+        WHERE ({where}) AND payment_status = 'completed'"""
+
+def _stats_bucket_sql(row):
+    """Имя счетчика в stats для статуса заказа (для триггеров)"""
+    return (
+        f"CASE {row}.payment_status "
+        "WHEN 'pending' THEN 'pending_orders' "
+        "WHEN 'waiting' THEN 'pending_orders' "
+        "WHEN 'paid' THEN 'paid_orders' "
+        "WHEN 'completed' THEN 'completed_orders' END"
+    )
+
+ARCHIVED_STATUSES = ("completed", "cancelled", "expired")
+
+# Из каких статусов пользователь может перевести заказ: "Я перевел" не должен
+# возвращать в ожидание истекший, отмененный или уже оплаченный заказ
+STATUS_SOURCES = {"waiting": ("pending", "waiting")}
+
 class Database:
-    def __init__(self, db_name="digistore.db"):
-        self.conn = sqlite3.connect(db_name, check_same_thread=False)
-        self.create_tables()
+    def __init__(self, db_name="digistore.db", wal=False, pragmas=None, readonly=False, archive_db=None):
+        if readonly:
+            uri = Path(db_name).resolve().as_uri() + "?mode=ro"
+            self.conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            self.conn = sqlite3.connect(db_name, check_same_thread=False)
+        self.conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+        # Архив в отдельном файле: не раздувает основную базу и ее кэш страниц
+        self.archive_table = "orders_archive"
+        self.archive_attached = bool(archive_db)
+        if archive_db:
+            if readonly:
+                self.conn.execute("ATTACH DATABASE ? AS archive", (Path(archive_db).resolve().as_uri() + "?mode=ro",))
+            else:
+                self.conn.execute("ATTACH DATABASE ? AS archive", (archive_db,))
+            self.archive_table = "archive.orders_archive"
+        if wal and not readonly:
+            self.conn.execute("PRAGMA journal_mode = WAL")
+            if archive_db:
+                self.conn.execute("PRAGMA archive.journal_mode = WAL")
+        for name, value in (pragmas or {}).items():
+            self.conn.execute(f"PRAGMA {name} = {value}")
+        self._in_transaction = False
+        if not readonly:
+            self.create_tables()
+
+    @contextmanager
+    def transaction(self):
+        """Выполняет несколько операций в одной транзакции с одним commit"""
+        # IMMEDIATE сразу берет блокировку записи: несколько процессов с общей базой
+        # ждут друг друга (busy_timeout), а не падают с "database is locked"
+        self.conn.execute("BEGIN IMMEDIATE")
+        self._in_transaction = True
+        try:
+            yield
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            self._in_transaction = False
+
+    def _commit(self):
+        if not self._in_transaction:
+            self.conn.commit()
+    
+    def _add_column(self, table, column, definition):
+        """ALTER TABLE ... ADD COLUMN, если такой колонки еще нет"""
+        schema, _, name = table.rpartition(".")
+        pragma = f"PRAGMA {schema}.table_xinfo({name})" if schema else f"PRAGMA table_xinfo({name})"
+        columns = [row[1] for row in self.conn.execute(pragma)]
+        if column not in columns:
+            self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
     
     def create_tables(self):
+        """Исходная схема (версия 0): таблицы, колонки и триггеры - только изменения схемы,
+        без прохода по существующим строкам. Индексы по заказам и пересчеты - в MIGRATIONS"""
         cursor = self.conn.cursor()
+        # Воркеры стартуют одновременно - схему создает кто-то один
+        cursor.execute("BEGIN IMMEDIATE")
+        fresh = cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'orders'").fetchone() is None
+        
+        # Примененные миграции (см. MIGRATIONS)
+        cursor.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''')
         
         # Пользователи
         cursor.execute('''CREATE TABLE IF NOT EXISTS users (
@@ -61,13 +406,13 @@ class Database:
         cursor.execute('''CREATE TABLE IF NOT EXISTS orders (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
-            order_type TEXT,  # 'stars', 'premium', 'exchange'
-            recipient TEXT,  # Для кого заказ
-            details TEXT,  # JSON с деталями (stars, period, etc)
+            order_type TEXT,  -- 'stars', 'premium', 'exchange'
+            recipient TEXT,  -- Для кого заказ
+            details TEXT,  -- JSON с деталями (stars, period, etc)
             amount_rub REAL,
             amount_usd REAL,
-            payment_method TEXT,  # 'card', 'cryptobot'
-            payment_status TEXT DEFAULT 'pending',  # pending, waiting, paid, completed, cancelled
+            payment_method TEXT,  -- 'card', 'cryptobot'
+            payment_status TEXT DEFAULT 'pending',  -- pending, waiting, paid, completed, cancelled
             admin_checked INTEGER DEFAULT 0,
             order_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             payment_date TIMESTAMP,
@@ -75,6 +420,9 @@ class Database:
             FOREIGN KEY (user_id) REFERENCES users (user_id)
         )''')
         
+        self._add_column("orders", "idempotency_key", "TEXT")
+        self._add_column("orders", "price_version", "TEXT")
+        
         # Платежи CryptoBot
         cursor.execute('''CREATE TABLE IF NOT EXISTS crypto_payments (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -84,35 +432,352 @@ class Database:
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (order_id) REFERENCES orders (id)
         )''')
+        self._add_column("crypto_payments", "pay_url", "TEXT")
+        self._add_column("crypto_payments", "paid_at", "TIMESTAMP")
+        
+        # Настройки (в том числе цены для PRICING_SOURCE=db) и все версии цен,
+        # по которым создавались заказы
+        cursor.execute('''CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''')
+        cursor.execute('''CREATE TABLE IF NOT EXISTS price_snapshots (
+            version TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''')
+        
+        # Счетчики статистики, обновляются триггерами в той же транзакции
+        cursor.execute('''CREATE TABLE IF NOT EXISTS stats (
+            name TEXT PRIMARY KEY,
+            value NUMERIC NOT NULL DEFAULT 0
+        )''')
+        cursor.execute('''CREATE TRIGGER IF NOT EXISTS stats_users_insert
+            AFTER INSERT ON users
+        BEGIN
+            UPDATE stats SET value = value + 1 WHERE name = 'total_users';
+        END''')
+        cursor.execute(f'''CREATE TRIGGER IF NOT EXISTS stats_orders_insert
+            AFTER INSERT ON orders
+        BEGIN
+            UPDATE stats SET value = value + 1 WHERE name = {_stats_bucket_sql("NEW")};
+            UPDATE stats SET value = value + NEW.amount_rub
+                WHERE name = 'total_revenue' AND NEW.payment_status = 'completed';
+        END''')
+        cursor.execute(f'''CREATE TRIGGER IF NOT EXISTS stats_orders_status
+            AFTER UPDATE OF payment_status ON orders
+            WHEN OLD.payment_status IS NOT NEW.payment_status
+        BEGIN
+            UPDATE stats SET value = value - 1 WHERE name = {_stats_bucket_sql("OLD")};
+            UPDATE stats SET value = value + 1 WHERE name = {_stats_bucket_sql("NEW")};
+            UPDATE stats SET value = value - OLD.amount_rub
+                WHERE name = 'total_revenue' AND OLD.payment_status = 'completed';
+            UPDATE stats SET value = value + NEW.amount_rub
+                WHERE name = 'total_revenue' AND NEW.payment_status = 'completed';
+        END''')
+        
+        # Архив: заказы, убранные из orders, чтобы рабочая таблица оставалась маленькой
+        cursor.execute(f'''CREATE TABLE IF NOT EXISTS {self.archive_table} (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            order_type TEXT,
+            recipient TEXT,
+            details TEXT,
+            amount_rub REAL,
+            amount_usd REAL,
+            payment_method TEXT,
+            payment_status TEXT,
+            admin_checked INTEGER,
+            order_date TIMESTAMP,
+            payment_date TIMESTAMP,
+            completed_date TIMESTAMP,
+            idempotency_key TEXT,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''')
+        self._add_column(self.archive_table, "price_version", "TEXT")
+        schema = "archive." if self.archive_table.startswith("archive.") else ""
+        cursor.execute(f"""CREATE INDEX IF NOT EXISTS {schema}idx_orders_archive_status_date
+            ON orders_archive (payment_status, order_date)""")
+        
+        # Отчеты: сколько заказов перешло в каждый статус за час/день и на какую сумму
+        for table in ("rollup_hourly", "rollup_daily"):
+            cursor.execute(f'''CREATE TABLE IF NOT EXISTS {table} (
+                bucket TEXT,
+                order_type TEXT,
+                status TEXT,
+                orders INTEGER NOT NULL DEFAULT 0,
+                amount_rub REAL NOT NULL DEFAULT 0,
+                amount_usd REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (bucket, order_type, status)
+            ) WITHOUT ROWID''')
+        created = "IFNULL(NEW.order_date, CURRENT_TIMESTAMP)"
+        cursor.execute(f'''CREATE TRIGGER IF NOT EXISTS rollup_orders_insert
+            AFTER INSERT ON orders
+        BEGIN
+            {_rollup_upsert_sql("rollup_hourly", HOUR_BUCKET_SQL.format(created))}
+            {_rollup_upsert_sql("rollup_daily", DAY_BUCKET_SQL.format(created))}
+        END''')
+        cursor.execute(f'''CREATE TRIGGER IF NOT EXISTS rollup_orders_status
+            AFTER UPDATE OF payment_status ON orders
+            WHEN OLD.payment_status IS NOT NEW.payment_status
+        BEGIN
+            {_rollup_upsert_sql("rollup_hourly", HOUR_BUCKET_SQL.format("CURRENT_TIMESTAMP"))}
+            {_rollup_upsert_sql("rollup_daily", DAY_BUCKET_SQL.format("CURRENT_TIMESTAMP"))}
+        END''')
+        
+        # Состояния пользователей (для STATE_STORAGE=sqlite)
+        cursor.execute('''CREATE TABLE IF NOT EXISTS user_states (
+            user_id INTEGER PRIMARY KEY,
+            state TEXT,
+            expires_at REAL
+        )''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_states_expires ON user_states (expires_at)")
+        
+        # Недоставленные уведомления (переживают перезапуск)
+        cursor.execute('''CREATE TABLE IF NOT EXISTS notifications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            text TEXT,
+            parse_mode TEXT,
+            worker_id INTEGER DEFAULT 0,  -- какой воркер отправляет
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''')
+        self._add_column("notifications", "worker_id", "INTEGER DEFAULT 0")
+        
+        # В новой базе строк нет: миграции выполняются мгновенно, в той же транзакции
+        if fresh:
+            for migration in MIGRATIONS:
+                for statement in migration.statements:
+                    if callable(statement):
+                        statement(self)
+                    else:
+                        cursor.execute(statement)
+                cursor.execute(
+                    "INSERT OR IGNORE INTO schema_version (version, name) VALUES (?, ?)",
+                    (migration.version, migration.name)
+                )
         
         self.conn.commit()
     
-    def add_user(self, user_id, username, full_name):
+    def upsert_users(self, users):
+        """Новые пользователи и смена username/имени одной пачкой (user_id, username, full_name)"""
         cursor = self.conn.cursor()
-        cursor.execute(
-            "INSERT OR IGNORE INTO users (user_id, username, full_name) VALUES (?, ?, ?)",
-            (user_id, username, full_name)
-        )
-        self.conn.commit()
+        cursor.executemany("""
+            INSERT INTO users (user_id, username, full_name) VALUES (?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET username = excluded.username, full_name = excluded.full_name
+            WHERE username IS NOT excluded.username OR full_name IS NOT excluded.full_name
+        """, users)
+        self._commit()
     
-    def add_order(self, user_id, order_type, recipient, details, amount_rub, amount_usd, payment_method):
+    def get_users(self, limit):
+        """До limit пользователей для прогрева кэша"""
         cursor = self.conn.cursor()
+        cursor.execute("SELECT user_id, username, full_name FROM users LIMIT ?", (limit,))
+        return cursor.fetchall()
+    
+    def add_order(self, user_id, order_type, recipient, details, amount_rub, amount_usd, payment_method,
+                  idempotency_key=None, price_version=None, invoice=None):
+        """Новый заказ; с уже известным idempotency_key возвращает id существующего.
+        invoice - (invoice_id, ссылка) уже созданного счета, сохраняется вместе с заказом"""
+        cursor = self.conn.cursor()
+        # Проверка и вставка идут в одной транзакции писателя, поэтому гонки нет;
+        # уникальный индекс страхует от дублей, если ключ все же совпадет
+        if idempotency_key is not None:
+            cursor.execute("SELECT id FROM orders WHERE idempotency_key = ?", (idempotency_key,))
+            row = cursor.fetchone()
+            if row is not None:
+                return row[0]
         cursor.execute(
             """INSERT INTO orders 
-            (user_id, order_type, recipient, details, amount_rub, amount_usd, payment_method) 
-            VALUES (?, ?, ?, ?, ?, ?, ?)""",
-            (user_id, order_type, recipient, details, amount_rub, amount_usd, payment_method)
+            (user_id, order_type, recipient, details, amount_rub, amount_usd, payment_method,
+             idempotency_key, price_version) 
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (user_id, order_type, recipient, details, amount_rub, amount_usd, payment_method,
+             idempotency_key, price_version)
         )
         order_id = cursor.lastrowid
-        self.conn.commit()
+        if invoice is not None:
+            invoice_id, pay_url = invoice
+            cursor.execute(
+                "INSERT INTO crypto_payments (order_id, invoice_id, status, pay_url) VALUES (?, ?, 'active', ?)",
+                (order_id, invoice_id, pay_url)
+            )
+        self._commit()
         return order_id
     
+    def expire_pending_orders(self, older_than_hours, batch_size, archive=False):
+        """Одна пачка: pending старше older_than_hours -> expired (и в архив). Возвращает id заказов,
+        после архивации их нужно передать в drop_archived"""
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            SELECT id FROM orders
+            WHERE payment_status = 'pending' AND order_date < datetime('now', ?)
+            ORDER BY order_date LIMIT ?
+        """, (f"-{older_than_hours} hours", batch_size))
+        ids = [row[0] for row in cursor.fetchall()]
+        if not ids:
+            return []
+        
+        placeholders = ", ".join("?" * len(ids))
+        # Ключ освобождается: повторное нажатие той же кнопки создаст новый заказ,
+        # как и при переносе в архив
+        cursor.execute(
+            f"UPDATE orders SET payment_status = 'expired', idempotency_key = NULL WHERE id IN ({placeholders})",
+            ids
+        )
+        if archive:
+            self._archive_orders(placeholders, ids)
+        self._commit()
+        return ids
+    
+    def _archive_orders(self, placeholders, ids):
+        """Копирует заказы в архив. Архив в том же файле коммитится вместе с orders,
+        и заказы удаляются сразу; отдельный файл в WAL коммитится сам по себе, поэтому
+        удалять можно только после коммита копии - в drop_archived"""
+        columns = ", ".join(ARCHIVE_COLUMNS)
+        self.conn.execute(
+            f"INSERT OR REPLACE INTO {self.archive_table} ({columns}) SELECT {columns} FROM orders WHERE id IN ({placeholders})",
+            ids
+        )
+        if not self.archive_attached:
+            self._drop_archived(placeholders, ids)
+    
+    def _drop_archived(self, placeholders, ids):
+        """Возвращает число удаленных из orders заказов"""
+        # Удаляются только заказы, копия которых лежит в архиве в том же статусе.
+        # Если статус успел смениться (истекший оплатили), заказ остается в orders,
+        # а устаревшая копия убирается из архива, чтобы отчеты не считали его дважды
+        dropped = self.conn.execute(f"""
+            DELETE FROM orders WHERE id IN ({placeholders}) AND payment_status IS (
+                SELECT payment_status FROM {self.archive_table} AS archived WHERE archived.id = orders.id
+            )
+        """, ids).rowcount
+        self.conn.execute(
+            f"DELETE FROM {self.archive_table} WHERE id IN ({placeholders}) "
+            f"AND id IN (SELECT id FROM orders WHERE id IN ({placeholders}))",
+            ids + ids
+        )
+        return dropped
+    
+    def drop_archived(self, ids):
+        """Вторая фаза архивации: удаляет из orders заказы, уже закоммиченные в архиве.
+        Сбой между фазами оставит заказ в обеих таблицах, но не потеряет его:
+        следующий проход скопирует его заново и удалит"""
+        if not ids or not self.archive_attached:
+            return 0
+        dropped = self._drop_archived(", ".join("?" * len(ids)), list(ids))
+        self._commit()
+        return dropped
+    
+    def archive_orders(self, older_than_days, batch_size):
+        """Одна пачка завершенных заказов старше older_than_days -> архив. Возвращает id заказов,
+        их нужно передать в drop_archived отдельной транзакцией"""
+        statuses = ", ".join(f"'{status}'" for status in ARCHIVED_STATUSES)
+        cursor = self.conn.cursor()
+        cursor.execute(f"""
+            SELECT id FROM orders
+            WHERE payment_status IN ({statuses}) AND order_date < datetime('now', ?)
+            LIMIT ?
+        """, (f"-{older_than_days} days", batch_size))
+        ids = [row[0] for row in cursor.fetchall()]
+        if not ids:
+            return []
+        
+        self._archive_orders(", ".join("?" * len(ids)), ids)
+        self._commit()
+        return ids
+    
+    def get_settings(self):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT key, value FROM settings")
+        return dict(cursor.fetchall())
+    
+    def set_setting(self, key, value):
+        self.conn.execute("""
+            INSERT INTO settings (key, value) VALUES (?, ?)
+            ON CONFLICT (key) DO UPDATE SET value = excluded.value, updated_at = CURRENT_TIMESTAMP
+        """, (key, value))
+        self._commit()
+    
+    def save_price_snapshot(self, version, data):
+        self.conn.execute("INSERT OR IGNORE INTO price_snapshots (version, data) VALUES (?, ?)", (version, data))
+        self._commit()
+    
+    def add_crypto_payment(self, order_id, invoice_id, pay_url):
+        self.conn.execute(
+            "INSERT INTO crypto_payments (order_id, invoice_id, status, pay_url) VALUES (?, ?, 'active', ?)",
+            (order_id, invoice_id, pay_url)
+        )
+        self._commit()
+    
+    def get_crypto_payment(self, order_id):
+        """Последний счет заказа: (invoice_id, статус, ссылка на оплату)"""
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            SELECT invoice_id, status, pay_url FROM crypto_payments
+            WHERE order_id = ? ORDER BY id DESC LIMIT 1
+        """, (order_id,))
+        return cursor.fetchone()
+    
+    def get_open_invoices(self):
+        """id всех неоплаченных счетов"""
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT invoice_id FROM crypto_payments WHERE status = 'active'")
+        return [row[0] for row in cursor.fetchall()]
+    
+    def set_invoices_status(self, invoice_ids, status):
+        """Отмечает счета оплаченными/истекшими; оплаченные заказы -> paid.
+        
+        Возвращает (order_id, user_id) заказов, которые стали оплаченными
+        именно сейчас - повторный вебхук или опрос ничего не вернет.
+        """
+        placeholders = ", ".join("?" * len(invoice_ids))
+        cursor = self.conn.cursor()
+        cursor.execute(f"""
+            SELECT order_id FROM crypto_payments
+            WHERE invoice_id IN ({placeholders}) AND status = 'active'
+        """, invoice_ids)
+        order_ids = [row[0] for row in cursor.fetchall()]
+        if not order_ids:
+            return []
+        
+        cursor.execute(f"""
+            UPDATE crypto_payments SET status = ?, paid_at = CASE WHEN ? = 'paid' THEN CURRENT_TIMESTAMP END
+            WHERE invoice_id IN ({placeholders}) AND status = 'active'
+        """, (status, status, *invoice_ids))
+        paid = []
+        if status == "paid":
+            order_placeholders = ", ".join("?" * len(order_ids))
+            cursor.execute(f"""
+                SELECT id, user_id FROM orders
+                WHERE id IN ({order_placeholders}) AND payment_status IN ('pending', 'waiting', 'expired')
+            """, order_ids)
+            paid = cursor.fetchall()
+            cursor.execute(f"""
+                UPDATE orders SET payment_status = 'paid', payment_date = CURRENT_TIMESTAMP
+                WHERE id IN ({order_placeholders}) AND payment_status IN ('pending', 'waiting', 'expired')
+            """, order_ids)
+        self._commit()
+        return paid
+    
+    def find_order(self, idempotency_key):
+        """Заказ по ключу идемпотентности: (id, тип, детали, RUB, USD, статус)"""
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            SELECT id, order_type, details, amount_rub, amount_usd, payment_status
+            FROM orders WHERE idempotency_key = ?
+        """, (idempotency_key,))
+        return cursor.fetchone()
+    
     def update_order_status(self, order_id, status):
         cursor = self.conn.cursor()
         
         if status == 'completed':
+            # Выполнен без отдельного подтверждения - значит, оплачен тогда же
             cursor.execute(
-                "UPDATE orders SET payment_status = ?, completed_date = CURRENT_TIMESTAMP WHERE id = ?",
+                """UPDATE orders SET payment_status = ?, completed_date = CURRENT_TIMESTAMP,
+                payment_date = IFNULL(payment_date, CURRENT_TIMESTAMP) WHERE id = ?""",
                 (status, order_id)
             )
         elif status == 'paid':
@@ -120,62 +785,125 @@ class Database:
                 "UPDATE orders SET payment_status = ?, payment_date = CURRENT_TIMESTAMP WHERE id = ?",
                 (status, order_id)
             )
+        elif status in STATUS_SOURCES:
+            sources = STATUS_SOURCES[status]
+            cursor.execute(
+                f"UPDATE orders SET payment_status = ? WHERE id = ? "
+                f"AND payment_status IN ({', '.join('?' * len(sources))})",
+                (status, order_id, *sources)
+            )
         else:
             cursor.execute(
                 "UPDATE orders SET payment_status = ? WHERE id = ?",
                 (status, order_id)
             )
         
-        self.conn.commit()
+        self._commit()
         return cursor.rowcount > 0
     
-    def get_pending_orders(self):
+    def get_orders_page(self, statuses, cursor=None, backward=False, limit=ORDERS_PAGE_SIZE):
+        """Страница заказов (новые сверху) с курсором по (order_date, id).
+        
+        cursor - id крайнего заказа предыдущей страницы, backward - листать
+        к более новым. Возвращает (orders, prev_cursor, next_cursor).
+        """
+        db_cursor = self.conn.cursor()
+        
+        cursor_key = None
+        if cursor is not None:
+            db_cursor.execute("SELECT order_date FROM orders WHERE id = ?", (cursor,))
+            row = db_cursor.fetchone()
+            if row:
+                cursor_key = (row[0], cursor)
+        
+        # По одному запросу на статус: каждый идет по индексу (payment_status, order_date)
+        # и читает не больше limit + 1 строк
+        order = "ASC" if backward else "DESC"
+        orders = []
+        for status in statuses:
+            if cursor_key is None:
+                db_cursor.execute(f"""
+                    SELECT id, user_id, order_type, recipient, details, amount_rub, payment_method, order_date 
+                    FROM orders 
+                    WHERE payment_status = ? 
+                    ORDER BY order_date {order}, id {order} 
+                    LIMIT ?
+                """, (status, limit + 1))
+            else:
+                db_cursor.execute(f"""
+                    SELECT id, user_id, order_type, recipient, details, amount_rub, payment_method, order_date 
+                    FROM orders 
+                    WHERE payment_status = ? AND (order_date, id) {">" if backward else "<"} (?, ?) 
+                    ORDER BY order_date {order}, id {order} 
+                    LIMIT ?
+                """, (status, *cursor_key, limit + 1))
+            orders.extend(db_cursor.fetchall())
+        
+        orders.sort(key=lambda o: (o[7], o[0]), reverse=not backward)
+        has_more = len(orders) > limit
+        orders = orders[:limit]
+        if backward:
+            orders.reverse()
+        
+        if not orders:
+            return [], None, None
+        if backward:
+            prev_cursor = orders[0][0] if has_more else None
+            next_cursor = orders[-1][0]
+        else:
+            prev_cursor = orders[0][0] if cursor_key else None
+            next_cursor = orders[-1][0] if has_more else None
+        return orders, prev_cursor, next_cursor
+    
+    def get_pending_orders(self, cursor=None, backward=False, limit=ORDERS_PAGE_SIZE):
         """Заказы ожидающие проверки админа"""
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT id, user_id, order_type, recipient, details, amount_rub, payment_method, order_date 
-            FROM orders 
-            WHERE payment_status IN ('pending', 'waiting') 
-            ORDER BY order_date DESC
-        """)
-        return cursor.fetchall()
+        return self.get_orders_page(("pending", "waiting"), cursor, backward, limit)
     
-    def get_active_orders(self):
+    def get_active_orders(self, cursor=None, backward=False, limit=ORDERS_PAGE_SIZE):
         """Активные заказы (оплаченные но не выполненные)"""
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT id, user_id, order_type, recipient, details, amount_rub, payment_method, order_date 
-            FROM orders 
-            WHERE payment_status = 'paid' 
-            ORDER BY order_date DESC
-        """)
-        return cursor.fetchall()
+        return self.get_orders_page(("paid",), cursor, backward, limit)
     
     def get_order_info(self, order_id):
+        """Заказ из рабочей таблицы, а если его там нет - из архива"""
         cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT user_id, order_type, recipient, details, amount_rub, payment_method, payment_status 
-            FROM orders WHERE id = ?
-        """, (order_id,))
-        return cursor.fetchone()
+        for table in ("orders", self.archive_table):
+            cursor.execute(f"""
+                SELECT user_id, order_type, recipient, details, amount_rub, payment_method, payment_status 
+                FROM {table} WHERE id = ?
+            """, (order_id,))
+            row = cursor.fetchone()
+            if row is not None:
+                return row
+        return None
     
     def get_statistics(self):
+        """Статистика из счетчиков - без сканирования таблиц"""
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT name, value FROM stats")
+        stats = dict.fromkeys(STATS_FIELDS, 0)
+        stats.update(cursor.fetchall())
+        return stats
+    
+    def _compute_statistics(self):
+        """Статистика, пересчитанная по таблицам с нуля"""
         cursor = self.conn.cursor()
         
         cursor.execute("SELECT COUNT(*) FROM users")
         total_users = cursor.fetchone()[0]
         
-        cursor.execute("SELECT COUNT(*) FROM orders WHERE payment_status = 'completed'")
-        completed_orders = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT SUM(amount_rub) FROM orders WHERE payment_status = 'completed'")
-        total_revenue = cursor.fetchone()[0] or 0
-        
-        cursor.execute("SELECT COUNT(*) FROM orders WHERE payment_status IN ('pending', 'waiting')")
-        pending_orders = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM orders WHERE payment_status = 'paid'")
-        paid_orders = cursor.fetchone()[0]
+        cursor.execute(f"""
+            SELECT
+                COUNT(CASE WHEN payment_status = 'completed' THEN 1 END),
+                TOTAL(CASE WHEN payment_status = 'completed' THEN amount_rub END),
+                COUNT(CASE WHEN payment_status IN ('pending', 'waiting') THEN 1 END),
+                COUNT(CASE WHEN payment_status = 'paid' THEN 1 END)
+            FROM (
+                SELECT payment_status, amount_rub FROM orders
+                UNION ALL
+                SELECT payment_status, amount_rub FROM {self.archive_table}
+            )
+        """)
+        completed_orders, total_revenue, pending_orders, paid_orders = cursor.fetchone()
         
         return {
             "total_users": total_users,
@@ -184,52 +912,2009 @@ class Database:
             "pending_orders": pending_orders,
             "paid_orders": paid_orders
         }
+    
+    def _write_statistics(self, stats):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO stats (name, value) VALUES (?, ?)",
+            stats.items()
+        )
+    
+    def check_statistics(self):
+        """Пересчитывает статистику с нуля, исправляет счетчики и возвращает расхождения"""
+        stored = self.get_statistics()
+        actual = self._compute_statistics()
+        drift = {
+            name: (stored[name], actual[name])
+            for name in STATS_FIELDS
+            if round(stored[name] - actual[name], 2) != 0
+        }
+        if drift:
+            self._write_statistics(actual)
+            self._commit()
+        return drift
+
+    def get_sales_by_day(self, days=7, status="completed"):
+        """Продажи по дням и типам заказов: (день, тип, заказов, звезд, RUB, USD)"""
+        cursor = self.conn.cursor()
+        since = f"-{int(days)} days"
+        cursor.execute(f"""
+            SELECT day, order_type, COUNT(*), TOTAL(stars), TOTAL(amount_rub), TOTAL(amount_usd)
+            FROM (
+                SELECT date(order_date) AS day, order_type, {_details_field_sql('stars')} AS stars,
+                       amount_rub, amount_usd
+                FROM orders
+                WHERE order_type IN ('stars', 'premium', 'exchange')
+                    AND payment_status = ?
+                    AND order_date >= datetime('now', ?)
+                UNION ALL
+                SELECT date(order_date), order_type, {_details_field_sql('stars')}, amount_rub, amount_usd
+                FROM {self.archive_table}
+                WHERE payment_status = ? AND order_date >= datetime('now', ?)
+            )
+            GROUP BY day, order_type
+            ORDER BY day DESC, order_type
+        """, (status, since, status, since))
+        return cursor.fetchall()
+    
+    def _rebuild_rollups(self):
+        """Заполняет отчеты по уже существующим заказам - по всем их переходам, как триггеры"""
+        for table, bucket in (("rollup_hourly", HOUR_BUCKET_SQL), ("rollup_daily", DAY_BUCKET_SQL)):
+            self.conn.execute(f"DELETE FROM {table}")
+            self.conn.execute(f"""
+                INSERT INTO {table} (bucket, order_type, status, orders, amount_rub, amount_usd)
+                SELECT {bucket.format("event_date")}, order_type, status,
+                       COUNT(*), TOTAL(amount_rub), TOTAL(amount_usd)
+                FROM ({_rollup_events_sql("orders")} UNION ALL {_rollup_events_sql(self.archive_table)})
+                GROUP BY 1, 2, 3
+            """)
+    
+    def _replace_inserted_rollups(self, first_id, last_id):
+        """Заказы first_id..last_id вставлены сразу в итоговом статусе, и триггер посчитал
+        только его. Заменяет это переходами заказов, как если бы они шли по одному"""
+        where = f"id BETWEEN {int(first_id)} AND {int(last_id)}"
+        for table, bucket in (("rollup_hourly", HOUR_BUCKET_SQL), ("rollup_daily", DAY_BUCKET_SQL)):
+            for sign, source in (
+                (-1, f"SELECT order_date AS event_date, payment_status AS status, order_type, "
+                     f"IFNULL(amount_rub, 0) AS amount_rub, IFNULL(amount_usd, 0) AS amount_usd "
+                     f"FROM orders WHERE {where}"),
+                (1, _rollup_events_sql("orders", where)),
+            ):
+                self.conn.execute(f"""
+                    INSERT INTO {table} (bucket, order_type, status, orders, amount_rub, amount_usd)
+                    SELECT {bucket.format("event_date")}, order_type, status,
+                           {sign} * COUNT(*), {sign} * TOTAL(amount_rub), {sign} * TOTAL(amount_usd)
+                    FROM ({source})
+                    GROUP BY 1, 2, 3
+                    ON CONFLICT (bucket, order_type, status) DO UPDATE SET
+                        orders = orders + excluded.orders,
+                        amount_rub = amount_rub + excluded.amount_rub,
+                        amount_usd = amount_usd + excluded.amount_usd
+                """)
+            self.conn.execute(f"DELETE FROM {table} WHERE orders = 0")
+    
+    def get_report(self, period):
+        """Сводка за период из REPORT_PERIODS: (тип, статус, заказов, RUB, USD)"""
+        table, since, _ = REPORT_PERIODS[period]
+        bucket = HOUR_BUCKET_SQL if table == "rollup_hourly" else DAY_BUCKET_SQL
+        cursor = self.conn.cursor()
+        cursor.execute(f"""
+            SELECT order_type, status, SUM(orders), TOTAL(amount_rub), TOTAL(amount_usd)
+            FROM {table}
+            WHERE bucket >= {bucket.format("'now', ?")}
+            GROUP BY order_type, status
+        """, (since,))
+        return cursor.fetchall()
+    
+    def seed_orders(self, count, days=30, batch_size=10000, progress=None):
+        """Синтетические заказы за последние days дней (для замеров).
+        Даты оплаты и выполнения идут после даты заказа, а отчеты получают все переходы заказа"""
+        prices = PriceSnapshot.build(**DEFAULT_PRICES)
+        statuses = ("pending", "waiting", "paid", "completed", "completed", "completed", "cancelled")
+        now = time.time()
+        
+        def timestamp(seconds):
+            return datetime.utcfromtimestamp(min(seconds, now)).strftime("%Y-%m-%d %H:%M:%S")
+        
+        for start in range(0, count, batch_size):
+            rows = []
+            for _ in range(min(batch_size, count - start)):
+                order_type = random.choice(("stars", "premium", "exchange"))
+                if order_type == "stars":
+                    stars = random.randint(50, 5000)
+                    details = order_details(StarsOrder(stars=stars, recipient="seed"))
+                    amount_rub = stars * prices.star_rate
+                elif order_type == "premium":
+                    period = random.choice(tuple(prices.premium))
+                    details = order_details(PremiumOrder(period=period, recipient="seed"))
+                    amount_rub = prices.premium[period]["rub"]
+                else:
+                    amount_rub = float(random.randint(100, 50000))
+                    details = order_details(ExchangeOrder(amount_rub=amount_rub, amount_usd=amount_rub / prices.usd_rate))
+                status = random.choice(statuses)
+                ordered = now - random.uniform(0, days * 86400)
+                paid = ordered + random.uniform(60, 3600) if status in ("paid", "completed") else None
+                completed = paid + random.uniform(60, 7200) if status == "completed" else None
+                rows.append((
+                    random.randint(1, 100000), order_type, "seed", details, amount_rub,
+                    amount_rub / prices.usd_rate, "card", status, timestamp(ordered),
+                    paid and timestamp(paid), completed and timestamp(completed)
+                ))
+            with self.transaction():
+                last_id = self.conn.execute("SELECT IFNULL(MAX(id), 0) FROM orders").fetchone()[0]
+                self.conn.executemany(
+                    """INSERT INTO orders 
+                    (user_id, order_type, recipient, details, amount_rub, amount_usd, payment_method,
+                     payment_status, order_date, payment_date, completed_date) 
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                    rows
+                )
+                self._replace_inserted_rollups(
+                    last_id + 1, self.conn.execute("SELECT MAX(id) FROM orders").fetchone()[0]
+                )
+            if progress:
+                progress(start + len(rows))
+    
+    def get_state(self, user_id, now):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT state FROM user_states WHERE user_id = ? AND expires_at > ?",
+            (user_id, now)
+        )
+        row = cursor.fetchone()
+        return row[0] if row else None
+    
+    def set_state(self, user_id, state, expires_at):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO user_states (user_id, state, expires_at) VALUES (?, ?, ?)",
+            (user_id, state, expires_at)
+        )
+        self._commit()
+    
+    def delete_state(self, user_id):
+        self.conn.execute("DELETE FROM user_states WHERE user_id = ?", (user_id,))
+        self._commit()
+    
+    def purge_states(self, now):
+        """Удаляет просроченные состояния, возвращает их количество"""
+        cursor = self.conn.cursor()
+        cursor.execute("DELETE FROM user_states WHERE expires_at <= ?", (now,))
+        self._commit()
+        return cursor.rowcount
+    
+    def count_states(self, now):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM user_states WHERE expires_at > ?", (now,))
+        return cursor.fetchone()[0]
+    
+    def add_notifications(self, chat_ids, text, parse_mode, worker_id=0):
+        cursor = self.conn.cursor()
+        notification_ids = []
+        for chat_id in chat_ids:
+            cursor.execute(
+                "INSERT INTO notifications (chat_id, text, parse_mode, worker_id) VALUES (?, ?, ?, ?)",
+                (chat_id, text, parse_mode, worker_id)
+            )
+            notification_ids.append(cursor.lastrowid)
+        self._commit()
+        return notification_ids
+    
+    def delete_notification(self, notification_id):
+        self.conn.execute("DELETE FROM notifications WHERE id = ?", (notification_id,))
+        self._commit()
+    
+    def get_notifications(self, worker_id=0):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT id, chat_id, text, parse_mode FROM notifications WHERE worker_id = ? ORDER BY id",
+            (worker_id,)
+        )
+        return cursor.fetchall()
+    
+    def iter_orders(self, date_from=None, date_to=None, status=None, order_type=None,
+                    chunk_size=EXPORT_CHUNK_SIZE):
+        """Заказы (вместе с архивом) пачками по chunk_size по возрастанию id, даты - YYYY-MM-DD включительно.
+
+        Каждая пачка - отдельный запрос с продолжением после последнего id,
+        поэтому память не зависит от размера таблицы, а блокировка чтения
+        не держится на всю выгрузку. Заказы, добавленные после начала
+        выгрузки, в нее не попадают.
+        """
+        conditions = ["id > ?", "id <= ?"]
+        params = []
+        if date_from:
+            conditions.append("order_date >= ?")
+            params.append(date_from)
+        if date_to:
+            conditions.append("order_date < date(?, '+1 day')")
+            params.append(date_to)
+        if status:
+            conditions.append("payment_status = ?")
+            params.append(status)
+        if order_type:
+            conditions.append("order_type = ?")
+            params.append(order_type)
+        
+        # id в рабочей таблице и архиве не пересекаются - сливаем два упорядоченных потока
+        rows = heapq.merge(*(
+            self._iter_table(table, " AND ".join(conditions), params, chunk_size)
+            for table in ("orders", self.archive_table)
+        ))
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+    
+    def _iter_table(self, table, where, params, chunk_size):
+        query = f"SELECT {', '.join(EXPORT_COLUMNS)} FROM {table} WHERE {where} ORDER BY id LIMIT ?"
+        last_id = 0
+        max_id = self.conn.execute(f"SELECT IFNULL(MAX(id), 0) FROM {table}").fetchone()[0]
+        while True:
+            rows = self.conn.execute(query, (last_id, max_id, *params, chunk_size)).fetchall()
+            if not rows:
+                return
+            yield from rows
+            last_id = rows[-1][0]
+    
+    def close(self):
+        self.conn.close()
+
+ARCHIVE_COLUMNS = (
+    "id", "user_id", "order_type", "recipient", "details", "amount_rub", "amount_usd",
+    "payment_method", "payment_status", "admin_checked", "order_date", "payment_date",
+    "completed_date", "idempotency_key", "price_version"
+)
+
+EXPORT_COLUMNS = (
+    "id", "user_id", "order_type", "recipient", "details", "amount_rub", "amount_usd",
+    "payment_method", "payment_status", "order_date", "payment_date", "completed_date"
+)
+
+# ========== МИГРАЦИИ ==========
+@dataclass(frozen=True)
+class Backfill:
+    """Дозаполнение колонки: UPDATE table SET assignments WHERE where, пачками по rowid.
+    Таблица orders_archive берется из той базы, где лежит архив (ARCHIVE_DB)"""
+    table: str
+    assignments: str
+    where: str
+
+@dataclass(frozen=True)
+class Migration:
+    """Версия схемы: команды (SQL или функция от Database) и дозаполнения по порядку.
+    
+    Команды должны быть идемпотентными (IF NOT EXISTS, _add_column):
+    версия записывается в конце, и прерванная миграция выполняется заново.
+    """
+    version: int
+    name: str
+    statements: tuple = ()
+    backfills: tuple = ()
+
+def _add_details_columns(database):
+    """Поля из details для отчетов: вычисляются SQLite из JSON и попадают в индекс"""
+    database._add_column("orders", "stars", f"INTEGER GENERATED ALWAYS AS ({_details_field_sql('stars')}) VIRTUAL")
+    database._add_column("orders", "period", f"TEXT GENERATED ALWAYS AS ({_details_field_sql('period')}) VIRTUAL")
+
+def _recount_statistics(database):
+    """Счетчики stats по уже существующим заказам; дальше их ведут триггеры"""
+    database._write_statistics(database._compute_statistics())
+
+# create_tables - исходная схема (версия 0); все дальнейшие изменения - только здесь,
+# по возрастанию версий. Код должен работать и до, и после миграции: на большой базе
+# она идет в фоне, пока бот принимает заказы
+MIGRATIONS = (
+    Migration(1, "индекс счетов CryptoBot по заказу", statements=(
+        "CREATE INDEX IF NOT EXISTS idx_crypto_payments_order ON crypto_payments (order_id)",
+    )),
+    Migration(2, "дата оплаты у заказов, выполненных без подтверждения", backfills=tuple(
+        Backfill(
+            table, "payment_date = completed_date",
+            "payment_status = 'completed' AND payment_date IS NULL AND completed_date IS NOT NULL"
+        )
+        for table in ("orders", "orders_archive")
+    )),
+    Migration(3, "ключи истекших заказов свободны для новых", backfills=(
+        Backfill("orders", "idempotency_key = NULL", "payment_status = 'expired' AND idempotency_key IS NOT NULL"),
+    )),
+    Migration(4, "индексы для админских списков, заказов пользователя и счетов", statements=(
+        "CREATE INDEX IF NOT EXISTS idx_orders_status_date ON orders (payment_status, order_date)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_user_date ON orders (user_id, order_date)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_crypto_payments_invoice ON crypto_payments (invoice_id)",
+        "CREATE INDEX IF NOT EXISTS idx_crypto_payments_status ON crypto_payments (status)",
+    )),
+    # До индекса повторное нажатие кнопки оплаты находит заказ полным просмотром
+    Migration(5, "уникальный ключ идемпотентности заказов", statements=(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_idempotency ON orders (idempotency_key)",
+    )),
+    # Отчет по дням: тип, статус и диапазон дат без полного сканирования
+    Migration(6, "поля details и индекс для отчетов", statements=(
+        _add_details_columns,
+        """CREATE INDEX IF NOT EXISTS idx_orders_sales ON orders
+            (order_type, payment_status, order_date, stars, period, amount_rub, amount_usd)""",
+    )),
+    # После миграции 2: дата оплаты попадает в отчеты
+    Migration(7, "счетчики статистики и отчеты по существующим заказам", statements=(
+        _recount_statistics,
+        Database._rebuild_rollups,
+    )),
+)
+
+class Migrator:
+    """Применяет MIGRATIONS к базе по порядку.
+    
+    Каждая команда и каждая пачка дозаполнения (batch_size строк по rowid) -
+    отдельная короткая транзакция с паузой pause после нее, поэтому
+    писатель бота ждет блокировку не дольше одной пачки. Исключение -
+    CREATE INDEX и пересчеты счетчиков: SQLite выполняет их одной командой,
+    читать базу в WAL при этом можно, а запись ждет до DB_BUSY_TIMEOUT_MS.
+    """
+
+    def __init__(self, database, migrations=MIGRATIONS, batch_size=MIGRATION_BATCH_SIZE,
+                 pause=MIGRATION_PAUSE, progress=print, stop_event=None):
+        self.db = database
+        self.migrations = sorted(migrations, key=lambda migration: migration.version)
+        self.batch_size = batch_size
+        self.pause = pause
+        self.progress = progress
+        self.stop_event = stop_event or threading.Event()
+
+    def current_version(self):
+        return self.db.conn.execute("SELECT IFNULL(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+    def pending(self):
+        current = self.current_version()
+        return [migration for migration in self.migrations if migration.version > current]
+
+    def run(self, dry_run=False):
+        """Применяет (или при dry_run только описывает) ожидающие миграции; возвращает их версии"""
+        applied = []
+        for migration in self.pending():
+            if self.stop_event.is_set():
+                break
+            if dry_run:
+                self._describe(migration)
+                applied.append(migration.version)
+                continue
+            
+            self.progress(f"🔧 Миграция {migration.version}: {migration.name}")
+            started = time.perf_counter()
+            for statement in migration.statements:
+                with self.db.transaction():
+                    if callable(statement):
+                        statement(self.db)
+                    else:
+                        self.db.conn.execute(statement)
+            if not all(self._backfill(backfill) for backfill in migration.backfills):
+                self.progress(f"⏸ Миграция {migration.version} прервана, продолжится при следующем запуске")
+                break
+            with self.db.transaction():
+                self.db.conn.execute(
+                    "INSERT OR IGNORE INTO schema_version (version, name) VALUES (?, ?)",
+                    (migration.version, migration.name)
+                )
+            applied.append(migration.version)
+            self.progress(f"✅ Миграция {migration.version} за {time.perf_counter() - started:.1f} с")
+        return applied
+
+    def _describe(self, migration):
+        self.progress(f"🔎 Миграция {migration.version}: {migration.name}")
+        for statement in migration.statements:
+            self.progress(f"   {getattr(statement, '__name__', statement)}")
+        for backfill in migration.backfills:
+            table = self._table(backfill)
+            count = self.db.conn.execute(f"SELECT COUNT(*) FROM {table} WHERE {backfill.where}").fetchone()[0]
+            self.progress(f"   UPDATE {table} SET {backfill.assignments}: {count} строк "
+                          f"(~{-(-count // self.batch_size)} пачек по {self.batch_size})")
+
+    def _table(self, backfill):
+        return self.db.archive_table if backfill.table == "orders_archive" else backfill.table
+
+    def _backfill(self, backfill):
+        """UPDATE по диапазонам rowid; False, если остановлено через stop_event"""
+        table = self._table(backfill)
+        low, high = self.db.conn.execute(f"SELECT MIN(rowid), MAX(rowid) FROM {table}").fetchone()
+        if low is None:
+            return True
+        
+        updated = 0
+        reported = time.monotonic()
+        start = low
+        while start <= high:
+            if self.stop_event.is_set():
+                return False
+            end = start + self.batch_size - 1
+            # NOT INDEXED: иначе SQLite может выбрать индекс по условию where
+            # и на каждой пачке просматривать его целиком, а не диапазон rowid
+            with self.db.transaction():
+                cursor = self.db.conn.execute(
+                    f"UPDATE {table} NOT INDEXED SET {backfill.assignments} "
+                    f"WHERE rowid BETWEEN ? AND ? AND ({backfill.where})",
+                    (start, end)
+                )
+            updated += cursor.rowcount
+            start = end + 1
+            if time.monotonic() - reported >= 1 or start > high:
+                reported = time.monotonic()
+                done = min(start - low, high - low + 1) / (high - low + 1)
+                self.progress(f"   {table}: {done:.0%}, обновлено строк: {updated}")
+            time.sleep(self.pause)
+        return True
+
+# ========== МЕТРИКИ ==========
+# Тип и описание метрик, которые пишут middleware и AsyncDatabase
+METRICS_HELP = {
+    "digi_updates_total": ("counter", "Апдейтов получено, по типу"),
+    "digi_update_errors_total": ("counter", "Апдейтов, упавших с исключением"),
+    "digi_update_seconds": ("histogram", "Полное время обработки апдейта"),
+    "digi_handler_seconds": ("histogram", "Время работы хендлера"),
+    "digi_handler_errors_total": ("counter", "Исключений в хендлере"),
+    "digi_db_seconds": ("histogram", "Время запроса к базе вместе с ожиданием в очереди"),
+    "digi_db_errors_total": ("counter", "Ошибок запросов к базе"),
+    "digi_telegram_seconds": ("histogram", "Время вызова Bot API"),
+    "digi_telegram_errors_total": ("counter", "Ошибок вызова Bot API"),
+}
+
+class Metrics:
+    """Счетчики и гистограммы в текстовом формате Prometheus.
+    
+    Запись - пара операций со словарем в потоке event loop, без блокировок;
+    значения, которые и так считают сервисы (очереди, счетчики уведомлений),
+    читаются функциями-сборщиками только при запросе /metrics.
+    """
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, meta=METRICS_HELP, buckets=BUCKETS):
+        self.buckets = buckets
+        self._meta = dict(meta)  # имя -> (тип, описание)
+        self._counters = {}  # имя -> {метки: значение}
+        self._histograms = {}  # имя -> {метки: [число по корзинам..., +Inf, сумма]}
+        self._collectors = []  # (имя, функция)
+
+    def describe(self, name, kind, help_text):
+        self._meta[name] = (kind, help_text)
+
+    def inc(self, name, labels=(), value=1):
+        series = self._counters.setdefault(name, {})
+        series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name, value, labels=()):
+        series = self._histograms.setdefault(name, {})
+        hist = series.get(labels)
+        if hist is None:
+            hist = series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        hist[bisect.bisect_left(self.buckets, value)] += 1
+        hist[-1] += value
+
+    def collect(self, name, kind, help_text, func):
+        """func возвращает число или {метки: число}"""
+        self.describe(name, kind, help_text)
+        self._collectors.append((name, func))
+
+    def render(self):
+        lines = []
+        for name, series in self._counters.items():
+            self._header(lines, name, "counter")
+            lines.extend(f"{name}{_labels(labels)} {value}" for labels, value in series.items())
+        for name, series in self._histograms.items():
+            self._header(lines, name, "histogram")
+            for labels, hist in series.items():
+                total = 0
+                for bound, count in zip((*self.buckets, "+Inf"), hist):
+                    total += count
+                    lines.append(f"{name}_bucket{_labels(labels, ('le', bound))} {total}")
+                lines.append(f"{name}_sum{_labels(labels)} {hist[-1]}")
+                lines.append(f"{name}_count{_labels(labels)} {total}")
+        for name, func in self._collectors:
+            try:
+                value = func()
+            except Exception:
+                logging.exception("Метрика %s не собрана", name)
+                continue
+            self._header(lines, name, "gauge")
+            if isinstance(value, dict):
+                lines.extend(f"{name}{_labels(labels)} {v}" for labels, v in value.items())
+            else:
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def _header(self, lines, name, kind):
+        kind, help_text = self._meta.get(name, (kind, ""))
+        if help_text:
+            lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+def _labels(labels, *extra):
+    pairs = (*labels, *extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape_label(value)}"' for key, value in pairs) + "}"
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Внешний middleware на dp.update: число апдейтов, полное время и необработанные ошибки"""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    async def __call__(self, handler, event, data):
+        labels = (("type", event.event_type),)
+        self.metrics.inc("digi_updates_total", labels)
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            self.metrics.inc("digi_update_errors_total", labels)
+            raise
+        finally:
+            self.metrics.observe("digi_update_seconds", time.perf_counter() - start, labels)
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутренний middleware: время и ошибки по имени хендлера (cmd_start, handle_messages...)"""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        labels = (("handler", handler_object.callback.__name__ if handler_object else "unknown"),)
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            self.metrics.inc("digi_handler_errors_total", labels)
+            raise
+        finally:
+            self.metrics.observe("digi_handler_seconds", time.perf_counter() - start, labels)
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: время и ошибки каждого вызова Bot API"""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    async def __call__(self, make_request, bot, method):
+        labels = (("method", type(method).__name__),)
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            self.metrics.inc("digi_telegram_errors_total", (*labels, ("error", type(e).__name__)))
+            raise
+        finally:
+            self.metrics.observe("digi_telegram_seconds", time.perf_counter() - start, labels)
+
+async def start_metrics_server(metrics, host=METRICS_HOST, port=METRICS_PORT):
+    """HTTP-сервер с одним маршрутом /metrics; возвращает runner для остановки"""
+    async def handle_metrics(request):
+        return web.Response(body=metrics.render().encode(),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+    
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+# ========== АСИНХРОННОЕ ХРАНИЛИЩЕ ==========
+class AsyncDatabase:
+    """Асинхронная обертка над Database с групповым коммитом.
+
+    Все записи выполняются в отдельном потоке-писателе, поэтому
+    медленный fsync не блокирует event loop. Запросы, пришедшие в течение
+    batch_window секунд (но не больше batch_size штук), выполняются в одной
+    транзакции с одним commit. Результат (например, order_id) возвращается
+    только после commit, то есть когда данные уже на диске.
+
+    В режиме WAL чтение (админские списки, статистика) идет через пул
+    read-only соединений и не конкурирует с записью.
+    
+    С metrics время каждого запроса (включая ожидание в очереди писателя
+    или пула) пишется в гистограмму digi_db_seconds по имени метода.
+    """
+
+    def __init__(self, db_name=DB_PATH, batch_window=DB_BATCH_WINDOW_MS / 1000,
+                 batch_size=DB_BATCH_SIZE, wal=DB_WAL, pragmas=DB_PRAGMAS,
+                 read_pool_size=DB_READ_POOL_SIZE, archive_db=ARCHIVE_DB, metrics=None):
+        self._db = Database(db_name, wal=wal, pragmas=pragmas, archive_db=archive_db)
+        self.metrics = metrics
+        self._db_name = db_name
+        self._pragmas = pragmas
+        self._archive_db = archive_db
+        self.archive_attached = self._db.archive_attached
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self._queue = queue.SimpleQueue()
+        self._writer = threading.Thread(target=self._writer_loop, name="db-writer", daemon=True)
+        self._writer.start()
+
+        self._readers = []
+        self._reader_local = threading.local()
+        self._read_executor = None
+        if wal and read_pool_size > 0 and db_name != ":memory:":
+            self._read_executor = ThreadPoolExecutor(
+                max_workers=read_pool_size, thread_name_prefix="db-reader",
+                initializer=self._init_reader, initargs=(db_name, pragmas, archive_db)
+            )
+
+    def _init_reader(self, db_name, pragmas, archive_db):
+        reader = Database(db_name, pragmas=pragmas, readonly=True, archive_db=archive_db)
+        self._reader_local.db = reader
+        self._readers.append(reader)
+
+    def _read_in_pool(self, func, args):
+        return func(self._reader_local.db, *args)
+
+    def _writer_loop(self):
+        running = True
+        while running:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            self._execute_batch(batch)
+        self._db.close()
+
+    def _execute_batch(self, batch):
+        results = []
+        try:
+            with self._db.transaction():
+                for func, args, future in batch:
+                    # Каждый запрос - в своей точке сохранения: упавший откатывает
+                    # только свои изменения, остальные запросы пачки коммитятся
+                    self._db.conn.execute("SAVEPOINT req")
+                    try:
+                        result = func(*args)
+                    except Exception as e:
+                        self._db.conn.execute("ROLLBACK TO req")
+                        results.append((future, None, e))
+                    else:
+                        results.append((future, result, None))
+                    self._db.conn.execute("RELEASE req")
+        except Exception as e:
+            # commit не прошел - ни одна операция из пачки не сохранена
+            results = [(future, None, e) for _, _, future in batch]
+        for future, result, error in results:
+            future.get_loop().call_soon_threadsafe(_resolve_future, future, result, error)
+
+    async def _run(self, func, *args):
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put((func, args, future))
+        if self.metrics is None:
+            return await future
+        return await self._timed(func, future)
+
+    async def _read(self, func, *args):
+        """Чтение: через пул read-only соединений, а без WAL - через писателя"""
+        if self._read_executor is None:
+            return await self._run(func, self._db, *args)
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._read_executor, self._read_in_pool, func, args)
+        if self.metrics is None:
+            return await future
+        return await self._timed(func, future)
+
+    async def _timed(self, func, future):
+        labels = (("query", func.__name__),)
+        start = time.perf_counter()
+        try:
+            return await future
+        except Exception:
+            self.metrics.inc("digi_db_errors_total", labels)
+            raise
+        finally:
+            self.metrics.observe("digi_db_seconds", time.perf_counter() - start, labels)
+
+    def write_queue_size(self):
+        return self._queue.qsize()
+
+    async def upsert_users(self, users):
+        return await self._run(self._db.upsert_users, users)
+
+    async def get_users(self, limit):
+        return await self._read(Database.get_users, limit)
+
+    async def add_order(self, user_id, order_type, recipient, details, amount_rub, amount_usd, payment_method,
+                        idempotency_key=None, price_version=None, invoice=None):
+        return await self._run(
+            self._db.add_order,
+            user_id, order_type, recipient, details, amount_rub, amount_usd, payment_method,
+            idempotency_key, price_version, invoice
+        )
+
+    async def get_settings(self):
+        return await self._read(Database.get_settings)
+
+    async def set_setting(self, key, value):
+        return await self._run(self._db.set_setting, key, value)
+
+    async def save_price_snapshot(self, version, data):
+        return await self._run(self._db.save_price_snapshot, version, data)
+
+    async def expire_pending_orders(self, older_than_hours, batch_size, archive=False):
+        return await self._run(self._db.expire_pending_orders, older_than_hours, batch_size, archive)
+
+    async def archive_orders(self, older_than_days, batch_size):
+        return await self._run(self._db.archive_orders, older_than_days, batch_size)
+
+    async def drop_archived(self, ids):
+        return await self._run(self._db.drop_archived, ids)
+
+    async def add_crypto_payment(self, order_id, invoice_id, pay_url):
+        return await self._run(self._db.add_crypto_payment, order_id, invoice_id, pay_url)
+
+    async def get_crypto_payment(self, order_id):
+        return await self._read(Database.get_crypto_payment, order_id)
+
+    async def get_open_invoices(self):
+        return await self._read(Database.get_open_invoices)
+
+    async def set_invoices_status(self, invoice_ids, status):
+        return await self._run(self._db.set_invoices_status, invoice_ids, status)
+
+    async def find_order(self, idempotency_key):
+        return await self._read(Database.find_order, idempotency_key)
+
+    async def update_order_status(self, order_id, status):
+        return await self._run(self._db.update_order_status, order_id, status)
+
+    async def get_pending_orders(self, cursor=None, backward=False, limit=ORDERS_PAGE_SIZE):
+        return await self._read(Database.get_pending_orders, cursor, backward, limit)
+
+    async def get_active_orders(self, cursor=None, backward=False, limit=ORDERS_PAGE_SIZE):
+        return await self._read(Database.get_active_orders, cursor, backward, limit)
+
+    async def get_order_info(self, order_id):
+        return await self._read(Database.get_order_info, order_id)
+
+    async def get_statistics(self):
+        return await self._read(Database.get_statistics)
+
+    async def check_statistics(self):
+        return await self._run(self._db.check_statistics)
+
+    async def get_sales_by_day(self, days=7, status="completed"):
+        return await self._read(Database.get_sales_by_day, days, status)
+
+    async def get_report(self, period):
+        return await self._read(Database.get_report, period)
+
+    async def get_state(self, user_id, now):
+        return await self._read(Database.get_state, user_id, now)
+
+    async def set_state(self, user_id, state, expires_at):
+        return await self._run(self._db.set_state, user_id, state, expires_at)
+
+    async def delete_state(self, user_id):
+        return await self._run(self._db.delete_state, user_id)
+
+    async def purge_states(self, now):
+        return await self._run(self._db.purge_states, now)
+
+    async def count_states(self, now):
+        return await self._read(Database.count_states, now)
+
+    async def add_notifications(self, chat_ids, text, parse_mode, worker_id=0):
+        return await self._run(self._db.add_notifications, chat_ids, text, parse_mode, worker_id)
+
+    async def delete_notification(self, notification_id):
+        return await self._run(self._db.delete_notification, notification_id)
+
+    async def get_notifications(self, worker_id=0):
+        return await self._read(Database.get_notifications, worker_id)
+
+    async def export_orders(self, path, fmt="csv", **filters):
+        """Выгрузка в отдельном потоке со своим read-only соединением"""
+        if self._db_name == ":memory:":
+            return await self._run(export_orders, self._db, path, fmt, filters)
+        return await asyncio.to_thread(self._export_orders, path, fmt, filters)
+
+    async def migrate(self, stop_event=None, progress=logging.info):
+        """Миграции в отдельном потоке со своим соединением: пачки чередуются с записями бота"""
+        return await asyncio.to_thread(self._migrate, stop_event, progress)
+
+    def _migrate(self, stop_event, progress):
+        database = Database(self._db_name, pragmas=self._pragmas, archive_db=self._archive_db)
+        try:
+            return Migrator(database, progress=progress, stop_event=stop_event).run()
+        finally:
+            database.close()
+
+    def _export_orders(self, path, fmt, filters):
+        reader = Database(self._db_name, pragmas=self._pragmas, readonly=True, archive_db=self._archive_db)
+        try:
+            return export_orders(reader, path, fmt, filters)
+        finally:
+            reader.close()
+
+    def close(self):
+        """Дожидается незавершенных запросов и закрывает соединение"""
+        if self._read_executor is not None:
+            self._read_executor.shutdown(wait=True)
+            for reader in self._readers:
+                reader.close()
+        self._queue.put(None)
+        self._writer.join()
+
+def _resolve_future(future, result, error):
+    if future.cancelled():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+# ========== ВЫГРУЗКА ЗАКАЗОВ ==========
+EXPORT_FORMATS = ("csv", "parquet")
+
+PARQUET_TYPES = {
+    "id": "int64", "user_id": "int64", "amount_rub": "float64", "amount_usd": "float64",
+}
+
+def export_orders(database, path, fmt="csv", filters=None):
+    """Пишет заказы в файл (CSV, .csv.gz или Parquet) пачками, возвращает число строк"""
+    chunks = database.iter_orders(**(filters or {}))
+    if fmt == "parquet":
+        return _write_parquet(chunks, path)
+    return _write_csv(chunks, path)
+
+def _write_csv(chunks, path):
+    # utf-8-sig - чтобы Excel сразу открыл кириллицу
+    opener = gzip.open if str(path).endswith(".gz") else open
+    count = 0
+    with opener(path, "wt", newline="", encoding="utf-8-sig") as file:
+        writer = csv.writer(file)
+        writer.writerow(EXPORT_COLUMNS)
+        for rows in chunks:
+            writer.writerows(rows)
+            count += len(rows)
+    return count
+
+def load_pyarrow():
+    """pyarrow нужен только для выгрузки в Parquet и грузится при первой выгрузке"""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        return None
+    return pyarrow
+
+def _write_parquet(chunks, path):
+    pyarrow = load_pyarrow()
+    if pyarrow is None:
+        raise RuntimeError("Для выгрузки в Parquet установите pyarrow")
+    schema = pyarrow.schema([
+        (column, getattr(pyarrow, PARQUET_TYPES.get(column, "string"))())
+        for column in EXPORT_COLUMNS
+    ])
+    count = 0
+    # Каждая пачка - отдельная row group, в памяти только одна пачка
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        for rows in chunks:
+            columns = [list(column) for column in zip(*rows)]
+            writer.write_table(pyarrow.Table.from_arrays(columns, schema=schema))
+            count += len(rows)
+    return count
+
+def parse_export_args(args):
+    """[с YYYY-MM-DD] [по YYYY-MM-DD] [статус] [тип] [csv|parquet] в любом порядке -> (формат, фильтры)"""
+    fmt = "csv"
+    filters = {}
+    for arg in args:
+        if arg in EXPORT_FORMATS:
+            fmt = arg
+        elif arg in ORDER_STATUSES:
+            filters["status"] = arg
+        elif arg in ORDER_MODELS:
+            filters["order_type"] = arg
+        else:
+            datetime.strptime(arg, "%Y-%m-%d")
+            filters["date_to" if "date_from" in filters else "date_from"] = arg
+    return fmt, filters
+
+# ========== СОСТОЯНИЯ ПОЛЬЗОВАТЕЛЕЙ ==========
+class MemoryStateStore:
+    """Состояния в памяти: живут ttl секунд, при переполнении вытесняются самые старые.
+    
+    Записи упорядочены по времени последнего set, поэтому просроченные
+    всегда лежат в начале и чистятся за O(1) на каждую запись.
+    """
+
+    def __init__(self, ttl=STATE_TTL, max_size=STATE_MAX_USERS):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._states = OrderedDict()  # user_id -> (expires_at, state)
+        self.evicted = 0
+        self.expired = 0
+
+    async def get(self, user_id):
+        item = self._states.get(user_id)
+        if item is None:
+            return None
+        expires_at, state = item
+        if expires_at <= time.monotonic():
+            del self._states[user_id]
+            self.expired += 1
+            return None
+        return dict(state)
+
+    async def set(self, user_id, state):
+        now = time.monotonic()
+        self._states[user_id] = (now + self.ttl, dict(state))
+        self._states.move_to_end(user_id)
+        
+        while self._states:
+            oldest_id, (expires_at, _) = next(iter(self._states.items()))
+            if expires_at <= now:
+                self.expired += 1
+            elif len(self._states) > self.max_size:
+                self.evicted += 1
+            else:
+                break
+            del self._states[oldest_id]
+
+    async def delete(self, user_id):
+        self._states.pop(user_id, None)
+
+    def counters(self):
+        """Счетчики для /metrics - синхронно, из памяти"""
+        return {"live": len(self._states), "evicted": self.evicted, "expired": self.expired}
+
+    async def stats(self):
+        return self.counters()
+
+class SQLiteStateStore:
+    """Состояния в таблице user_states: переживают перезапуск бота"""
+
+    def __init__(self, database, ttl=STATE_TTL, purge_every=1000):
+        self.db = database
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self._writes = 0
+        self.expired = 0
+        self.live = 0  # на момент последней очистки или stats()
+
+    async def get(self, user_id):
+        state = await self.db.get_state(user_id, time.time())
+        return loads_json(state) if state else None
+
+    async def set(self, user_id, state):
+        await self.db.set_state(user_id, dumps_json(state), time.time() + self.ttl)
+        self._writes += 1
+        if self._writes % self.purge_every == 0:
+            self.expired += await self.db.purge_states(time.time())
+            self.live = await self.db.count_states(time.time())
+
+    async def delete(self, user_id):
+        await self.db.delete_state(user_id)
+
+    def counters(self):
+        """Счетчики для /metrics без запроса к базе: live - запомненное значение"""
+        return {"live": self.live, "evicted": 0, "expired": self.expired}
+
+    async def stats(self):
+        self.live = await self.db.count_states(time.time())
+        return self.counters()
+
+def create_state_store(database, storage=STATE_STORAGE):
+    if storage == "sqlite":
+        return SQLiteStateStore(database)
+    return MemoryStateStore()
+
+# ========== ИЗВЕСТНЫЕ ПОЛЬЗОВАТЕЛИ ==========
+class KnownUsers:
+    """Кэш пользователей для /start.
+    
+    Вернувшийся пользователь с теми же username и именем не вызывает
+    записи в базу. Новые и изменившиеся копятся и пишутся одним upsert
+    раз в flush_interval секунд или при batch_size штук. В памяти - LRU
+    на max_size пользователей: user_id -> хеш (username, имя); при старте
+    он заполняется из таблицы users.
+    """
+
+    def __init__(self, database, max_size=KNOWN_USERS_MAX, flush_interval=USERS_FLUSH_INTERVAL,
+                 batch_size=USERS_FLUSH_BATCH):
+        self.db = database
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._users = OrderedDict()  # user_id -> хеш (username, full_name)
+        self._pending = {}  # user_id -> (user_id, username, full_name)
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.hits = 0
+        self.new = 0
+        self.changed = 0
+
+    async def start(self):
+        for user_id, username, full_name in await self.db.get_users(self.max_size):
+            self._users[user_id] = hash((username, full_name))
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    def seen(self, user_id, username, full_name):
+        """Отмечает /start; True - пользователь известен и не изменился"""
+        fingerprint = hash((username, full_name))
+        known = self._users.pop(user_id, None)
+        self._users[user_id] = fingerprint
+        if known == fingerprint:
+            self.hits += 1
+            return True
+        
+        if known is None:
+            self.new += 1
+            if len(self._users) > self.max_size:
+                self._users.popitem(last=False)
+        else:
+            self.changed += 1
+        self._pending[user_id] = (user_id, username, full_name)
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+        return False
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = list(self._pending.values()), {}
+        try:
+            await self.db.upsert_users(batch)
+        except Exception:
+            logging.exception("Не удалось сохранить пользователей (%s)", len(batch))
+            # Вернем в очередь, если за это время не пришли более свежие данные
+            for row in batch:
+                self._pending.setdefault(row[0], row)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def hit_ratio(self):
+        total = self.hits + self.new + self.changed
+        return self.hits / total if total else 0.0
+
+# ========== УВЕДОМЛЕНИЯ ==========
+class Notifier:
+    """Фоновая отправка уведомлений.
+    
+    Сообщение сначала сохраняется в таблицу notifications, затем его
+    отправляет пул воркеров с учетом общего лимита и лимита на чат.
+    При RetryAfter и сетевых ошибках отправка повторяется с задержкой,
+    после доставки запись удаляется. Неотправленное переживает перезапуск.
+    """
+
+    def __init__(self, bot, database, workers=NOTIFY_WORKERS, rate=NOTIFY_RATE,
+                 chat_interval=NOTIFY_CHAT_INTERVAL, max_attempts=NOTIFY_MAX_ATTEMPTS,
+                 worker_id=WORKER_ID):
+        self.bot = bot
+        self.db = database
+        self.worker_id = worker_id
+        self.workers = workers
+        self.rate = rate
+        self.chat_interval = chat_interval
+        self.max_attempts = max_attempts
+        self.queue = asyncio.Queue()
+        self._tasks = []
+        self._next_send = 0.0
+        self._next_chat_send = {}
+        self.sent = 0
+        self.failed = 0
+
+    async def send(self, chat_ids, text, parse_mode=None):
+        """Ставит сообщение в очередь для одного чата или списка чатов"""
+        if isinstance(chat_ids, int):
+            chat_ids = [chat_ids]
+        if not chat_ids:
+            return
+        notification_ids = await self.db.add_notifications(chat_ids, text, parse_mode, self.worker_id)
+        for notification_id, chat_id in zip(notification_ids, chat_ids):
+            self.queue.put_nowait((notification_id, chat_id, text, parse_mode, 0))
+
+    async def start(self):
+        # Каждый воркер дослает только свои сообщения, чтобы не было дублей
+        for notification_id, chat_id, text, parse_mode in await self.db.get_notifications(self.worker_id):
+            self.queue.put_nowait((notification_id, chat_id, text, parse_mode, 0))
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self):
+        while True:
+            item = await self.queue.get()
+            try:
+                await self._deliver(item)
+            except Exception:
+                logging.exception("Ошибка отправки уведомления %s", item[0])
+            finally:
+                self.queue.task_done()
+
+    async def _wait_turn(self, chat_id):
+        """Резервирует ближайший слот отправки с учетом обоих лимитов и ждет его"""
+        now = time.monotonic()
+        slot = max(now, self._next_send, self._next_chat_send.get(chat_id, 0.0))
+        self._next_send = slot + 1 / self.rate
+        self._next_chat_send[chat_id] = slot + self.chat_interval
+        
+        if len(self._next_chat_send) > 10000:
+            self._next_chat_send = {c: t for c, t in self._next_chat_send.items() if t > now}
+        
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def _retry_later(self, item, delay):
+        notification_id, chat_id, text, parse_mode, attempts = item
+        if attempts + 1 >= self.max_attempts:
+            self.failed += 1
+            logging.warning("Уведомление %s в чат %s не доставлено", notification_id, chat_id)
+            return
+        asyncio.get_running_loop().call_later(
+            delay, self.queue.put_nowait,
+            (notification_id, chat_id, text, parse_mode, attempts + 1)
+        )
+
+    async def _deliver(self, item):
+        notification_id, chat_id, text, parse_mode, attempts = item
+        await self._wait_turn(chat_id)
+        
+        try:
+            await self.bot.send_message(chat_id, text, parse_mode=parse_mode)
+        except TelegramRetryAfter as e:
+            # Флуд-контроль: притормаживаем и этот чат, и всю отправку
+            resume = time.monotonic() + e.retry_after
+            self._next_send = max(self._next_send, resume)
+            self._next_chat_send[chat_id] = max(self._next_chat_send.get(chat_id, 0.0), resume)
+            self._retry_later(item, e.retry_after)
+            return
+        except (TelegramNetworkError, TelegramServerError):
+            self._retry_later(item, 2 ** attempts)
+            return
+        except TelegramBadRequest:
+            if parse_mode:
+                # Разметка сломалась (например, "_" в юзернейме) - отправляем как есть
+                self.queue.put_nowait((notification_id, chat_id, text, None, attempts))
+                return
+            self.failed += 1
+            await self.db.delete_notification(notification_id)
+            return
+        except (TelegramForbiddenError, TelegramNotFound):
+            # Пользователь заблокировал бота или чата нет - повторять бессмысленно
+            self.failed += 1
+            await self.db.delete_notification(notification_id)
+            return
+        
+        self.sent += 1
+        await self.db.delete_notification(notification_id)
+
+# ========== ОЧИСТКА ЗАКАЗОВ ==========
+class OrderSweeper:
+    """Фоновая задача: истекшие неоплаченные заказы -> expired,
+    старые завершенные заказы -> orders_archive.
+    
+    Заказы обрабатываются пачками, каждая пачка - отдельная короткая
+    транзакция писателя, поэтому обычные записи между ними не ждут.
+    Архив в отдельном файле переносится в две транзакции: сначала копия,
+    после ее коммита - удаление из orders (drop_archived).
+    """
+
+    def __init__(self, database, ttl_hours=PENDING_TTL_HOURS, interval=SWEEP_INTERVAL,
+                 batch_size=SWEEP_BATCH_SIZE, archive=SWEEP_ARCHIVE, archive_after_days=ARCHIVE_AFTER_DAYS):
+        self.db = database
+        self.ttl_hours = ttl_hours
+        self.interval = interval
+        self.batch_size = batch_size
+        self.archive = archive
+        self.archive_after_days = archive_after_days
+        self._task = None
+        self.last_moved = 0
+        self.total_moved = 0
+        self.last_archived = 0
+        self.total_archived = 0
+
+    async def _batches(self, func, *args, archive=True):
+        moved = 0
+        while True:
+            ids = await func(*args)
+            if archive and ids and self.db.archive_attached:
+                await self.db.drop_archived(ids)
+            moved += len(ids)
+            if len(ids) < self.batch_size:
+                return moved
+
+    async def sweep(self):
+        """Один проход до последней пачки, возвращает число просроченных заказов"""
+        moved = await self._batches(self.db.expire_pending_orders, self.ttl_hours, self.batch_size, self.archive,
+                                   archive=self.archive)
+        self.last_moved = moved
+        self.total_moved += moved
+        if moved:
+            logging.info("Просрочено заказов: %s%s", moved, " (в архиве)" if self.archive else "")
+        return moved
+
+    async def archive_old(self):
+        """Один проход архивации, возвращает число перенесенных заказов"""
+        if not self.archive_after_days:
+            return 0
+        archived = await self._batches(self.db.archive_orders, self.archive_after_days, self.batch_size)
+        self.last_archived = archived
+        self.total_archived += archived
+        if archived:
+            logging.info("Перенесено в архив: %s", archived)
+        return archived
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.sweep()
+                await self.archive_old()
+            except Exception:
+                logging.exception("Ошибка очистки заказов")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+# ========== CRYPTOBOT ==========
+class CryptoBotError(Exception):
+    """Ошибка Crypto Pay API"""
+
+class OrderClosedError(Exception):
+    """Заказ по кнопке оплаты уже нельзя оплатить: оплачен, отменен или истек"""
+
+    def __init__(self, order_id, status):
+        super().__init__(f"заказ #{order_id}: {status}")
+        self.order_id = order_id
+        self.status = status
+
+class CryptoBot:
+    """Оплата через CryptoBot (Crypto Pay API).
+    
+    Все запросы идут через одну aiohttp-сессию с keep-alive. Оплата
+    подтверждается вебхуком invoice_paid, а фоновая сверка раз в
+    poll_interval проверяет все открытые счета одним getInvoices
+    (до 1000 счетов на запрос) - на случай, если вебхук не дошел.
+    """
+
+    # Больше счетов getInvoices за один раз не отдает
+    MAX_INVOICES_PER_CALL = 1000
+
+    def __init__(self, token, database, notifier, api_url=CRYPTOBOT_API_URL,
+                 poll_interval=CRYPTOBOT_POLL_INTERVAL, invoice_ttl=CRYPTOBOT_INVOICE_TTL, admin_ids=ADMIN_IDS):
+        self.token = token
+        self.db = database
+        self.notifier = notifier
+        self.admin_ids = admin_ids
+        self.api_url = api_url.rstrip("/")
+        self.poll_interval = poll_interval
+        self.invoice_ttl = invoice_ttl
+        self._session = None
+        self._task = None
+        self.requests = 0
+        self.confirmed = 0
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers={"Crypto-Pay-API-Token": self.token},
+                connector=aiohttp.TCPConnector(limit=20, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=15)
+            )
+        return self._session
+
+    async def _call(self, method, **params):
+        self.requests += 1
+        try:
+            async with self._get_session().post(f"{self.api_url}/{method}", json=params) as response:
+                data = await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            raise CryptoBotError(f"{method}: {e}") from e
+        if not data.get("ok"):
+            raise CryptoBotError(f"{method}: {data.get('error')}")
+        return data["result"]
+
+    async def create_invoice(self, amount_rub, description, payload):
+        """Счет в рублях (оплата любой криптовалютой), возвращает (invoice_id, ссылка).
+        В базу не пишет: счет привязывает к заказу вызывающий"""
+        invoice = await self._call(
+            "createInvoice",
+            currency_type="fiat", fiat="RUB", amount=f"{amount_rub:.2f}",
+            description=description, payload=payload, expires_in=self.invoice_ttl
+        )
+        pay_url = invoice.get("bot_invoice_url") or invoice.get("pay_url")
+        return str(invoice["invoice_id"]), pay_url
+
+    async def poll(self):
+        """Одна сверка открытых счетов, возвращает число подтвержденных заказов"""
+        invoice_ids = await self.db.get_open_invoices()
+        confirmed = 0
+        for start in range(0, len(invoice_ids), self.MAX_INVOICES_PER_CALL):
+            chunk = invoice_ids[start:start + self.MAX_INVOICES_PER_CALL]
+            result = await self._call("getInvoices", invoice_ids=",".join(chunk), count=len(chunk))
+            by_status = {}
+            for invoice in result.get("items", []):
+                by_status.setdefault(invoice["status"], []).append(str(invoice["invoice_id"]))
+            if by_status.get("expired"):
+                await self.db.set_invoices_status(by_status["expired"], "expired")
+            if by_status.get("paid"):
+                confirmed += await self._confirm(by_status["paid"])
+        return confirmed
+
+    async def _confirm(self, invoice_ids):
+        paid = await self.db.set_invoices_status(invoice_ids, "paid")
+        for order_id, user_id in paid:
+            await self.notifier.send(
+                user_id,
+                f"✅ **Оплата получена!**\n\n"
+                f"🆔 Заказ: #{order_id}\n"
+                "Заказ будет выполнен в ближайшее время.",
+                parse_mode="Markdown"
+            )
+            await self.notifier.send(
+                self.admin_ids,
+                f"💎 **Оплачено через CryptoBot**\n\n"
+                f"🆔 Заказ: #{order_id}\n"
+                f"Для проверки: /check_{order_id}",
+                parse_mode="Markdown"
+            )
+        self.confirmed += len(paid)
+        return len(paid)
+
+    def check_signature(self, body, signature):
+        """Подпись вебхука: HMAC-SHA256 тела, ключ - SHA256 от токена"""
+        secret = hashlib.sha256(self.token.encode()).digest()
+        expected = hmac.new(secret, body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, signature or "")
+
+    async def handle_webhook(self, request):
+        body = await request.read()
+        if not self.check_signature(body, request.headers.get("crypto-pay-api-signature")):
+            return web.Response(status=401)
+        update = loads_json(body)
+        if update.get("update_type") == "invoice_paid":
+            await self._confirm([str(update["payload"]["invoice_id"])])
+        return web.Response(text="ok")
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.poll()
+            except Exception:
+                logging.exception("Ошибка сверки счетов CryptoBot")
+            await asyncio.sleep(self.poll_interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
+
+# ========== НАСТРОЙКИ ==========
+# Что можно менять из админки: ключ -> (название, значение по умолчанию)
+SETTINGS = {
+    "card_number": ("💳 Карта для оплаты", CARD_NUMBER),
+    "star_rate": ("⭐️ Курс звезды, RUB", STAR_RATE),
+    "usd_rate": ("💵 Курс USD, RUB", USD_RATE),
+    "premium_prices": ("👑 Цены Premium (JSON)", PREMIUM_PRICES),
+    "main_photo_id": ("🖼 Фото главного меню (file_id)", MAIN_PHOTO_ID),
+    "reputation_channel": ("📈 Канал репутации", REPUTATION_CHANNEL),
+    "news_channel": ("📰 Канал новостей", NEWS_CHANNEL),
+    "support_user": ("🆘 Тех поддержка", SUPPORT_USER),
+}
+PRICE_SETTINGS = {"star_rate", "usd_rate", "premium_prices"}
+
+def parse_setting(key, text):
+    """Значение настройки из текста админа (ValueError, если не подходит)"""
+    text = text.strip()
+    if not text:
+        raise ValueError("пустое значение")
+    if key in ("star_rate", "usd_rate"):
+        try:
+            value = float(text.replace(",", "."))
+        except ValueError:
+            raise ValueError("нужно число, например 1.5") from None
+        if value <= 0:
+            raise ValueError("курс должен быть больше нуля")
+        return value
+    if key == "premium_prices":
+        try:
+            value = loads_json(text)
+        except ValueError:
+            raise ValueError("неверный JSON") from None
+        if not isinstance(value, dict) or set(value) != set(PREMIUM_PRICES):
+            raise ValueError(f"нужны периоды {', '.join(PREMIUM_PRICES)}")
+        for price in value.values():
+            if not isinstance(price, dict) or {"rub", "usd", "name"} - set(price):
+                raise ValueError("у каждого периода должны быть rub, usd и name")
+            price["rub"], price["usd"] = float(price["rub"]), float(price["usd"])
+        return value
+    if key.endswith("_channel") and not text.startswith("https://"):
+        raise ValueError("ссылка должна начинаться с https://")
+    return text
+
+def dump_setting(value):
+    return dumps_json(value) if isinstance(value, dict) else str(value)
+
+class SettingsStore:
+    """Настройки из таблицы settings с кэшем в памяти.
+    
+    get() - обычный поиск в словаре. Запись сразу обновляет кэш этого
+    процесса, остальные воркеры подхватывают ее при перечитывании раз в
+    reload_interval. При изменении вызывается on_change(ключи).
+    """
+
+    def __init__(self, database, reload_interval=SETTINGS_RELOAD_INTERVAL, on_change=None):
+        self.db = database
+        self.reload_interval = reload_interval
+        self.on_change = on_change
+        self._values = {key: default for key, (_, default) in SETTINGS.items()}
+        self._task = None
+
+    def get(self, key):
+        return self._values[key]
+
+    async def load(self):
+        """Перечитывает таблицу, возвращает множество изменившихся ключей"""
+        values = {key: default for key, (_, default) in SETTINGS.items()}
+        for key, text in (await self.db.get_settings()).items():
+            if key not in SETTINGS:
+                continue
+            try:
+                values[key] = parse_setting(key, text)
+            except ValueError as e:
+                logging.warning("Настройка %s пропущена: %s", key, e)
+        changed = {key for key in values if values[key] != self._values[key]}
+        self._values = values
+        if changed:
+            await self._notify(changed)
+        return changed
+
+    async def set(self, key, text):
+        """Проверяет и сохраняет значение (ValueError, если не подходит)"""
+        value = parse_setting(key, text)
+        await self.db.set_setting(key, dump_setting(value))
+        self._values = {**self._values, key: value}
+        await self._notify({key})
+        return value
+
+    async def _notify(self, keys):
+        if self.on_change is not None:
+            await self.on_change(keys)
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                await self.load()
+            except Exception:
+                logging.exception("Ошибка перечитывания настроек")
+
+    async def start(self):
+        await self.load()
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+# ========== ЦЕНЫ ==========
+@dataclass(slots=True, frozen=True)
+class PriceSnapshot:
+    """Неизменяемый набор цен. Сервис подменяет его целиком одной
+    операцией присваивания, поэтому хендлеры читают цены без блокировок
+    и в пределах одного апдейта видят согласованные значения."""
+    star_rate: float
+    usd_rate: float
+    premium: Mapping[str, Mapping]
+    version: str
+
+    @classmethod
+    def build(cls, star_rate, usd_rate, premium):
+        """Снимок с версией - хешем цен: одинаковые цены дают одну версию во всех процессах"""
+        data = {"star_rate": float(star_rate), "usd_rate": float(usd_rate), "premium": premium}
+        version = hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()[:12]
+        premium = MappingProxyType({key: MappingProxyType(dict(value)) for key, value in premium.items()})
+        return cls(data["star_rate"], data["usd_rate"], premium, version)
+
+    def __hash__(self):
+        # premium не хешируется, а версия и есть хеш цен; снимок - ключ кэша подписей
+        return hash(self.version)
+
+    def to_json(self):
+        return json.dumps({
+            "star_rate": self.star_rate, "usd_rate": self.usd_rate,
+            "premium": {key: dict(value) for key, value in self.premium.items()}
+        }, ensure_ascii=False, sort_keys=True)
+
+DEFAULT_PRICES = {"star_rate": STAR_RATE, "usd_rate": USD_RATE, "premium": PREMIUM_PRICES}
+
+class StaticRatesProvider:
+    """Фиксированные цены (по умолчанию - константы). Годится и как подставной источник в тестах"""
+
+    def __init__(self, rates=None):
+        self.rates = dict(DEFAULT_PRICES if rates is None else rates)
+
+    async def fetch(self):
+        return dict(self.rates)
+
+    async def close(self):
+        pass
+
+class SettingsRatesProvider:
+    """Цены из настроек (star_rate, usd_rate, premium_prices) - без запроса к базе"""
+
+    def __init__(self, settings):
+        self.settings = settings
+
+    async def fetch(self):
+        return {
+            "star_rate": self.settings.get("star_rate"),
+            "usd_rate": self.settings.get("usd_rate"),
+            "premium": self.settings.get("premium_prices"),
+        }
+
+    async def close(self):
+        pass
+
+class HttpRatesProvider:
+    """Цены по HTTP: JSON с любыми из полей star_rate, usd_rate, premium"""
+
+    def __init__(self, url):
+        self.url = url
+        self._session = None
+
+    async def fetch(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+        async with self._session.get(self.url) as response:
+            response.raise_for_status()
+            data = await response.json(content_type=None)
+        return {key: data[key] for key in DEFAULT_PRICES if key in data}
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+def create_rates_provider(settings, source=PRICING_SOURCE):
+    if source == "db":
+        return SettingsRatesProvider(settings)
+    if source.startswith(("http://", "https://")):
+        return HttpRatesProvider(source)
+    return StaticRatesProvider()
+
+class PricingService:
+    """Актуальные цены: pricing.current - последний снимок.
+    
+    Раз в ttl секунд цены перечитываются из провайдера; если они
+    изменились, новый снимок сохраняется в price_snapshots и заменяет
+    текущий. Ошибка провайдера оставляет прежние цены.
+    """
+
+    def __init__(self, provider, database=None, ttl=PRICING_TTL):
+        self.provider = provider
+        self.db = database
+        self.ttl = ttl
+        self.current = PriceSnapshot.build(**DEFAULT_PRICES)
+        self._task = None
+        self.refreshed = 0
+        self.failed = 0
+
+    async def refresh(self):
+        """Перечитывает цены, возвращает True, если снимок сменился"""
+        try:
+            rates = {**DEFAULT_PRICES, **await self.provider.fetch()}
+            snapshot = PriceSnapshot.build(**rates)
+        except Exception as e:
+            self.failed += 1
+            logging.warning("Не удалось обновить цены: %s", e)
+            return False
+        if snapshot.version == self.current.version:
+            return False
+        
+        if self.db is not None:
+            await self.db.save_price_snapshot(snapshot.version, snapshot.to_json())
+        self.current = snapshot
+        self.refreshed += 1
+        return True
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.ttl)
+            await self.refresh()
+
+    async def start(self):
+        await self.refresh()
+        if self.db is not None:
+            await self.db.save_price_snapshot(self.current.version, self.current.to_json())
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await self.provider.close()
+
+# ========== АНТИФЛУД ==========
+class TokenBuckets:
+    """Token bucket на каждую пару (user_id, класс апдейта).
+    
+    Хранится только (токены, время обновления); при переполнении
+    вытесняются давно не активные пользователи - их корзины все равно
+    успели бы наполниться заново.
+    """
+
+    def __init__(self, limits=THROTTLE_LIMITS, max_size=THROTTLE_MAX_USERS):
+        self.limits = limits
+        self.max_size = max_size
+        self._buckets = OrderedDict()  # (user_id, kind) -> (tokens, updated_at)
+        self.evicted = 0
+
+    def acquire(self, user_id, kind, now=None):
+        """Забирает токен и возвращает, сколько секунд подождать до него (0 - сразу)"""
+        rate, burst = self.limits[kind]
+        now = time.monotonic() if now is None else now
+        key = (user_id, kind)
+        tokens, updated_at = self._buckets.pop(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated_at) * rate) - 1
+        self._buckets[key] = (tokens, now)
+        
+        if len(self._buckets) > self.max_size:
+            self._buckets.popitem(last=False)
+            self.evicted += 1
+        return 0.0 if tokens >= 0 else -tokens / rate
+
+    def refund(self, user_id, kind):
+        """Возвращает токен отброшенного апдейта, чтобы флуд не копил долг"""
+        key = (user_id, kind)
+        if key in self._buckets:
+            tokens, updated_at = self._buckets[key]
+            self._buckets[key] = (tokens + 1, updated_at)
+
+    def __len__(self):
+        return len(self._buckets)
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Ограничивает частоту апдейтов от одного пользователя.
+    
+    Класс лимита берется из флага хендлера throttle (например, "order"),
+    иначе "message" или "callback". Если токен появится в течение
+    max_delay секунд, апдейт ждет, иначе отбрасывается.
+    """
+
+    def __init__(self, buckets=None, max_delay=THROTTLE_MAX_DELAY, admin_ids=ADMIN_IDS):
+        self.buckets = buckets or TokenBuckets()
+        self.max_delay = max_delay
+        self.admin_ids = admin_ids
+        self.delayed = dict.fromkeys(self.buckets.limits, 0)
+        self.throttled = dict.fromkeys(self.buckets.limits, 0)
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None or user.id in self.admin_ids:
+            return await handler(event, data)
+        
+        default = "callback" if isinstance(event, types.CallbackQuery) else "message"
+        kind = get_flag(data, "throttle", default=default)
+        wait = self.buckets.acquire(user.id, kind)
+        
+        if wait > self.max_delay:
+            self.buckets.refund(user.id, kind)
+            self.throttled[kind] += 1
+            if isinstance(event, types.CallbackQuery):
+                try:
+                    await event.answer("⏳ Слишком часто, подождите немного")
+                except TelegramAPIError:
+                    pass
+            return None
+        if wait > 0:
+            self.delayed[kind] += 1
+            await asyncio.sleep(wait)
+        return await handler(event, data)
+
+    def stats(self):
+        return {
+            "users": len(self.buckets), "evicted": self.buckets.evicted,
+            "delayed": sum(self.delayed.values()), "throttled": dict(self.throttled),
+        }
 
 # ========== ИНИЦИАЛИЗАЦИЯ ==========
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
-db = Database()
+# Импорт модуля ничего не открывает: бот, диспетчер со своим Router, база и сервисы
+# создаются в create_app(). Хендлеры получают их аргументом app - это данные
+# диспетчера, поэтому в одном процессе может жить несколько приложений
+@dataclass
+class AppConfig:
+    """Параметры приложения; по умолчанию - из переменных окружения"""
+    bot_token: Optional[str] = BOT_TOKEN
+    telegram_api_url: str = TELEGRAM_API_URL
+    db_path: str = DB_PATH
+    archive_db: Optional[str] = ARCHIVE_DB
+    state_storage: str = STATE_STORAGE
+    admin_ids: List[int] = field(default_factory=lambda: list(ADMIN_IDS))
+    cryptobot_token: str = CRYPTOBOT_TOKEN
+    cryptobot_api_url: str = CRYPTOBOT_API_URL
+    run_mode: str = RUN_MODE
+    workers: int = WORKERS
+    worker_id: int = WORKER_ID
+    webhook_url: str = WEBHOOK_URL
+    webhook_path: str = WEBHOOK_PATH
+    webhook_secret: Optional[str] = WEBHOOK_SECRET
+    webhook_max_connections: int = WEBHOOK_MAX_CONNECTIONS
+    webapp_host: str = WEBAPP_HOST
+    webapp_port: int = WEBAPP_PORT
+    metrics_host: str = METRICS_HOST
+    metrics_port: int = METRICS_PORT
+    migrate_on_start: bool = MIGRATE_ON_START
+    pricing_source: str = PRICING_SOURCE
+
+@dataclass
+class App:
+    """Одно приложение: конфиг, бот, диспетчер и сервисы"""
+    config: AppConfig
+    metrics: Metrics
+    bot: Bot
+    dp: Dispatcher
+    db: AsyncDatabase
+    user_states: object
+    known_users: KnownUsers
+    recent_orders: MemoryStateStore
+    sweeper: OrderSweeper
+    notifier: Notifier
+    settings: SettingsStore
+    pricing: PricingService
+    cryptobot: Optional[CryptoBot]
+    throttling: ThrottlingMiddleware
+    metrics_runner: Optional[web.AppRunner] = field(default=None, init=False)
+    migration: Optional[asyncio.Task] = field(default=None, init=False)
+    migration_stop: threading.Event = field(default_factory=threading.Event, init=False)
+
+    async def start(self):
+        """Запускает фоновые сервисы; очистку, сверку CryptoBot и миграции - только в первом воркере"""
+        await self.settings.start()
+        await self.pricing.start()
+        await self.known_users.start()
+        await self.notifier.start()
+        if self.config.metrics_port:
+            self.metrics_runner = await start_metrics_server(
+                self.metrics, self.config.metrics_host, self.config.metrics_port + self.config.worker_id
+            )
+        if self.config.worker_id == 0:
+            self.sweeper.start()
+            if self.cryptobot is not None:
+                self.cryptobot.start()
+            if self.config.migrate_on_start:
+                self.migration = asyncio.create_task(self.db.migrate(self.migration_stop))
+
+    async def stop(self):
+        """Останавливает сервисы, закрывает сессию бота и базу"""
+        if self.migration is not None:
+            self.migration_stop.set()
+            try:
+                await self.migration
+            except Exception:
+                logging.exception("Ошибка миграции")
+        if self.cryptobot is not None:
+            await self.cryptobot.stop()
+        await self.sweeper.stop()
+        await self.notifier.stop()
+        await self.known_users.stop()
+        await self.pricing.stop()
+        await self.settings.stop()
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+        await self.bot.session.close()
+        self.db.close()
+
+def create_app(config=None):
+    """Создает бота, диспетчер со своим Router, базу и сервисы; возвращает App.
+    
+    Вызовы независимы: каждое приложение закрывается своим app.stop().
+    """
+    config = config or AppConfig()
+    if not config.bot_token:
+        raise ValueError("BOT_TOKEN не задан")
+    
+    metrics = Metrics()
+    bot = Bot(
+        token=config.bot_token,
+        session=AiohttpSession(api=TelegramAPIServer.from_base(config.telegram_api_url))
+        if config.telegram_api_url else None
+    )
+    bot.session.middleware(TelegramMetricsMiddleware(metrics))
+    db = AsyncDatabase(config.db_path, archive_db=config.archive_db, metrics=metrics)
+    
+    # Подписи и клавиатуры кэшируются по ценам и настройкам, сбрасывать их не нужно
+    async def on_settings_change(keys):
+        if keys & PRICE_SETTINGS:
+            await pricing.refresh()
+    
+    notifier = Notifier(bot, db, worker_id=config.worker_id)
+    settings = SettingsStore(db, on_change=on_settings_change)
+    pricing = PricingService(create_rates_provider(settings, config.pricing_source), db)
+    cryptobot = None
+    if config.cryptobot_token:
+        cryptobot = CryptoBot(config.cryptobot_token, db, notifier, config.cryptobot_api_url,
+                              admin_ids=config.admin_ids)
+    throttling = ThrottlingMiddleware(admin_ids=config.admin_ids)
+    dp = Dispatcher()
+    app = App(
+        config=config, metrics=metrics, bot=bot, dp=dp, db=db,
+        user_states=create_state_store(db, config.state_storage),
+        known_users=KnownUsers(db),
+        recent_orders=MemoryStateStore(ORDER_DEDUP_TTL, ORDER_DEDUP_SIZE),
+        sweeper=OrderSweeper(db),
+        notifier=notifier, settings=settings, pricing=pricing, cryptobot=cryptobot,
+        throttling=throttling
+    )
+    # Данные диспетчера: aiogram передает app в хендлеры по имени аргумента
+    dp["app"] = app
+    
+    dp.message.middleware(throttling)
+    dp.callback_query.middleware(throttling)
+    # Время хендлера считается после антифлуда, чтобы не учитывать ожидание токена
+    dp.update.outer_middleware(UpdateMetricsMiddleware(metrics))
+    dp.message.middleware(HandlerMetricsMiddleware(metrics))
+    dp.callback_query.middleware(HandlerMetricsMiddleware(metrics))
+    dp.include_router(create_router())
+    
+    register_collectors(app)
+    return app
 
-user_states = {}
+def register_collectors(app):
+    """Метрики, которые и так считают сервисы, - читаются при запросе /metrics"""
+    metrics = app.metrics
+    metrics.collect("digi_notify_queue", "gauge", "Уведомлений в очереди на отправку",
+                    lambda: app.notifier.queue.qsize())
+    metrics.collect("digi_notifications_total", "counter", "Уведомлений отправлено и не доставлено",
+                    lambda: {(("result", "sent"),): app.notifier.sent, (("result", "failed"),): app.notifier.failed})
+    metrics.collect("digi_known_users_total", "counter", "/start: известные без записи, новые и сменившие имя",
+                    lambda: {(("result", "hit"),): app.known_users.hits, (("result", "new"),): app.known_users.new,
+                             (("result", "changed"),): app.known_users.changed})
+    metrics.collect("digi_db_write_queue", "gauge", "Запросов в очереди писателя базы",
+                    app.db.write_queue_size)
+    metrics.collect("digi_user_states", "gauge", "Состояний пользователей в хранилище",
+                    lambda: app.user_states.counters()["live"])
+    metrics.collect("digi_user_states_dropped_total", "counter", "Состояний, вытесненных и просроченных",
+                    lambda: {(("reason", reason),): count for reason, count in app.user_states.counters().items()
+                             if reason != "live"})
+    metrics.collect("digi_throttle_users", "gauge", "Корзин антифлуда в памяти",
+                    lambda: len(app.throttling.buckets))
+    metrics.collect("digi_throttled_total", "counter", "Апдейтов, отброшенных антифлудом",
+                    lambda: {(("kind", kind),): count for kind, count in app.throttling.throttled.items()})
+    metrics.collect("digi_orders_swept_total", "counter", "Заказов, переведенных в expired и в архив",
+                    lambda: {(("action", "expired"),): app.sweeper.total_moved,
+                             (("action", "archived"),): app.sweeper.total_archived})
+    metrics.collect("digi_pricing_refresh_total", "counter", "Обновлений цен",
+                    lambda: {(("result", "ok"),): app.pricing.refreshed, (("result", "failed"),): app.pricing.failed})
+    if app.cryptobot is not None:
+        metrics.collect("digi_cryptobot_confirmed_total", "counter", "Оплат CryptoBot подтверждено",
+                        lambda: app.cryptobot.confirmed)
 
 # ========== КЛАВИАТУРЫ ==========
-def main_menu():
+# Клавиатуры и подписи собираются один раз (lru_cache) и переиспользуются: объекты
+# aiogram при отправке не изменяются. То, что зависит от цен и настроек, получает их
+# аргументами: новые цены или ссылки - новый ключ кэша, сбрасывать ничего не нужно.
+@lru_cache(maxsize=None)
+def _back_row(callback_data):
+    return [InlineKeyboardButton(text="🔙 Назад", callback_data=callback_data)]
+
+@lru_cache(maxsize=None)
+def back_kb(callback_data="main_menu"):
+    """Клавиатура из одной кнопки «Назад»"""
+    return InlineKeyboardMarkup(inline_keyboard=[_back_row(callback_data)])
+
+@lru_cache(maxsize=16)
+def main_menu(support_user):
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="⭐️ Купить звезды", callback_data="buy_stars")],
         [InlineKeyboardButton(text="👑 Купить премиум", callback_data="buy_premium")],
         [InlineKeyboardButton(text="💱 Обмен валют", callback_data="exchange")],
         [InlineKeyboardButton(text="📊 Информация", callback_data="info")],
-        [InlineKeyboardButton(text="🆘 Тех поддержка", url=f"https://t.me/{SUPPORT_USER[1:] if SUPPORT_USER.startswith('@') else SUPPORT_USER}")]
+        [InlineKeyboardButton(text="🆘 Тех поддержка", url=f"https://t.me/{support_user.lstrip('@')}")]
     ])
 
+@lru_cache(maxsize=None)
 def back_to_main_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
+        [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
+    ])
+
+@lru_cache(maxsize=None)
+def buy_stars_kb():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✏️ Ввести получателя", callback_data="enter_stars_recipient")],
+        _back_row("main_menu")
+    ])
+
+@lru_cache(maxsize=None)
+def premium_periods_kb():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="3 месяца", callback_data="premium_3months")],
+        [InlineKeyboardButton(text="6 месяцев", callback_data="premium_6months")],
+        [InlineKeyboardButton(text="1 год", callback_data="premium_1year")],
+        _back_row("main_menu")
+    ])
+
+@lru_cache(maxsize=None)
+def premium_recipient_kb():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✏️ Ввести получателя", callback_data="enter_premium_recipient")],
+        _back_row("buy_premium")
+    ])
+
+@lru_cache(maxsize=16)
+def info_kb(reputation_channel, news_channel):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📈 Репутация", url=reputation_channel)],
+        [InlineKeyboardButton(text="📰 Новости", url=news_channel)],
+        _back_row("main_menu")
     ])
 
-def payment_methods_kb(order_type, order_data):
-    """Методы оплаты"""
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+def payment_methods_kb(order_type, order_data, crypto=False):
+    """Методы оплаты; crypto - подключен ли CryptoBot"""
+    keyboard = [
         [InlineKeyboardButton(text="💳 Перевод на карту", callback_data=f"pay_card_{order_type}_{order_data}")],
-    ])
+    ]
     
-    # Добавляем CryptoBot если есть токен
-    if CRYPTOBOT_TOKEN:
-        keyboard.inline_keyboard.insert(0, 
+    if crypto:
+        keyboard.insert(0, 
             [InlineKeyboardButton(text="💎 CryptoBot", callback_data=f"pay_crypto_{order_type}_{order_data}")]
         )
     
-    keyboard.inline_keyboard.append([InlineKeyboardButton(text="🔙 Назад", callback_data=f"back_to_{order_type}")])
+    keyboard.append(_back_row(f"back_to_{order_type}"))
     
-    return keyboard
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+def crypto_payment_kb(pay_url):
+    """Ссылка на счет CryptoBot"""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="💎 Оплатить в CryptoBot", url=pay_url)],
+        _back_row("main_menu")
+    ])
 
 def card_payment_kb(order_id):
     """Клавиатура после показа карты"""
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="✅ Я перевел", callback_data=f"card_paid_{order_id}")],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")]
+        _back_row("main_menu")
     ])
 
+@lru_cache(maxsize=None)
 def admin_menu_kb():
     """Админ меню"""
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -241,82 +2926,146 @@ def admin_menu_kb():
         [InlineKeyboardButton(text="🔙 В меню", callback_data="main_menu")]
     ])
 
+@lru_cache(maxsize=None)
+def admin_stats_kb():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_stats")],
+        _back_row("admin_back")
+    ])
+
+@lru_cache(maxsize=None)
+def admin_settings_kb():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=title, callback_data=f"admin_setting_{key}")]
+        for key, (title, _) in SETTINGS.items()
+    ] + [_back_row("admin_back")])
+
+@lru_cache(maxsize=None)
+def report_kb(period):
+    """Переключение периода отчета"""
+    periods = [
+        InlineKeyboardButton(text=("• " if key == period else "") + label, callback_data=f"admin_report_{key}")
+        for key, (_, _, label) in REPORT_PERIODS.items()
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=[periods, _back_row("admin_back")])
+
 def order_actions_kb(order_id):
     """Действия с заказом для админа"""
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="✅ Подтвердить оплату", callback_data=f"admin_confirm_{order_id}")],
         [InlineKeyboardButton(text="✅ Заказ выполнен", callback_data=f"admin_complete_{order_id}")],
         [InlineKeyboardButton(text="❌ Отменить", callback_data=f"admin_cancel_{order_id}")],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_pending")]
+        _back_row("admin_pending")
     ])
 
+def orders_page_kb(section, prev_cursor, next_cursor):
+    """Листалка для списков заказов в админке"""
+    keyboard = [
+        [InlineKeyboardButton(text="🔄 Обновить", callback_data=section)],
+        _back_row("admin_back")
+    ]
+    
+    pages = []
+    if prev_cursor is not None:
+        pages.append(InlineKeyboardButton(text="◀️", callback_data=f"{section}_prev_{prev_cursor}"))
+    if next_cursor is not None:
+        pages.append(InlineKeyboardButton(text="▶️", callback_data=f"{section}_next_{next_cursor}"))
+    if pages:
+        keyboard.insert(0, pages)
+    
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+# ========== ПОДПИСИ ==========
+# Ключ кэша - снимок цен (хешируется по версии), поэтому старые цены просто вытесняются
+@lru_cache(maxsize=16)
+def main_menu_caption(prices):
+    return (
+        "🪐 **Digi Store - Главное меню**\n\n"
+        "C помощью нашего магазина вы можете:\n"
+        "• ⭐️ Купить Telegram Stars\n"
+        "• 👑 Купить Telegram Premium\n"
+        "• 💱 Обменять рубли на доллары\n\n"
+        f"📊 **Текущие курсы:**\n"
+        f"• 1 звезда = {prices.star_rate} RUB\n"
+        f"• 1 USD = {prices.usd_rate} RUB\n\n"
+        "Выберите действие:"
+    )
+
+@lru_cache(maxsize=16)
+def buy_stars_caption(prices):
+    return (
+        "⭐️ **Покупка Telegram Stars**\n\n"
+        f"Курс: **1 звезда = {prices.star_rate} RUB**\n"
+        "Диапазон: от 50 до 1,000,000 звезд\n\n"
+        "✏️ Введите username получателя:"
+    )
+
+@lru_cache(maxsize=16)
+def buy_premium_caption(prices):
+    price_text = ""
+    for key, value in prices.premium.items():
+        price_text += f"• {value['name']}: {value['rub']:.2f} RUB\n"
+    
+    return (
+        "👑 **Покупка Telegram Premium**\n\n"
+        "Выберите период:\n\n"
+        f"{price_text}"
+    )
+
+@lru_cache(maxsize=64)
+def premium_period_caption(prices, period):
+    price = prices.premium[period]
+    return (
+        f"👑 **Telegram Premium - {price['name']}**\n\n"
+        f"Цена: **{price['rub']:.2f} RUB**\n\n"
+        "✏️ Введите username получателя:"
+    )
+
+@lru_cache(maxsize=16)
+def exchange_caption(prices):
+    return (
+        "💱 **Обмен валют**\n\n"
+        f"Курс: **1 USD = {prices.usd_rate} RUB**\n\n"
+        "Введите сумму в рублях:\n"
+        "(Минимум: 100 RUB)"
+    )
+
 # ========== ОСНОВНЫЕ ОБРАБОТЧИКИ ==========
-@dp.message(CommandStart())
-async def cmd_start(message: types.Message):
+async def cmd_start(message: types.Message, app: App):
     user_id = message.from_user.id
     username = message.from_user.username or ""
     full_name = message.from_user.full_name
     
-    db.add_user(user_id, username, full_name)
+    # Вернувшиеся пользователи (почти весь трафик /start) не пишут в базу
+    app.known_users.seen(user_id, username, full_name)
     
     await message.answer_photo(
-        photo=MAIN_PHOTO_ID,
-        caption=(
-            "🪐 **Digi Store - Главное меню**\n\n"
-            "C помощью нашего магазина вы можете:\n"
-            "• ⭐️ Купить Telegram Stars\n"
-            "• 👑 Купить Telegram Premium\n"
-            "• 💱 Обменять рубли на доллары\n\n"
-            f"📊 **Текущие курсы:**\n"
-            f"• 1 звезда = {STAR_RATE} RUB\n"
-            f"• 1 USD = {USD_RATE} RUB\n\n"
-            "Выберите действие:"
-        ),
-        reply_markup=main_menu(),
+        photo=app.settings.get("main_photo_id"),
+        caption=main_menu_caption(app.pricing.current),
+        reply_markup=main_menu(app.settings.get("support_user")),
         parse_mode="Markdown"
     )
 
-@dp.callback_query(F.data == "main_menu")
-async def main_menu_handler(callback: types.CallbackQuery):
+async def main_menu_handler(callback: types.CallbackQuery, app: App):
     await callback.message.edit_caption(
-        caption=(
-            "🪐 **Digi Store - Главное меню**\n\n"
-            "C помощью нашего магазина вы можете:\n"
-            "• ⭐️ Купить Telegram Stars\n"
-            "• 👑 Купить Telegram Premium\n"
-            "• 💱 Обменять рубли на доллары\n\n"
-            f"📊 **Текущие курсы:**\n"
-            f"• 1 звезда = {STAR_RATE} RUB\n"
-            f"• 1 USD = {USD_RATE} RUB\n\n"
-            "Выберите действие:"
-        ),
-        reply_markup=main_menu(),
+        caption=main_menu_caption(app.pricing.current),
+        reply_markup=main_menu(app.settings.get("support_user")),
         parse_mode="Markdown"
     )
     await callback.answer()
 
 # ========== ПОКУПКА ЗВЕЗД ==========
-@dp.callback_query(F.data == "buy_stars")
-async def buy_stars_handler(callback: types.CallbackQuery):
+async def buy_stars_handler(callback: types.CallbackQuery, app: App):
     await callback.message.edit_caption(
-        caption=(
-            "⭐️ **Покупка Telegram Stars**\n\n"
-            f"Курс: **1 звезда = {STAR_RATE} RUB**\n"
-            "Диапазон: от 50 до 1,000,000 звезд\n\n"
-            "✏️ Введите username получателя:"
-        ),
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="✏️ Ввести получателя", callback_data="enter_stars_recipient")],
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")]
-        ]),
+        caption=buy_stars_caption(app.pricing.current),
+        reply_markup=buy_stars_kb(),
         parse_mode="Markdown"
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "enter_stars_recipient")
-async def enter_stars_recipient_handler(callback: types.CallbackQuery):
+async def enter_stars_recipient_handler(callback: types.CallbackQuery, app: App):
     user_id = callback.from_user.id
-    user_states[user_id] = {"action": "waiting_stars_recipient"}
+    await app.user_states.set(user_id, {"action": "waiting_stars_recipient"})
     
     await callback.message.edit_caption(
         caption=(
@@ -325,165 +3074,145 @@ async def enter_stars_recipient_handler(callback: types.CallbackQuery):
             "Пример: @username\n\n"
             "Отправьте username сообщением:"
         ),
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="buy_stars")]
-        ]),
+        reply_markup=back_kb("buy_stars"),
         parse_mode="Markdown"
     )
     await callback.answer()
 
 # ========== ПОКУПКА ПРЕМИУМА ==========
-@dp.callback_query(F.data == "buy_premium")
-async def buy_premium_handler(callback: types.CallbackQuery):
-    price_text = ""
-    for key, value in PREMIUM_PRICES.items():
-        price_text += f"• {value['name']}: {value['rub']:.2f} RUB\n"
-    
+async def buy_premium_handler(callback: types.CallbackQuery, app: App):
     await callback.message.edit_caption(
-        caption=(
-            "👑 **Покупка Telegram Premium**\n\n"
-            "Выберите период:\n\n"
-            f"{price_text}"
-        ),
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="3 месяца", callback_data="premium_3months")],
-            [InlineKeyboardButton(text="6 месяцев", callback_data="premium_6months")],
-            [InlineKeyboardButton(text="1 год", callback_data="premium_1year")],
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")]
-        ]),
+        caption=buy_premium_caption(app.pricing.current),
+        reply_markup=premium_periods_kb(),
         parse_mode="Markdown"
     )
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("premium_"))
-async def select_premium_period_handler(callback: types.CallbackQuery):
+async def select_premium_period_handler(callback: types.CallbackQuery, app: App):
     period = callback.data.split("_")[1]
     
-    if period in PREMIUM_PRICES:
+    prices = app.pricing.current
+    premium = prices.premium
+    if period in premium:
         user_id = callback.from_user.id
-        price = PREMIUM_PRICES[period]
+        price = premium[period]
         
-        user_states[user_id] = {
+        await app.user_states.set(user_id, {
             "action": "premium_selected",
             "period": period,
             "period_name": price["name"],
             "amount_rub": price["rub"]
-        }
+        })
         
         await callback.message.edit_caption(
-            caption=(
-                f"👑 **Telegram Premium - {price['name']}**\n\n"
-                f"Цена: **{price['rub']:.2f} RUB**\n\n"
-                "✏️ Введите username получателя:"
-            ),
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="✏️ Ввести получателя", callback_data="enter_premium_recipient")],
-                [InlineKeyboardButton(text="🔙 Назад", callback_data="buy_premium")]
-            ]),
+            caption=premium_period_caption(prices, period),
+            reply_markup=premium_recipient_kb(),
             parse_mode="Markdown"
         )
     
     await callback.answer()
 
-@dp.callback_query(F.data == "enter_premium_recipient")
-async def enter_premium_recipient_handler(callback: types.CallbackQuery):
+async def enter_premium_recipient_handler(callback: types.CallbackQuery, app: App):
     user_id = callback.from_user.id
-    if user_id in user_states:
-        user_states[user_id]["action"] = "waiting_premium_recipient"
+    state = await app.user_states.get(user_id)
+    if state is not None:
+        state["action"] = "waiting_premium_recipient"
+        await app.user_states.set(user_id, state)
     
     await callback.message.edit_caption(
         caption=(
             "✏️ **Введите username получателя**\n\n"
             "Отправьте username сообщением:"
         ),
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="buy_premium")]
-        ]),
+        reply_markup=back_kb("buy_premium"),
         parse_mode="Markdown"
     )
     await callback.answer()
 
 # ========== ОБМЕН ВАЛЮТЫ ==========
-@dp.callback_query(F.data == "exchange")
-async def exchange_handler(callback: types.CallbackQuery):
+async def exchange_handler(callback: types.CallbackQuery, app: App):
     user_id = callback.from_user.id
-    user_states[user_id] = {"action": "waiting_exchange_amount"}
+    await app.user_states.set(user_id, {"action": "waiting_exchange_amount"})
     
     await callback.message.edit_caption(
-        caption=(
-            "💱 **Обмен валют**\n\n"
-            f"Курс: **1 USD = {USD_RATE} RUB**\n\n"
-            "Введите сумму в рублях:\n"
-            "(Минимум: 100 RUB)"
-        ),
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")]
-        ]),
+        caption=exchange_caption(app.pricing.current),
+        reply_markup=back_kb("main_menu"),
         parse_mode="Markdown"
     )
     await callback.answer()
 
 # ========== ИНФОРМАЦИЯ ==========
-@dp.callback_query(F.data == "info")
-async def info_handler(callback: types.CallbackQuery):
+async def info_handler(callback: types.CallbackQuery, app: App):
     await callback.message.edit_caption(
         caption="📊 **Информация**\n\nВыберите раздел:",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="📈 Репутация", url=REPUTATION_CHANNEL)],
-            [InlineKeyboardButton(text="📰 Новости", url=NEWS_CHANNEL)],
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")]
-        ]),
+        reply_markup=info_kb(app.settings.get("reputation_channel"), app.settings.get("news_channel")),
         parse_mode="Markdown"
     )
     await callback.answer()
 
 # ========== ОБРАБОТКА ТЕКСТОВЫХ СООБЩЕНИЙ ==========
-@dp.message()
-async def handle_messages(message: types.Message):
+async def handle_messages(message: types.Message, app: App):
     user_id = message.from_user.id
     text = message.text.strip()
     
-    if user_id not in user_states:
-        await message.answer("Используйте меню", reply_markup=main_menu())
+    state = await app.user_states.get(user_id)
+    if state is None:
+        await message.answer("Используйте меню", reply_markup=main_menu(app.settings.get("support_user")))
         return
     
-    state = user_states[user_id]
     action = state.get("action", "")
     
+    # Новое значение настройки от админа
+    if action == "admin_setting" and user_id in app.config.admin_ids:
+        key = state["key"]
+        try:
+            await app.settings.set(key, text)
+        except ValueError as e:
+            await message.answer(f"❌ {e}\nПопробуйте еще раз:", reply_markup=back_kb("admin_settings"))
+            return
+        
+        await app.user_states.delete(user_id)
+        await message.answer(
+            f"✅ {SETTINGS[key][0]} сохранено\n\n" + settings_text(app.settings, app.config.pricing_source),
+            reply_markup=admin_settings_kb(),
+            parse_mode="Markdown"
+        )
+    
     # Обработка получателя звезд
-    if action == "waiting_stars_recipient":
+    elif action == "waiting_stars_recipient":
         recipient = text.replace("@", "")
         state["recipient"] = recipient
         state["action"] = "waiting_stars_amount"
+        await app.user_states.set(user_id, state)
         
         await message.answer(
             f"✅ Получатель: {recipient}\n\n"
             "Введите количество звезд (50-1,000,000):",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔙 Назад", callback_data="buy_stars")]
-            ])
+            reply_markup=back_kb("buy_stars")
         )
     
     # Обработка количества звезд
     elif action == "waiting_stars_amount":
+        prices = app.pricing.current
         try:
             stars = int(text)
             if stars < 50 or stars > 1000000:
                 await message.answer("❌ От 50 до 1,000,000")
                 return
             
-            amount_rub = stars * STAR_RATE
-            amount_usd = amount_rub / USD_RATE
+            amount_rub = stars * prices.star_rate
+            amount_usd = amount_rub / prices.usd_rate
             recipient = state.get("recipient", "")
             
             state["stars_amount"] = stars
             state["amount_rub"] = amount_rub
+            await app.user_states.set(user_id, state)
             
             await message.answer(
                 f"✅ {stars} звезд\n"
                 f"💰 {amount_rub:.2f} RUB\n\n"
                 "Выберите оплату:",
-                reply_markup=payment_methods_kb("stars", f"{stars}_{recipient}")
+                reply_markup=payment_methods_kb("stars", f"{stars}_{recipient}", app.cryptobot is not None)
             )
         except ValueError:
             await message.answer("❌ Введите число")
@@ -497,120 +3226,173 @@ async def handle_messages(message: types.Message):
         
         if period and amount_rub:
             state["recipient"] = recipient
+            await app.user_states.set(user_id, state)
             
             await message.answer(
                 f"✅ Получатель: {recipient}\n"
                 f"👑 {period_name}\n"
                 f"💰 {amount_rub:.2f} RUB\n\n"
                 "Выберите оплату:",
-                reply_markup=payment_methods_kb("premium", f"{period}_{recipient}")
+                reply_markup=payment_methods_kb("premium", f"{period}_{recipient}", app.cryptobot is not None)
             )
     
     # Обработка суммы обмена
     elif action == "waiting_exchange_amount":
+        prices = app.pricing.current
         try:
             amount_rub = float(text)
             if amount_rub < 100:
                 await message.answer("❌ Минимум 100 RUB")
                 return
             
-            amount_usd = amount_rub / USD_RATE
+            amount_usd = amount_rub / prices.usd_rate
             state["exchange_amount"] = amount_rub
+            await app.user_states.set(user_id, state)
             
             await message.answer(
                 f"✅ {amount_rub:.2f} RUB → {amount_usd:.2f} USD\n"
-                f"Курс: 1 USD = {USD_RATE} RUB\n\n"
+                f"Курс: 1 USD = {prices.usd_rate} RUB\n\n"
                 "Выберите оплату:",
-                reply_markup=payment_methods_kb("exchange", f"{amount_rub}")
+                reply_markup=payment_methods_kb("exchange", f"{amount_rub}", app.cryptobot is not None)
             )
         except ValueError:
             await message.answer("❌ Введите число")
 
 # ========== ОПЛАТА КАРТОЙ ==========
-@dp.callback_query(F.data.startswith("pay_card_"))
-async def card_payment_handler(callback: types.CallbackQuery):
-    data = callback.data.split("_")
-    order_type = data[2]
-    order_data = data[3] if len(data) > 3 else ""
-    
-    user_id = callback.from_user.id
-    user_state = user_states.get(user_id, {})
-    
-    # Определяем детали заказа
+def order_idempotency_key(user_id, order_type, order_data, message_id, payment_method="card"):
+    """Одна и та же кнопка под одним сообщением - один и тот же заказ"""
+    key = f"{user_id}:{message_id}:{order_type}:{order_data}"
+    return key if payment_method == "card" else f"{key}:{payment_method}"
+
+async def find_order(app, key):
+    """Заказ по ключу: сначала недавние в памяти, затем индекс в базе.
+    Статус всегда из базы: заказ мог оплатить админ или просрочить очистка в другом воркере"""
+    order = await app.recent_orders.get(key)
+    if order is not None:
+        order_info = await app.db.get_order_info(order["order_id"])
+        order["status"] = order_info[6] if order_info else "expired"
+        if order["status"] in PAYABLE_STATUSES:
+            return order
+        # Истекший заказ освободил ключ - дальше по индексу найдется только оплаченный или отмененный
+        await app.recent_orders.delete(key)
+    row = await app.db.find_order(key)
+    if row is None:
+        return None
+    order = dict(zip(("order_id", "order_type", "details", "amount_rub", "amount_usd", "status"), row))
+    if order["status"] in PAYABLE_STATUSES:
+        await app.recent_orders.set(key, order)
+    return order
+
+def closed_order_text(status):
+    """Ответ на кнопку заказа, который уже нельзя оплатить"""
+    if status in ("paid", "completed"):
+        return "✅ Этот заказ уже оплачен"
+    if status == "cancelled":
+        return "❌ Заказ отменен, оформите его заново"
+    return "⌛ Заказ истек, оформите его заново"
+
+def order_caption(order_type, order, amount_rub, amount_usd, prices):
+    """Описание заказа над реквизитами"""
+    if order_type == "stars":
+        return (
+            f"⭐️ **Покупка звезд**\n\n"
+            f"Получатель: {order.recipient}\n"
+            f"Количество: {order.stars} ⭐️\n"
+            f"Сумма: **{amount_rub:.2f} RUB**\n\n"
+        )
+    if order_type == "premium":
+        return (
+            f"👑 **Telegram Premium**\n\n"
+            f"Период: {prices.premium[order.period]['name']}\n"
+            f"Получатель: {order.recipient}\n"
+            f"Сумма: **{amount_rub:.2f} RUB**\n\n"
+        )
+    return (
+        f"💱 **Обмен валют**\n\n"
+        f"Отдаете: {amount_rub:.2f} RUB\n"
+        f"Получаете: {amount_usd:.2f} USD\n"
+        f"Курс: 1 USD = {round(amount_rub / amount_usd, 4) if amount_usd else 0} RUB\n\n"
+    )
+
+def build_order(order_type, order_data, user_state, prices):
+    """Модель заказа по ценам prices из данных кнопки или состояния покупки: (заказ, получатель, RUB, USD)"""
     if order_type == "stars":
         if "_" in order_data:
-            stars_str, recipient = order_data.split("_")
+            stars_str, recipient = order_data.split("_", 1)
             stars = int(stars_str)
-            amount_rub = stars * STAR_RATE
-            details = f'{{"stars": {stars}, "recipient": "{recipient}"}}'
         else:
             stars = user_state.get("stars_amount", 0)
             recipient = user_state.get("recipient", "")
-            amount_rub = stars * STAR_RATE
-            details = f'{{"stars": {stars}, "recipient": "{recipient}"}}'
-        
-        amount_usd = amount_rub / USD_RATE
-        
-        # Создаем заказ
-        order_id = db.add_order(
-            user_id, "stars", recipient, details, 
-            amount_rub, amount_usd, "card"
-        )
         
-        caption = (
-            f"⭐️ **Покупка звезд**\n\n"
-            f"Получатель: {recipient}\n"
-            f"Количество: {stars} ⭐️\n"
-            f"Сумма: **{amount_rub:.2f} RUB**\n\n"
-        )
+        amount_rub = stars * prices.star_rate
+        amount_usd = amount_rub / prices.usd_rate
+        return StarsOrder(stars=stars, recipient=recipient), recipient, amount_rub, amount_usd
     
-    elif order_type == "premium":
+    if order_type == "premium":
         if "_" in order_data:
-            period, recipient = order_data.split("_")
+            period, recipient = order_data.split("_", 1)
         else:
             period = user_state.get("period")
             recipient = user_state.get("recipient", "")
         
-        price = PREMIUM_PRICES[period]
-        amount_rub = price["rub"]
-        amount_usd = price["usd"]
-        details = f'{{"period": "{period}", "recipient": "{recipient}"}}'
-        
-        # Создаем заказ
-        order_id = db.add_order(
-            user_id, "premium", recipient, details, 
-            amount_rub, amount_usd, "card"
-        )
-        
-        caption = (
-            f"👑 **Telegram Premium**\n\n"
-            f"Период: {price['name']}\n"
-            f"Получатель: {recipient}\n"
-            f"Сумма: **{amount_rub:.2f} RUB**\n\n"
-        )
+        price = prices.premium[period]
+        return PremiumOrder(period=period, recipient=recipient), recipient, price["rub"], price["usd"]
     
-    elif order_type == "exchange":
-        amount_rub = float(order_data) if order_data else user_state.get("exchange_amount", 0)
-        amount_usd = amount_rub / USD_RATE
-        details = f'{{"amount_rub": {amount_rub}, "amount_usd": {amount_usd}}}'
-        
-        # Создаем заказ
-        order_id = db.add_order(
-            user_id, "exchange", "", details, 
-            amount_rub, amount_usd, "card"
-        )
-        
-        caption = (
-            f"💱 **Обмен валют**\n\n"
-            f"Отдаете: {amount_rub:.2f} RUB\n"
-            f"Получаете: {amount_usd:.2f} USD\n"
-            f"Курс: 1 USD = {USD_RATE} RUB\n\n"
+    amount_rub = float(order_data) if order_data else user_state.get("exchange_amount", 0)
+    amount_usd = amount_rub / prices.usd_rate
+    return ExchangeOrder(amount_rub=amount_rub, amount_usd=amount_usd), "", amount_rub, amount_usd
+
+async def get_or_create_order(app, key, user_id, order_type, order_data, payment_method, create_invoice=None):
+    """Заказ по кнопке оплаты: существующий по ключу или новый. Возвращает (order_id, описание).
+    create_invoice(amount_rub) вызывается до вставки нового заказа: если он упал, заказа нет"""
+    # Повторное нажатие или повторная доставка - показываем тот же заказ, пока его можно оплатить
+    existing = await find_order(app, key)
+    if existing is not None:
+        if existing["status"] not in PAYABLE_STATUSES:
+            raise OrderClosedError(existing["order_id"], existing["status"])
+        order = parse_order_details(existing["order_type"], existing["details"])
+        return existing["order_id"], order_caption(
+            order_type, order, existing["amount_rub"], existing["amount_usd"], app.pricing.current
         )
     
+    user_state = await app.user_states.get(user_id) or {}
+    prices = app.pricing.current
+    order, recipient, amount_rub, amount_usd = build_order(order_type, order_data, user_state, prices)
+    invoice = await create_invoice(amount_rub) if create_invoice is not None else None
+    
+    # Создаем заказ (одновременные повторы сойдутся на одном id через уникальный ключ)
+    details = order_details(order)
+    order_id = await app.db.add_order(
+        user_id, order_type, recipient, details,
+        amount_rub, amount_usd, payment_method, key, prices.version, invoice
+    )
+    await app.recent_orders.set(key, {
+        "order_id": order_id, "order_type": order_type, "details": details,
+        "amount_rub": amount_rub, "amount_usd": amount_usd
+    })
+    
+    # Заказ создан - состояние покупки больше не нужно
+    await app.user_states.delete(user_id)
+    return order_id, order_caption(order_type, order, amount_rub, amount_usd, prices)
+
+async def card_payment_handler(callback: types.CallbackQuery, app: App):
+    data = callback.data.split("_", 3)
+    order_type = data[2]
+    order_data = data[3] if len(data) > 3 else ""
+    
+    user_id = callback.from_user.id
+    key = order_idempotency_key(user_id, order_type, order_data, callback.message.message_id)
+    
+    try:
+        order_id, caption = await get_or_create_order(app, key, user_id, order_type, order_data, "card")
+    except OrderClosedError as e:
+        await callback.answer(closed_order_text(e.status), show_alert=True)
+        return
+    
     # Показываем реквизиты карты
     caption += (
         "💳 **Перевод на карту:**\n"
-        f"`{CARD_NUMBER}`\n\n"
+        f"`{app.settings.get('card_number')}`\n\n"
         "**Инструкция:**\n"
         "1. Переведите точную сумму\n"
         "2. Сделайте скриншот перевода\n"
@@ -619,42 +3401,46 @@ async def card_payment_handler(callback: types.CallbackQuery):
         f"🆔 Заказ: #{order_id}"
     )
     
-    await callback.message.edit_caption(
-        caption=caption,
-        reply_markup=card_payment_kb(order_id),
-        parse_mode="Markdown"
-    )
+    try:
+        await callback.message.edit_caption(
+            caption=caption,
+            reply_markup=card_payment_kb(order_id),
+            parse_mode="Markdown"
+        )
+    except TelegramBadRequest as e:
+        # Повтор: сообщение уже показывает этот заказ
+        if "message is not modified" not in str(e):
+            raise
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("card_paid_"))
-async def card_paid_handler(callback: types.CallbackQuery):
+async def card_paid_handler(callback: types.CallbackQuery, app: App):
     """Пользователь нажал 'Я перевел'"""
     order_id = int(callback.data.split("_")[2])
     
-    # Обновляем статус заказа
-    db.update_order_status(order_id, "waiting")
+    # Обновляем статус заказа (только pending/waiting; истекший мог уже уйти в архив)
+    if not await app.db.update_order_status(order_id, "waiting"):
+        order_info = await app.db.get_order_info(order_id)
+        await callback.answer(closed_order_text(order_info[6] if order_info else "expired"), show_alert=True)
+        await main_menu_handler(callback, app)
+        return
     
     # Уведомляем админа
-    order_info = db.get_order_info(order_id)
+    order_info = await app.db.get_order_info(order_id)
     if order_info:
         user_id, order_type, recipient, details, amount_rub, payment_method, status = order_info
         
-        for admin_id in ADMIN_IDS:
-            try:
-                await bot.send_message(
-                    admin_id,
-                    f"🆕 **Ожидает проверки**\n\n"
-                    f"🆔 Заказ: #{order_id}\n"
-                    f"👤 Пользователь: {callback.from_user.username or 'Нет юзернейма'}\n"
-                    f"🆔 ID: {callback.from_user.id}\n"
-                    f"💰 Сумма: {amount_rub:.2f} RUB\n"
-                    f"📦 Тип: {order_type}\n"
-                    f"👤 Получатель: {recipient}\n\n"
-                    f"Для проверки: /check_{order_id}",
-                    parse_mode="Markdown"
-                )
-            except:
-                pass
+        await app.notifier.send(
+            app.config.admin_ids,
+            f"🆕 **Ожидает проверки**\n\n"
+            f"🆔 Заказ: #{order_id}\n"
+            f"👤 Пользователь: {callback.from_user.username or 'Нет юзернейма'}\n"
+            f"🆔 ID: {callback.from_user.id}\n"
+            f"💰 Сумма: {amount_rub:.2f} RUB\n"
+            f"📦 Тип: {order_type}\n"
+            f"👤 Получатель: {recipient}\n\n"
+            f"Для проверки: /check_{order_id}",
+            parse_mode="Markdown"
+        )
     
     await callback.answer(
         "✅ Заказ передан админу на проверку!\n"
@@ -663,16 +3449,73 @@ async def card_paid_handler(callback: types.CallbackQuery):
     )
     
     # Возвращаем в меню
-    await main_menu_handler(callback)
+    await main_menu_handler(callback, app)
+
+# ========== ОПЛАТА CRYPTOBOT ==========
+async def crypto_payment_handler(callback: types.CallbackQuery, app: App):
+    if app.cryptobot is None:
+        await callback.answer("❌ Оплата через CryptoBot недоступна", show_alert=True)
+        return
+    
+    data = callback.data.split("_", 3)
+    order_type = data[2]
+    order_data = data[3] if len(data) > 3 else ""
+    
+    user_id = callback.from_user.id
+    key = order_idempotency_key(user_id, order_type, order_data, callback.message.message_id, "cryptobot")
+    
+    # Счет создается до заказа: если CryptoBot не ответил, заказа нет и оплата
+    # картой не наткнется на висящий pending-заказ с другим ключом
+    async def new_order_invoice(amount_rub):
+        return await app.cryptobot.create_invoice(amount_rub, "Digi Store", key)
+    
+    try:
+        order_id, caption = await get_or_create_order(
+            app, key, user_id, order_type, order_data, "cryptobot", new_order_invoice
+        )
+        # Счет один на заказ; истекший заменяется новым для того же заказа
+        payment = await app.db.get_crypto_payment(order_id)
+        if payment is not None and payment[1] != "expired":
+            pay_url = payment[2]
+        else:
+            order_info = await app.db.get_order_info(order_id)
+            invoice_id, pay_url = await app.cryptobot.create_invoice(
+                order_info[4], f"Digi Store, заказ #{order_id}", str(order_id)
+            )
+            await app.db.add_crypto_payment(order_id, invoice_id, pay_url)
+    except OrderClosedError as e:
+        await callback.answer(closed_order_text(e.status), show_alert=True)
+        return
+    except CryptoBotError as e:
+        logging.warning("Не удалось создать счет CryptoBot (%s): %s", key, e)
+        await callback.answer("❌ CryptoBot сейчас недоступен, попробуйте позже или оплатите картой", show_alert=True)
+        return
+    
+    caption += (
+        "💎 **Оплата через CryptoBot**\n\n"
+        "Нажмите кнопку ниже и оплатите счет любой криптовалютой.\n"
+        f"Счет действует {app.cryptobot.invoice_ttl // 60} мин, оплата подтвердится автоматически.\n\n"
+        f"🆔 Заказ: #{order_id}"
+    )
+    
+    try:
+        await callback.message.edit_caption(
+            caption=caption,
+            reply_markup=crypto_payment_kb(pay_url),
+            parse_mode="Markdown"
+        )
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+    await callback.answer()
 
 # ========== АДМИН ПАНЕЛЬ ==========
-@dp.message(Command("admin"))
-async def admin_command(message: types.Message):
-    if message.from_user.id not in ADMIN_IDS:
+async def admin_command(message: types.Message, app: App):
+    if message.from_user.id not in app.config.admin_ids:
         await message.answer("❌ Доступ запрещен")
         return
     
-    stats = db.get_statistics()
+    stats = await app.db.get_statistics()
     
     await message.answer(
         f"🛠️ **Админ панель**\n\n"
@@ -687,13 +3530,15 @@ async def admin_command(message: types.Message):
         parse_mode="Markdown"
     )
 
-@dp.callback_query(F.data == "admin_stats")
-async def admin_stats_handler(callback: types.CallbackQuery):
-    if callback.from_user.id not in ADMIN_IDS:
+async def admin_stats_handler(callback: types.CallbackQuery, app: App):
+    if callback.from_user.id not in app.config.admin_ids:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    stats = db.get_statistics()
+    stats = await app.db.get_statistics()
+    states_stats = await app.user_states.stats()
+    throttle_stats = app.throttling.stats()
+    throttled = throttle_stats["throttled"]
     
     await callback.message.edit_text(
         f"📊 **Статистика**\n\n"
@@ -701,36 +3546,157 @@ async def admin_stats_handler(callback: types.CallbackQuery):
         f"✅ Выполнено заказов: {stats['completed_orders']}\n"
         f"💰 Общая выручка: {stats['total_revenue']:.2f} RUB\n\n"
         f"⏳ Ожидают проверки: {stats['pending_orders']}\n"
-        f"💳 Оплачено: {stats['paid_orders']}",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_stats")],
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
-        ]),
+        f"💳 Оплачено: {stats['paid_orders']}\n\n"
+        f"🧠 Активных покупок: {states_stats['live']} "
+        f"(истекло: {states_stats['expired']}, вытеснено: {states_stats['evicted']})\n"
+        f"👤 /start без записи в базу: {app.known_users.hit_ratio():.0%} "
+        f"(новых {app.known_users.new}, сменили имя {app.known_users.changed})\n"
+        f"🚦 Антифлуд: отброшено {throttled['message']} сообщ., {throttled['callback']} кнопок, "
+        f"{throttled['order']} заказов; задержано {throttle_stats['delayed']}\n"
+        f"⌛ Истекших заказов: {app.sweeper.last_moved} за последний проход, {app.sweeper.total_moved} всего\n"
+        f"🗄 В архив: {app.sweeper.last_archived} за последний проход, {app.sweeper.total_archived} всего",
+        reply_markup=admin_stats_kb(),
+        parse_mode="Markdown"
+    )
+    await callback.answer()
+
+def settings_text(settings, pricing_source):
+    text = "⚙️ **Настройки**\n\n"
+    for key, (title, _) in SETTINGS.items():
+        value = dump_setting(settings.get(key))
+        if len(value) > 60:
+            value = value[:57] + "..."
+        text += f"{title}:\n`{value}`\n"
+    if pricing_source != "db":
+        text += f"\n⚠️ Цены берутся из {pricing_source}, правка курсов здесь не действует"
+    return text + "\nВыберите, что изменить:"
+
+async def admin_settings_handler(callback: types.CallbackQuery, app: App):
+    if callback.from_user.id not in app.config.admin_ids:
+        await callback.answer("❌ Доступ запрещен")
+        return
+    
+    # Выход из редактирования без ввода значения
+    await app.user_states.delete(callback.from_user.id)
+    
+    await callback.message.edit_text(
+        settings_text(app.settings, app.config.pricing_source),
+        reply_markup=admin_settings_kb(),
+        parse_mode="Markdown"
+    )
+    await callback.answer()
+
+async def admin_setting_handler(callback: types.CallbackQuery, app: App):
+    if callback.from_user.id not in app.config.admin_ids:
+        await callback.answer("❌ Доступ запрещен")
+        return
+    
+    key = callback.data[len("admin_setting_"):]
+    if key not in SETTINGS:
+        await callback.answer("❌ Неизвестная настройка")
+        return
+    
+    await app.user_states.set(callback.from_user.id, {"action": "admin_setting", "key": key})
+    
+    await callback.message.edit_text(
+        f"✏️ **{SETTINGS[key][0]}**\n\n"
+        f"Сейчас:\n`{dump_setting(app.settings.get(key))}`\n\n"
+        "Отправьте новое значение сообщением:",
+        reply_markup=back_kb("admin_settings"),
+        parse_mode="Markdown"
+    )
+    await callback.answer()
+
+# Воронка заказа: в каком порядке проходят статусы
+FUNNEL_STATUSES = [
+    ("pending", "🆕 Создано"),
+    ("waiting", "⏳ Ждут проверки"),
+    ("paid", "💳 Оплачено"),
+    ("completed", "✅ Выполнено"),
+]
+
+def format_report(period, rows):
+    """Текст отчета из строк get_report"""
+    by_status = {}
+    by_type = {}
+    for order_type, status, orders, amount_rub, amount_usd in rows:
+        by_status[status] = by_status.get(status, 0) + orders
+        if status == "completed":
+            total = by_type.setdefault(order_type, [0, 0.0, 0.0])
+            total[0] += orders
+            total[1] += amount_rub
+            total[2] += amount_usd
+    
+    text = f"📑 **Отчет за {REPORT_PERIODS[period][2]}**\n\n"
+    
+    created = by_status.get("pending", 0)
+    text += "**Воронка:**\n"
+    for status, label in FUNNEL_STATUSES:
+        count = by_status.get(status, 0)
+        share = f" ({count / created * 100:.1f}%)" if created and status != "pending" else ""
+        text += f"{label}: {count}{share}\n"
+    text += f"❌ Отменено: {by_status.get('cancelled', 0)}\n"
+    text += f"⌛ Истекло: {by_status.get('expired', 0)}\n\n"
+    
+    text += "**Выполнено по типам:**\n"
+    if not by_type:
+        text += "📭 Нет выполненных заказов\n"
+    names = {"stars": "⭐️ Звезды", "premium": "👑 Premium", "exchange": "💱 Обмен"}
+    for order_type, (orders, amount_rub, amount_usd) in sorted(by_type.items()):
+        text += f"{names.get(order_type, order_type)}: {orders} зак., {amount_rub:.2f} RUB"
+        if order_type == "exchange":
+            text += f" → {amount_usd:.2f} USD"
+        text += "\n"
+    total_rub = sum(total[1] for total in by_type.values())
+    text += f"\n💰 Выручка: {total_rub:.2f} RUB"
+    return text
+
+async def admin_report_handler(callback: types.CallbackQuery, app: App):
+    """Выполненные заказы: отчет за 24 часа / 7 дней / 30 дней"""
+    if callback.from_user.id not in app.config.admin_ids:
+        await callback.answer("❌ Доступ запрещен")
+        return
+    
+    period = callback.data[len("admin_report_"):] if callback.data.startswith("admin_report_") else "24h"
+    if period not in REPORT_PERIODS:
+        await callback.answer("❌ Неизвестный период")
+        return
+    
+    rows = await app.db.get_report(period)
+    
+    await callback.message.edit_text(
+        format_report(period, rows),
+        reply_markup=report_kb(period),
         parse_mode="Markdown"
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "admin_pending")
-async def admin_pending_handler(callback: types.CallbackQuery):
+def parse_page_callback(data, section):
+    """admin_pending / admin_pending_next_15 / admin_pending_prev_15 -> (cursor, backward)"""
+    parts = data[len(section):].split("_")
+    if len(parts) == 3 and parts[2].isdigit():
+        return int(parts[2]), parts[1] == "prev"
+    return None, False
+
+async def admin_pending_handler(callback: types.CallbackQuery, app: App):
     """Заказы ожидающие проверки"""
-    if callback.from_user.id not in ADMIN_IDS:
+    if callback.from_user.id not in app.config.admin_ids:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    orders = db.get_pending_orders()
+    cursor, backward = parse_page_callback(callback.data, "admin_pending")
+    orders, prev_cursor, next_cursor = await app.db.get_pending_orders(cursor, backward)
     
     if not orders:
         await callback.message.edit_text(
             "✅ Нет заказов ожидающих проверки",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
-            ])
+            reply_markup=back_kb("admin_back")
         )
         return
     
     text = "⏳ **Ожидают проверки:**\n\n"
     
-    for order in orders[:10]:  # Показываем первые 10
+    for order in orders:
         order_id, user_id, order_type, recipient, details, amount_rub, payment_method, order_date = order
         
         emoji = "⭐️" if order_type == "stars" else "👑" if order_type == "premium" else "💱"
@@ -752,35 +3718,30 @@ async def admin_pending_handler(callback: types.CallbackQuery):
     
     await callback.message.edit_text(
         text,
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_pending")],
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
-        ]),
+        reply_markup=orders_page_kb("admin_pending", prev_cursor, next_cursor),
         parse_mode="Markdown"
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "admin_paid")
-async def admin_paid_handler(callback: types.CallbackQuery):
+async def admin_paid_handler(callback: types.CallbackQuery, app: App):
     """Оплаченные заказы"""
-    if callback.from_user.id not in ADMIN_IDS:
+    if callback.from_user.id not in app.config.admin_ids:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    orders = db.get_active_orders()
+    cursor, backward = parse_page_callback(callback.data, "admin_paid")
+    orders, prev_cursor, next_cursor = await app.db.get_active_orders(cursor, backward)
     
     if not orders:
         await callback.message.edit_text(
             "✅ Нет оплаченных заказов",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
-            ])
+            reply_markup=back_kb("admin_back")
         )
         return
     
     text = "💳 **Оплаченные заказы:**\n\n"
     
-    for order in orders[:10]:
+    for order in orders:
         order_id, user_id, order_type, recipient, details, amount_rub, payment_method, order_date = order
         
         emoji = "⭐️" if order_type == "stars" else "👑" if order_type == "premium" else "💱"
@@ -795,22 +3756,18 @@ async def admin_paid_handler(callback: types.CallbackQuery):
     
     await callback.message.edit_text(
         text,
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_paid")],
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
-        ]),
+        reply_markup=orders_page_kb("admin_paid", prev_cursor, next_cursor),
         parse_mode="Markdown"
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "admin_back")
-async def admin_back_handler(callback: types.CallbackQuery):
+async def admin_back_handler(callback: types.CallbackQuery, app: App):
     """Назад в админ меню"""
-    if callback.from_user.id not in ADMIN_IDS:
+    if callback.from_user.id not in app.config.admin_ids:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    stats = db.get_statistics()
+    stats = await app.db.get_statistics()
     
     await callback.message.edit_text(
         f"🛠️ **Админ панель**\n\n"
@@ -827,16 +3784,113 @@ async def admin_back_handler(callback: types.CallbackQuery):
     await callback.answer()
 
 # ========== КОМАНДЫ АДМИНА ==========
-@dp.message(F.text.startswith("/check_"))
-async def check_order_command(message: types.Message):
+async def sales_command(message: types.Message, app: App):
+    """Продажи по дням: /sales или /sales 30"""
+    if message.from_user.id not in app.config.admin_ids:
+        await message.answer("❌ Доступ запрещен")
+        return
+    
+    parts = message.text.split()
+    days = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 7
+    rows = await app.db.get_sales_by_day(days)
+    
+    if not rows:
+        await message.answer(f"📭 Нет выполненных заказов за {days} дн.")
+        return
+    
+    text = f"📈 **Продажи за {days} дн.**\n"
+    current_day = None
+    for day, order_type, orders, stars, amount_rub, amount_usd in rows:
+        if day != current_day:
+            text += f"\n📅 {day}\n"
+            current_day = day
+        if order_type == "stars":
+            text += f"⭐️ {orders} зак., {int(stars)} звезд, {amount_rub:.2f} RUB\n"
+        elif order_type == "premium":
+            text += f"👑 {orders} зак., {amount_rub:.2f} RUB\n"
+        else:
+            text += f"💱 {orders} зак., {amount_rub:.2f} RUB → {amount_usd:.2f} USD\n"
+    
+    await message.answer(text, parse_mode="Markdown")
+
+async def report_command(message: types.Message, app: App):
+    """Отчет: /report, /report 7d или /report 30d"""
+    if message.from_user.id not in app.config.admin_ids:
+        await message.answer("❌ Доступ запрещен")
+        return
+    
+    parts = message.text.split()
+    period = parts[1] if len(parts) > 1 else "24h"
+    if period not in REPORT_PERIODS:
+        await message.answer(f"❌ Период: {', '.join(REPORT_PERIODS)}")
+        return
+    
+    rows = await app.db.get_report(period)
+    await message.answer(format_report(period, rows), reply_markup=report_kb(period), parse_mode="Markdown")
+
+async def export_command(message: types.Message, app: App):
+    """Выгрузка заказов: /export [с] [по] [статус] [тип] [csv|parquet]"""
+    if message.from_user.id not in app.config.admin_ids:
+        await message.answer("❌ Доступ запрещен")
+        return
+    
+    try:
+        fmt, filters = parse_export_args(message.text.split()[1:])
+    except ValueError:
+        await message.answer(
+            "❌ Формат: /export [2024-01-01] [2024-01-31] [статус] [тип] [csv|parquet]\n"
+            f"Статусы: {', '.join(ORDER_STATUSES)}\nТипы: {', '.join(ORDER_MODELS)}"
+        )
+        return
+    
+    if fmt == "parquet" and load_pyarrow() is None:
+        await message.answer("❌ Для выгрузки в Parquet установите pyarrow")
+        return
+    
+    await message.answer("⏳ Готовлю выгрузку...")
+    
+    path = Path(tempfile.mkdtemp()) / f"orders_{datetime.now():%Y%m%d_%H%M%S}.{fmt}"
+    try:
+        count = await app.db.export_orders(path, fmt, **filters)
+        if path.stat().st_size > EXPORT_MAX_DOCUMENT:
+            await message.answer(
+                f"❌ Файл больше {EXPORT_MAX_DOCUMENT // 1024 // 1024} МБ ({count} заказов). "
+                "Сузьте период или выгрузите через `python digi.py export`",
+                parse_mode="Markdown"
+            )
+            return
+        await message.answer_document(FSInputFile(path), caption=f"📦 Заказов: {count}")
+    finally:
+        path.unlink(missing_ok=True)
+        path.parent.rmdir()
+
+async def stats_check_command(message: types.Message, app: App):
+    """Сверить счетчики статистики с таблицами"""
+    if message.from_user.id not in app.config.admin_ids:
+        await message.answer("❌ Доступ запрещен")
+        return
+    
+    drift = await app.db.check_statistics()
+    
+    if not drift:
+        await message.answer("✅ Статистика сходится")
+        return
+    
+    text = "⚠️ **Расхождения исправлены:**\n\n"
+    for name, (stored, actual) in drift.items():
+        text += f"• `{name}`: {stored} → {actual}\n"
+    
+    await message.answer(text, parse_mode="Markdown")
+
+async def check_order_command(message: types.Message, app: App):
     """Проверить заказ"""
-    if message.from_user.id not in ADMIN_IDS:
+    if message.from_user.id not in app.config.admin_ids:
         await message.answer("❌ Доступ запрещен")
         return
     
     try:
         order_id = int(message.text.split("_")[1])
-        order_info = db.get_order_info(order_id)
+        order_info = await app.db.get_order_info(order_id)
         
         if not order_info:
             await message.answer(f"❌ Заказ #{order_id} не найден")
@@ -862,10 +3916,9 @@ async def check_order_command(message: types.Message):
     except (ValueError, IndexError):
         await message.answer("❌ Формат: /check_123")
 
-@dp.message(F.text.startswith("/confirm_"))
-async def confirm_order_command(message: types.Message):
+async def confirm_order_command(message: types.Message, app: App):
     """Подтвердить оплату заказа"""
-    if message.from_user.id not in ADMIN_IDS:
+    if message.from_user.id not in app.config.admin_ids:
         await message.answer("❌ Доступ запрещен")
         return
     
@@ -873,23 +3926,20 @@ async def confirm_order_command(message: types.Message):
         order_id = int(message.text.split("_")[1])
         
         # Обновляем статус на "paid"
-        success = db.update_order_status(order_id, "paid")
+        success = await app.db.update_order_status(order_id, "paid")
         
         if success:
             # Уведомляем пользователя
-            order_info = db.get_order_info(order_id)
+            order_info = await app.db.get_order_info(order_id)
             if order_info:
                 user_id = order_info[0]
                 
-                try:
-                    await bot.send_message(
-                        user_id,
-                        f"✅ **Заказ #{order_id} оплачен!**\n\n"
-                        "Админ подтвердил получение оплаты.\n"
-                        "Ваш товар будет доставлен в течение 15 минут."
-                    )
-                except:
-                    pass
+                await app.notifier.send(
+                    user_id,
+                    f"✅ **Заказ #{order_id} оплачен!**\n\n"
+                    "Админ подтвердил получение оплаты.\n"
+                    "Ваш товар будет доставлен в течение 15 минут."
+                )
             
             await message.answer(f"✅ Заказ #{order_id} подтвержден")
         else:
@@ -898,10 +3948,9 @@ async def confirm_order_command(message: types.Message):
     except (ValueError, IndexError):
         await message.answer("❌ Формат: /confirm_123")
 
-@dp.message(F.text.startswith("/complete_"))
-async def complete_order_command(message: types.Message):
+async def complete_order_command(message: types.Message, app: App):
     """Завершить заказ"""
-    if message.from_user.id not in ADMIN_IDS:
+    if message.from_user.id not in app.config.admin_ids:
         await message.answer("❌ Доступ запрещен")
         return
     
@@ -909,23 +3958,20 @@ async def complete_order_command(message: types.Message):
         order_id = int(message.text.split("_")[1])
         
         # Обновляем статус на "completed"
-        success = db.update_order_status(order_id, "completed")
+        success = await app.db.update_order_status(order_id, "completed")
         
         if success:
             # Уведомляем пользователя
-            order_info = db.get_order_info(order_id)
+            order_info = await app.db.get_order_info(order_id)
             if order_info:
                 user_id = order_info[0]
                 
-                try:
-                    await bot.send_message(
-                        user_id,
-                        f"🎉 **Заказ #{order_id} выполнен!**\n\n"
-                        "Товар успешно доставлен.\n"
-                        "Спасибо за покупку! 🛍️"
-                    )
-                except:
-                    pass
+                await app.notifier.send(
+                    user_id,
+                    f"🎉 **Заказ #{order_id} выполнен!**\n\n"
+                    "Товар успешно доставлен.\n"
+                    "Спасибо за покупку! 🛍️"
+                )
             
             await message.answer(f"✅ Заказ #{order_id} выполнен")
         else:
@@ -934,10 +3980,9 @@ async def complete_order_command(message: types.Message):
     except (ValueError, IndexError):
         await message.answer("❌ Формат: /complete_123")
 
-@dp.message(F.text.startswith("/cancel_"))
-async def cancel_order_command(message: types.Message):
+async def cancel_order_command(message: types.Message, app: App):
     """Отменить заказ"""
-    if message.from_user.id not in ADMIN_IDS:
+    if message.from_user.id not in app.config.admin_ids:
         await message.answer("❌ Доступ запрещен")
         return
     
@@ -945,23 +3990,20 @@ async def cancel_order_command(message: types.Message):
         order_id = int(message.text.split("_")[1])
         
         # Обновляем статус на "cancelled"
-        success = db.update_order_status(order_id, "cancelled")
+        success = await app.db.update_order_status(order_id, "cancelled")
         
         if success:
             # Уведомляем пользователя
-            order_info = db.get_order_info(order_id)
+            order_info = await app.db.get_order_info(order_id)
             if order_info:
                 user_id = order_info[0]
                 
-                try:
-                    await bot.send_message(
-                        user_id,
-                        f"❌ **Заказ #{order_id} отменен**\n\n"
-                        "Админ отменил ваш заказ.\n"
-                        "Если вы уже оплатили, свяжитесь с поддержкой."
-                    )
-                except:
-                    pass
+                await app.notifier.send(
+                    user_id,
+                    f"❌ **Заказ #{order_id} отменен**\n\n"
+                    "Админ отменил ваш заказ.\n"
+                    "Если вы уже оплатили, свяжитесь с поддержкой."
+                )
             
             await message.answer(f"✅ Заказ #{order_id} отменен")
         else:
@@ -970,13 +4012,270 @@ async def cancel_order_command(message: types.Message):
     except (ValueError, IndexError):
         await message.answer("❌ Формат: /cancel_123")
 
+# ========== РОУТЕР ==========
+def create_router():
+    """Router со всеми хендлерами - свой для каждого приложения (Router подключается
+    только к одному диспетчеру). Порядок важен: срабатывает первый подходящий хендлер"""
+    router = Router()
+    
+    router.message.register(cmd_start, CommandStart())
+    router.message.register(handle_messages, F.text, ~F.text.startswith("/"))
+    router.message.register(admin_command, Command("admin"))
+    router.message.register(sales_command, Command("sales"))
+    router.message.register(report_command, Command("report"))
+    router.message.register(export_command, Command("export"))
+    router.message.register(stats_check_command, Command("stats_check"))
+    router.message.register(check_order_command, F.text.startswith("/check_"))
+    router.message.register(confirm_order_command, F.text.startswith("/confirm_"))
+    router.message.register(complete_order_command, F.text.startswith("/complete_"))
+    router.message.register(cancel_order_command, F.text.startswith("/cancel_"))
+    
+    router.callback_query.register(main_menu_handler, F.data == "main_menu")
+    router.callback_query.register(buy_stars_handler, F.data == "buy_stars")
+    router.callback_query.register(enter_stars_recipient_handler, F.data == "enter_stars_recipient")
+    router.callback_query.register(buy_premium_handler, F.data == "buy_premium")
+    router.callback_query.register(select_premium_period_handler, F.data.startswith("premium_"))
+    router.callback_query.register(enter_premium_recipient_handler, F.data == "enter_premium_recipient")
+    router.callback_query.register(exchange_handler, F.data == "exchange")
+    router.callback_query.register(info_handler, F.data == "info")
+    router.callback_query.register(card_payment_handler, F.data.startswith("pay_card_"), flags={"throttle": "order"})
+    router.callback_query.register(card_paid_handler, F.data.startswith("card_paid_"))
+    router.callback_query.register(crypto_payment_handler, F.data.startswith("pay_crypto_"), flags={"throttle": "order"})
+    router.callback_query.register(admin_stats_handler, F.data == "admin_stats")
+    router.callback_query.register(admin_settings_handler, F.data == "admin_settings")
+    router.callback_query.register(admin_setting_handler, F.data.startswith("admin_setting_"))
+    router.callback_query.register(admin_report_handler, F.data == "admin_completed")
+    router.callback_query.register(admin_report_handler, F.data.startswith("admin_report_"))
+    router.callback_query.register(admin_pending_handler, F.data.startswith("admin_pending"))
+    router.callback_query.register(admin_paid_handler, F.data.startswith("admin_paid"))
+    router.callback_query.register(admin_back_handler, F.data == "admin_back")
+    return router
+
 # ========== ЗАПУСК БОТА ==========
-async def main():
+async def set_webhook(bot: Bot, config):
+    await bot.set_webhook(
+        f"{config.webhook_url}{config.webhook_path}",
+        secret_token=config.webhook_secret,
+        max_connections=config.webhook_max_connections
+    )
+
+def create_webhook_app(app):
+    """aiohttp-приложение, принимающее обновления на webhook_path"""
+    config = app.config
+    webapp = web.Application()
+    # Обновление обрабатывается до ответа Telegram: при ошибке он пришлет его повторно,
+    # а при остановке сервер дожидается всех обновлений в работе
+    SimpleRequestHandler(
+        dispatcher=app.dp, bot=app.bot,
+        handle_in_background=False,
+        secret_token=config.webhook_secret
+    ).register(webapp, path=config.webhook_path)
+    if app.cryptobot is not None:
+        webapp.router.add_post(CRYPTOBOT_WEBHOOK_PATH, app.cryptobot.handle_webhook)
+    setup_application(webapp, app.dp, bot=app.bot)
+    return webapp
+
+async def run_webhook(app):
+    config = app.config
+    if config.webhook_url and config.worker_id == 0:
+        await set_webhook(app.bot, config)
+    
+    runner = web.AppRunner(create_webhook_app(app))
+    await runner.setup()
+    # reuse_port: все воркеры слушают один порт, ядро раздает им соединения
+    await web.TCPSite(runner, config.webapp_host, config.webapp_port, reuse_port=config.workers > 1).start()
+    print(f"🌐 Webhook: {config.webapp_host}:{config.webapp_port}{config.webhook_path} (воркер {config.worker_id})")
+    
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+
+async def main(config=None):
+    try:
+        app = create_app(config)
+    except ValueError as e:
+        raise SystemExit(f"❌ {e}")
+    config = app.config
     print("🚀 Digi Store Bot запущен!")
-    print(f"💳 Карта для оплаты: {CARD_NUMBER}")
-    print(f"👑 Админы: {ADMIN_IDS}")
+    try:
+        await app.start()
+        print(f"💳 Карта для оплаты: {app.settings.get('card_number')}")
+        print(f"👑 Админы: {config.admin_ids}")
+        if app.metrics_runner is not None:
+            port = config.metrics_port + config.worker_id
+            print(f"📈 Метрики: http://{config.metrics_host}:{port}/metrics")
+        
+        startup = time.perf_counter() - IMPORT_STARTED
+        print(f"⏱ Запуск: {startup:.2f} с (импорт {IMPORT_SECONDS:.2f} с)")
+        if startup > STARTUP_BUDGET:
+            logging.warning("Запуск занял %.2f с при бюджете %.2f с", startup, STARTUP_BUDGET)
+        
+        if config.run_mode == "webhook":
+            await run_webhook(app)
+        else:
+            await app.dp.start_polling(app.bot)
+    finally:
+        await app.stop()
+
+def setup_logging():
+    logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if LOG_LEVEL != "DEBUG":
+        # Строка на каждый апдейт - это работа для метрик, а не для лога
+        logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+
+def _worker_main():
+    setup_logging()
+    asyncio.run(main())
+
+def run_workers(count):
+    """Супервизор: запускает count воркеров и перезапускает упавшие"""
+    if RUN_MODE != "webhook":
+        raise SystemExit("WORKERS > 1 работает только с RUN_MODE=webhook")
+    if STATE_STORAGE != "sqlite":
+        # Обновления одного пользователя попадают в разные процессы - состояния должны быть общими
+        print("⚠️ STATE_STORAGE=sqlite: состояния хранятся в общей базе")
+        os.environ["STATE_STORAGE"] = "sqlite"
+    
+    context = multiprocessing.get_context("spawn")
+    workers = {}
+    stopping = False
+    
+    def start(worker_id):
+        os.environ["WORKER_ID"] = str(worker_id)
+        process = context.Process(target=_worker_main, name=f"digi-worker-{worker_id}")
+        process.start()
+        workers[worker_id] = process
+    
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process in workers.values():
+            if process.is_alive():
+                process.terminate()
+    
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    
+    for worker_id in range(count):
+        start(worker_id)
+    print(f"👷 Запущено воркеров: {count}")
+    
+    while not stopping:
+        for worker_id, process in list(workers.items()):
+            if not process.is_alive() and not stopping:
+                print(f"⚠️ Воркер {worker_id} завершился (код {process.exitcode}), перезапуск")
+                start(worker_id)
+        time.sleep(1)
     
-    await dp.start_polling(bot)
+    for process in workers.values():
+        process.join()
+
+def seed(count, days=30, db_path=DB_PATH):
+    """Заполнить базу синтетическими заказами и замерить отчеты"""
+    database = Database(db_path, wal=DB_WAL, pragmas=DB_PRAGMAS, archive_db=ARCHIVE_DB)
+    started = time.perf_counter()
+    database.seed_orders(count, days, progress=lambda done: print(f"🌱 {done}/{count}", end="\r"))
+    print(f"🌱 Добавлено заказов: {count} за {time.perf_counter() - started:.1f} с")
+    
+    for period in REPORT_PERIODS:
+        started = time.perf_counter()
+        rows = database.get_report(period)
+        print(f"📑 Отчет {period}: {len(rows)} строк за {(time.perf_counter() - started) * 1000:.2f} мс")
+    database.close()
+
+def check_import(budget=IMPORT_BUDGET):
+    """Импорт модуля в чистом процессе без токена: время сверх aiogram/aiohttp и отсутствие побочных эффектов"""
+    script = (
+        "import sys, time\n"
+        "started = time.perf_counter()\n"
+        "import aiogram, aiogram.types, aiohttp\n"
+        "deps = time.perf_counter() - started\n"
+        "import digi\n"
+        "print(deps, time.perf_counter() - started - deps)\n"
+    )
+    env = {k: v for k, v in os.environ.items() if k != "BOT_TOKEN"}
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [str(Path(__file__).resolve().parent), env.get("PYTHONPATH")]))
+    with tempfile.TemporaryDirectory() as workdir:
+        result = subprocess.run([sys.executable, "-c", script], cwd=workdir, env=env,
+                                capture_output=True, text=True)
+        created = os.listdir(workdir)
+    if result.returncode != 0:
+        print(result.stderr)
+        raise SystemExit("❌ Модуль не импортируется без BOT_TOKEN")
+    deps, own = map(float, result.stdout.split())
+    print(f"⏱ Импорт: aiogram/aiohttp {deps:.3f} с, digi {own:.3f} с (бюджет {budget:.3f} с)")
+    if created:
+        raise SystemExit(f"❌ Импорт создал файлы: {', '.join(created)}")
+    if own > budget:
+        raise SystemExit("❌ Импорт не укладывается в бюджет")
+
+def cli(argv=None):
+    setup_logging()
+    parser = argparse.ArgumentParser(description="Digi Store Bot")
+    commands = parser.add_subparsers(dest="command")
+    seed_parser = commands.add_parser("seed", help="заполнить базу синтетическими заказами")
+    seed_parser.add_argument("count", type=int, nargs="?", default=1_000_000)
+    seed_parser.add_argument("--days", type=int, default=30)
+    seed_parser.add_argument("--db", default=DB_PATH, help="файл базы (по умолчанию DB_PATH)")
+    export_parser = commands.add_parser("export", help="выгрузить заказы в CSV или Parquet")
+    export_parser.add_argument("path", help="файл выгрузки (.csv, .csv.gz или .parquet)")
+    export_parser.add_argument("--from", dest="date_from", help="с даты YYYY-MM-DD")
+    export_parser.add_argument("--to", dest="date_to", help="по дату YYYY-MM-DD включительно")
+    export_parser.add_argument("--status", choices=ORDER_STATUSES)
+    export_parser.add_argument("--type", dest="order_type", choices=list(ORDER_MODELS))
+    export_parser.add_argument("--format", choices=EXPORT_FORMATS)
+    export_parser.add_argument("--db", default=DB_PATH, help="файл базы (по умолчанию DB_PATH)")
+    migrate_parser = commands.add_parser("migrate", help="применить миграции схемы")
+    migrate_parser.add_argument("--dry-run", action="store_true", help="только показать, что будет сделано")
+    migrate_parser.add_argument("--batch-size", type=int, default=MIGRATION_BATCH_SIZE)
+    migrate_parser.add_argument("--db", default=DB_PATH, help="файл базы (по умолчанию DB_PATH)")
+    check_parser = commands.add_parser("check-import", help="проверить время и побочные эффекты импорта")
+    check_parser.add_argument("--budget", type=float, default=IMPORT_BUDGET, help="секунд на импорт digi")
+    args = parser.parse_args(argv)
+    
+    if args.command == "seed":
+        seed(args.count, args.days, args.db)
+    elif args.command == "export":
+        fmt = args.format or ("parquet" if args.path.endswith(".parquet") else "csv")
+        filters = {"date_from": args.date_from, "date_to": args.date_to,
+                   "status": args.status, "order_type": args.order_type}
+        if fmt == "parquet" and load_pyarrow() is None:
+            raise SystemExit("❌ Для выгрузки в Parquet установите pyarrow")
+        database = Database(args.db, readonly=True, archive_db=ARCHIVE_DB)
+        started = time.perf_counter()
+        count = export_orders(database, args.path, fmt, filters)
+        database.close()
+        print(f"📦 Выгружено заказов: {count} в {args.path} за {time.perf_counter() - started:.1f} с")
+    elif args.command == "migrate":
+        database = Database(args.db, wal=DB_WAL, pragmas=DB_PRAGMAS, archive_db=ARCHIVE_DB)
+        migrator = Migrator(database, batch_size=args.batch_size)
+        print(f"📐 Версия схемы: {migrator.current_version()}, последняя: {MIGRATIONS[-1].version}")
+        try:
+            applied = migrator.run(dry_run=args.dry_run)
+        except KeyboardInterrupt:
+            # Прерванная пачка откатилась, готовые сохранены - можно запустить заново
+            raise SystemExit("⏸ Миграция прервана")
+        finally:
+            database.close()
+        if not applied:
+            print("✅ Схема актуальна")
+    elif args.command == "check-import":
+        check_import(args.budget)
+    elif WORKERS > 1:
+        run_workers(WORKERS)
+    else:
+        asyncio.run(main())
+
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    cli()
\ No newline at end of file
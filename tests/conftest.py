@@ -0,0 +1,132 @@
+import asyncio
+import contextlib
+import itertools
+import os
+import sqlite3
+import sys
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from aiogram import methods
+from aiogram.client.session.base import BaseSession
+from aiogram.types import CallbackQuery, Chat, Message, Update, User
+
+import digi
+
+ADMIN_ID = 1
+
+
+def pytest_addoption(parser):
+    parser.addoption("--runslow", action="store_true", help="запустить долгие тесты (миллионы строк и пользователей)")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "slow: долгий тест, запускается с --runslow или DIGI_SLOW_TESTS=1")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--runslow") or os.getenv("DIGI_SLOW_TESTS") == "1":
+        return
+    skip = pytest.mark.skip(reason="долгий тест: --runslow или DIGI_SLOW_TESTS=1")
+    for item in items:
+        if "slow" in item.keywords:
+            item.add_marker(skip)
+
+
+# ========== ПОДСТАВНОЙ BOT API ==========
+_ids = itertools.count(1)
+MESSAGE_METHODS = (
+    methods.SendMessage, methods.SendPhoto, methods.SendDocument,
+    methods.EditMessageCaption, methods.EditMessageText,
+)
+
+
+class FakeSession(BaseSession):
+    """Bot API без сети: запоминает вызовы, на отправку и правку отвечает сообщением.
+    delay - задержка ответа, как у настоящего Telegram"""
+
+    def __init__(self, delay=0.0):
+        super().__init__()
+        self.delay = delay
+        self.calls = []
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls.append(method)
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if isinstance(method, MESSAGE_METHODS):
+            return Message(
+                message_id=next(_ids), date=datetime.now(),
+                chat=Chat(id=int(getattr(method, "chat_id", None) or 0), type="private")
+            )
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def close(self):
+        pass
+
+    def answers(self):
+        """Тексты всплывающих ответов на кнопки"""
+        return [call.text for call in self.calls if isinstance(call, methods.AnswerCallbackQuery) and call.text]
+
+
+def user(user_id):
+    return User(id=user_id, is_bot=False, first_name=f"User {user_id}", username=f"user{user_id}")
+
+
+def message_update(user_id, text):
+    return Update(update_id=next(_ids), message=Message(
+        message_id=next(_ids), date=datetime.now(),
+        chat=Chat(id=user_id, type="private"), from_user=user(user_id), text=text
+    ))
+
+
+def callback_update(user_id, data, message_id=1):
+    """Нажатие кнопки под сообщением message_id (от него зависит ключ идемпотентности заказа)"""
+    message = Message(
+        message_id=message_id, date=datetime.now(),
+        chat=Chat(id=user_id, type="private"), from_user=user(user_id), caption="..."
+    )
+    return Update(update_id=next(_ids), callback_query=CallbackQuery(
+        id=str(next(_ids)), from_user=user(user_id), chat_instance="test", message=message, data=data
+    ))
+
+
+# ========== ПРИЛОЖЕНИЕ ==========
+def make_app(path, **overrides):
+    """create_app() на отдельной базе с подставным Bot API; overrides - поля AppConfig"""
+    config = digi.AppConfig(
+        bot_token="42:TEST", telegram_api_url="", db_path=str(path), archive_db=None,
+        state_storage="memory", admin_ids=[ADMIN_ID], cryptobot_token="",
+        run_mode="polling", workers=1, worker_id=0, metrics_port=0, migrate_on_start=False
+    )
+    for key, value in overrides.items():
+        setattr(config, key, value)
+    app = digi.create_app(config)
+    app.bot.session = FakeSession()
+    return app
+
+
+@contextlib.asynccontextmanager
+async def running(app):
+    await app.start()
+    try:
+        yield app
+    finally:
+        await app.stop()
+
+
+def query(path, sql, params=()):
+    """Чтение базы приложения отдельным соединением (как делает админ или отчет)"""
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
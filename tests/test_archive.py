@@ -0,0 +1,74 @@
+"""Архив в отдельном файле: копия коммитится раньше удаления, заказ не теряется и не задваивается"""
+import asyncio
+import sqlite3
+
+import digi
+from conftest import query
+
+DETAILS = digi.order_details(digi.StarsOrder(stars=100, recipient="alice"))
+
+
+def age_orders(path, days):
+    with sqlite3.connect(path) as connection:
+        connection.execute("UPDATE orders SET order_date = datetime('now', ?)", (f"-{days} days",))
+
+
+def rows(path, table):
+    return query(path, f"SELECT id, payment_status FROM {table} ORDER BY id")
+
+
+def test_sweeper_moves_orders_into_archive_file(tmp_path):
+    main, archive = tmp_path / "digi.db", tmp_path / "archive.db"
+
+    async def scenario():
+        database = digi.AsyncDatabase(str(main), archive_db=str(archive))
+        try:
+            for status in ("completed", "cancelled", "paid"):
+                order_id = await database.add_order(7, "stars", "alice", DETAILS, 150.0, 1.78, "card")
+                await database.update_order_status(order_id, status)
+            age_orders(main, 60)
+            sweeper = digi.OrderSweeper(database, archive_after_days=30)
+            assert await sweeper.archive_old() == 2
+            assert (await database.get_order_info(1))[6] == "completed"
+        finally:
+            database.close()
+
+    asyncio.run(scenario())
+    assert rows(main, "orders") == [(3, "paid")]
+    assert rows(archive, "orders_archive") == [(1, "completed"), (2, "cancelled")]
+
+
+def test_crash_between_phases_keeps_order_and_next_pass_cleans_up(tmp_path):
+    main, archive = tmp_path / "digi.db", tmp_path / "archive.db"
+    database = digi.Database(str(main), wal=True, archive_db=str(archive))
+    order_id = database.add_order(7, "stars", "alice", DETAILS, 150.0, 1.78, "card")
+    database.update_order_status(order_id, "completed")
+    age_orders(main, 60)
+
+    # Первая фаза закоммичена, вторая не выполнилась: заказ в обеих таблицах
+    assert database.archive_orders(30, 100) == [order_id]
+    database.close()
+    assert rows(main, "orders") == rows(archive, "orders_archive") == [(order_id, "completed")]
+
+    database = digi.Database(str(main), wal=True, archive_db=str(archive))
+    ids = database.archive_orders(30, 100)
+    assert database.drop_archived(ids) == 1
+    database.close()
+    assert rows(main, "orders") == []
+    assert rows(archive, "orders_archive") == [(order_id, "completed")]
+
+
+def test_order_paid_between_phases_stays_in_orders(tmp_path):
+    main, archive = tmp_path / "digi.db", tmp_path / "archive.db"
+    database = digi.Database(str(main), wal=True, archive_db=str(archive))
+    order_id = database.add_order(7, "stars", "alice", DETAILS, 150.0, 1.78, "card")
+    age_orders(main, 2)
+
+    ids = database.expire_pending_orders(1, 100, archive=True)
+    # Пока копия ждала второй фазы, счет истекшего заказа оплатили
+    database.update_order_status(order_id, "paid")
+    assert database.drop_archived(ids) == 0
+    database.close()
+
+    assert rows(main, "orders") == [(order_id, "paid")]
+    assert rows(archive, "orders_archive") == []
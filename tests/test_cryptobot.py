@@ -0,0 +1,154 @@
+"""CryptoBot: счет до заказа, сверка getInvoices и вебхук - против подставного Crypto Pay API"""
+import asyncio
+import hashlib
+import hmac
+import json
+
+from aiohttp import ClientSession, web
+
+import digi
+from conftest import callback_update, make_app, query, running
+
+TOKEN = "12345:TEST"
+
+
+class FakeCryptoPay:
+    """Crypto Pay API на локальном порту: createInvoice и getInvoices"""
+
+    def __init__(self):
+        self.fail = False
+        self.invoices = {}
+        self.calls = []
+        self.runner = None
+        self.url = None
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        params = await request.json()
+        self.calls.append((method, params))
+        if request.headers.get("Crypto-Pay-API-Token") != TOKEN:
+            return web.json_response({"ok": False, "error": {"code": 401, "name": "UNAUTHORIZED"}})
+        if self.fail:
+            return web.json_response({"ok": False, "error": {"code": 500, "name": "INTERNAL_ERROR"}})
+        if method == "createInvoice":
+            invoice_id = len(self.invoices) + 1
+            self.invoices[invoice_id] = {
+                "invoice_id": invoice_id, "status": "active", "amount": params["amount"],
+                "payload": params["payload"], "bot_invoice_url": f"https://t.me/CryptoBot?start=IV{invoice_id}"
+            }
+            return web.json_response({"ok": True, "result": self.invoices[invoice_id]})
+        if method == "getInvoices":
+            ids = [int(invoice_id) for invoice_id in params["invoice_ids"].split(",")]
+            items = [self.invoices[invoice_id] for invoice_id in ids if invoice_id in self.invoices]
+            return web.json_response({"ok": True, "result": {"items": items}})
+        return web.json_response({"ok": False, "error": {"code": 405, "name": "METHOD_NOT_FOUND"}})
+
+    def created(self):
+        return [params for method, params in self.calls if method == "createInvoice"]
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_post("/{method}", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", 0).start()
+        self.url = f"http://127.0.0.1:{self.runner.addresses[0][1]}"
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.runner.cleanup()
+
+
+def crypto_app(tmp_path, api):
+    return make_app(tmp_path / "digi.db", cryptobot_token=TOKEN, cryptobot_api_url=api.url)
+
+
+def orders(app):
+    return query(app.config.db_path, "SELECT id, payment_method, payment_status FROM orders ORDER BY id")
+
+
+def test_failed_invoice_creates_no_order(tmp_path):
+    async def scenario():
+        async with FakeCryptoPay() as api:
+            app = crypto_app(tmp_path, api)
+            async with running(app):
+                api.fail = True
+                await app.dp.feed_update(app.bot, callback_update(7, "pay_crypto_stars_100_alice"))
+                assert orders(app) == []
+                assert any("CryptoBot сейчас недоступен" in text for text in app.bot.session.answers())
+
+                # Оплата картой под тем же сообщением - единственный заказ
+                await app.dp.feed_update(app.bot, callback_update(7, "pay_card_stars_100_alice"))
+                assert [(method, status) for _, method, status in orders(app)] == [("card", "pending")]
+
+    asyncio.run(scenario())
+
+
+def test_invoice_is_created_once_and_confirmed_by_poll(tmp_path):
+    async def scenario():
+        async with FakeCryptoPay() as api:
+            app = crypto_app(tmp_path, api)
+            async with running(app):
+                for _ in range(3):
+                    await app.dp.feed_update(app.bot, callback_update(7, "pay_crypto_stars_100_alice"))
+
+                (order_id, method, status), = orders(app)
+                assert (method, status) == ("cryptobot", "pending")
+                assert len(api.created()) == 1
+                assert api.created()[0]["amount"] == f"{100 * app.pricing.current.star_rate:.2f}"
+
+                api.invoices[1]["status"] = "paid"
+                assert await app.cryptobot.poll() == 1
+                assert orders(app) == [(order_id, "cryptobot", "paid")]
+                # Повторная сверка уже ничего не подтверждает
+                assert await app.cryptobot.poll() == 0
+
+    asyncio.run(scenario())
+
+
+def test_expired_invoice_is_replaced_for_the_same_order(tmp_path):
+    async def scenario():
+        async with FakeCryptoPay() as api:
+            app = crypto_app(tmp_path, api)
+            async with running(app):
+                await app.dp.feed_update(app.bot, callback_update(7, "pay_crypto_stars_100_alice"))
+                api.invoices[1]["status"] = "expired"
+                await app.cryptobot.poll()
+
+                await app.dp.feed_update(app.bot, callback_update(7, "pay_crypto_stars_100_alice"))
+                (order_id, _, _), = orders(app)
+                assert len(api.created()) == 2
+                assert api.created()[1]["payload"] == str(order_id)
+                assert (await app.db.get_crypto_payment(order_id))[:2] == ("2", "active")
+
+    asyncio.run(scenario())
+
+
+def test_webhook_checks_signature(tmp_path):
+    async def scenario():
+        async with FakeCryptoPay() as api:
+            app = crypto_app(tmp_path, api)
+            async with running(app):
+                await app.dp.feed_update(app.bot, callback_update(7, "pay_crypto_stars_100_alice"))
+                (order_id, _, _), = orders(app)
+
+                runner = web.AppRunner(digi.create_webhook_app(app))
+                await runner.setup()
+                await web.TCPSite(runner, "127.0.0.1", 0).start()
+                url = f"http://127.0.0.1:{runner.addresses[0][1]}{digi.CRYPTOBOT_WEBHOOK_PATH}"
+                body = json.dumps({"update_type": "invoice_paid", "payload": {"invoice_id": 1}}).encode()
+                secret = hashlib.sha256(TOKEN.encode()).digest()
+                signature = hmac.new(secret, body, hashlib.sha256).hexdigest()
+                try:
+                    async with ClientSession() as session:
+                        async with session.post(url, data=body, headers={"crypto-pay-api-signature": "0" * 64}) as response:
+                            assert response.status == 401
+                        assert orders(app)[0][2] == "pending"
+
+                        async with session.post(url, data=body, headers={"crypto-pay-api-signature": signature}) as response:
+                            assert response.status == 200
+                    assert orders(app) == [(order_id, "cryptobot", "paid")]
+                finally:
+                    await runner.cleanup()
+
+    asyncio.run(scenario())
@@ -0,0 +1,101 @@
+"""Выгрузка заказов: потоковая запись без роста памяти с числом строк"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+import digi
+from conftest import ROOT
+
+# Сколько строк в долгом тесте и насколько пик памяти может вырасти относительно малой выгрузки
+EXPORT_ROWS = int(os.getenv("DIGI_EXPORT_ROWS", "5000000"))
+EXPORT_RSS_GROWTH_MB = 64
+
+
+def make_orders_db(path, count, seed_count=20_000):
+    """База с count заказами: seed_orders для разнообразия, дальше - копирование самой себя.
+    Триггеры статистики удаляются: для выгрузки они не нужны и в разы замедляют заполнение"""
+    database = digi.Database(str(path))
+    database.create_tables()
+    for (name,) in database.conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'").fetchall():
+        database.conn.execute(f"DROP TRIGGER {name}")
+    database.seed_orders(min(count, seed_count))
+    columns = ("user_id, order_type, recipient, details, amount_rub, amount_usd, "
+               "payment_method, payment_status, order_date")
+    while True:
+        total = database.conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+        if total >= count:
+            break
+        database.conn.execute(
+            f"INSERT INTO orders ({columns}) SELECT {columns} FROM orders LIMIT ?", (count - total,)
+        )
+        database.conn.commit()
+    database.close()
+    return path
+
+
+def run_export(db_path, out_path, *args):
+    """python digi.py export в отдельном процессе: (код выхода, stdout, stderr, пик RSS в МБ)"""
+    script = (
+        "import resource, sys\n"
+        "import digi\n"
+        "try:\n"
+        "    digi.cli(sys.argv[1:])\n"
+        "finally:\n"
+        "    print('RSS', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)\n"
+    )
+    env = {key: value for key, value in os.environ.items() if key not in ("BOT_TOKEN", "ARCHIVE_DB")}
+    result = subprocess.run(
+        [sys.executable, "-c", script, "export", str(out_path), "--db", str(db_path), *args],
+        cwd=ROOT, env=env, capture_output=True, text=True, timeout=3600
+    )
+    rss_kb = int(result.stdout.rsplit("RSS", 1)[1])
+    return result.returncode, result.stdout, result.stderr, rss_kb / 1024
+
+
+def exported_rows(stdout):
+    line = next(line for line in stdout.splitlines() if "Выгружено заказов" in line)
+    return int(line.split(":")[1].split()[0])
+
+
+def test_export_csv(tmp_path):
+    db_path = make_orders_db(tmp_path / "orders.db", 30_000)
+    out = tmp_path / "orders.csv.gz"
+    code, stdout, stderr, _ = run_export(db_path, out)
+    assert code == 0, stderr
+    assert exported_rows(stdout) == 30_000
+    assert out.stat().st_size > 0
+
+
+def test_export_parquet_without_pyarrow(tmp_path):
+    if digi.load_pyarrow() is not None:
+        pytest.skip("pyarrow установлен")
+    db_path = make_orders_db(tmp_path / "orders.db", 10)
+    code, _, stderr, _ = run_export(db_path, tmp_path / "orders.parquet")
+    assert code == 1
+    assert "установите pyarrow" in stderr
+    assert "Traceback" not in stderr
+    assert not (tmp_path / "orders.parquet").exists()
+
+
+@pytest.fixture(scope="module")
+def export_dbs(tmp_path_factory):
+    base = tmp_path_factory.mktemp("export")
+    return base, make_orders_db(base / "small.db", 50_000), make_orders_db(base / "large.db", EXPORT_ROWS)
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("fmt", ["csv", "parquet"])
+def test_export_memory_is_flat(export_dbs, fmt):
+    if fmt == "parquet" and digi.load_pyarrow() is None:
+        pytest.skip("нет pyarrow")
+    base, small, large = export_dbs
+    
+    code, _, stderr, small_rss = run_export(small, base / f"small.{fmt}")
+    assert code == 0, stderr
+    code, stdout, stderr, large_rss = run_export(large, base / f"large.{fmt}")
+    assert code == 0, stderr
+    assert exported_rows(stdout) == EXPORT_ROWS
+    # Пачки одинакового размера: пик памяти не зависит от числа строк
+    assert large_rss - small_rss < EXPORT_RSS_GROWTH_MB, (small_rss, large_rss)
@@ -0,0 +1,108 @@
+"""Нагрузка: 500 одновременных пользователей оформляют заказы, пока диск медленно делает commit.
+
+Запись идет в отдельном потоке писателя, поэтому медленный commit задерживает только
+ответы, которые ждут записи, а цикл событий и остальные хендлеры его не замечают.
+Сравнения - по p50 и p90: p99 из 500 замеров - это пятый худший, его двигают паузы
+сборщика мусора и соседние тесты. p99 - в отчете: pytest -s tests/test_load.py
+"""
+import asyncio
+import contextlib
+import random
+import time
+
+import digi
+from conftest import callback_update, make_app, message_update, running
+
+USERS = 500
+# Пауза пользователя между нажатиями, с
+THINK_TIME = (1.0, 3.0)
+# Имитация медленного fsync: столько длится каждый commit писателя
+COMMIT_STALL = 0.05
+
+
+def slow_commits(database, stall):
+    """Каждая транзакция писателя держит поток писателя еще stall секунд"""
+    transaction = database.transaction
+
+    @contextlib.contextmanager
+    def slow_transaction():
+        with transaction():
+            yield
+            time.sleep(stall)
+
+    database.transaction = slow_transaction
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def simulate(path, users, stall):
+    """Сценарий покупки звезд для users пользователей; возвращает задержки по шагам и задержки цикла событий"""
+    app = make_app(path)
+    if stall:
+        slow_commits(app.db._db, stall)
+    latencies = {"start": [], "buy_stars": [], "pay_card": [], "card_paid": []}
+    lags = []
+    rnd = random.Random(1)
+    done = asyncio.Event()
+
+    async def probe():
+        # Насколько позже положенного просыпается короткий sleep - так виден заблокированный цикл
+        while not done.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(0.005)
+            lags.append(time.perf_counter() - started - 0.005)
+
+    async def feed(step, update):
+        started = time.perf_counter()
+        await app.dp.feed_update(app.bot, update)
+        latencies[step].append(time.perf_counter() - started)
+
+    async def purchase(user_id):
+        await asyncio.sleep(rnd.uniform(0, THINK_TIME[1]))
+        await feed("start", message_update(user_id, "/start"))
+        await asyncio.sleep(rnd.uniform(*THINK_TIME))
+        await feed("buy_stars", callback_update(user_id, "buy_stars"))
+        await asyncio.sleep(rnd.uniform(*THINK_TIME))
+        order_data = f"100_user{user_id}"
+        await feed("pay_card", callback_update(user_id, f"pay_card_stars_{order_data}"))
+        order_id = (await app.db.find_order(digi.order_idempotency_key(user_id, "stars", order_data, 1)))[0]
+        await asyncio.sleep(rnd.uniform(*THINK_TIME))
+        await feed("card_paid", callback_update(user_id, f"card_paid_{order_id}"))
+
+    async with running(app):
+        prober = asyncio.create_task(probe())
+        await asyncio.gather(*(purchase(1000 + n) for n in range(users)))
+        done.set()
+        await prober
+        stats = await app.db.get_statistics()
+    assert stats["pending_orders"] == users
+    return latencies, lags
+
+
+def report(title, latencies, lags):
+    print(f"\n{title}")
+    for step, values in latencies.items():
+        print(f"  {step:<10} n={len(values):<4} p50={percentile(values, 0.5) * 1000:7.1f} мс "
+              f"p90={percentile(values, 0.9) * 1000:7.1f} мс p99={percentile(values, 0.99) * 1000:7.1f} мс")
+    print(f"  цикл событий: задержка p90 {percentile(lags, 0.9) * 1000:.1f} мс, "
+          f"p99 {percentile(lags, 0.99) * 1000:.1f} мс, max {max(lags) * 1000:.1f} мс")
+
+
+def test_slow_disk_does_not_stall_handlers(tmp_path):
+    fast, fast_lags = asyncio.run(simulate(tmp_path / "fast.db", USERS, 0))
+    slow, slow_lags = asyncio.run(simulate(tmp_path / "slow.db", USERS, COMMIT_STALL))
+    report("commit без задержки", fast, fast_lags)
+    report(f"commit +{COMMIT_STALL * 1000:.0f} мс", slow, slow_lags)
+
+    # Цикл событий не ждет диск: задержка пробуждения меньше одного медленного commit
+    assert percentile(slow_lags, 0.9) < COMMIT_STALL
+    # Хендлеры без записи не ждут диск: с записью в цикле событий даже медиана ждала бы
+    # медленный commit
+    for step in ("start", "buy_stars"):
+        assert percentile(slow[step], 0.5) < percentile(fast[step], 0.5) * 2 + COMMIT_STALL, step
+    # Заказ ждет свой commit, но пачки писателя не копят очередь: даже хвост - меньше секунды
+    for step in ("pay_card", "card_paid"):
+        assert percentile(slow[step], 0.99) < 1.0, step
@@ -0,0 +1,70 @@
+"""Обновление старой базы: запуск меняет только схему, индексы и пересчеты идут миграциями"""
+import sqlite3
+
+import digi
+
+# Схема до всех изменений: только пользователи, заказы и платежи CryptoBot
+LEGACY_SCHEMA = """
+CREATE TABLE users (user_id INTEGER PRIMARY KEY, username TEXT, full_name TEXT,
+                    join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE orders (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, order_type TEXT,
+                     recipient TEXT, details TEXT, amount_rub REAL, amount_usd REAL, payment_method TEXT,
+                     payment_status TEXT DEFAULT 'pending', admin_checked INTEGER DEFAULT 0,
+                     order_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP, payment_date TIMESTAMP,
+                     completed_date TIMESTAMP);
+CREATE TABLE crypto_payments (id INTEGER PRIMARY KEY AUTOINCREMENT, order_id INTEGER, invoice_id TEXT,
+                              status TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+"""
+
+
+def legacy_db(path):
+    details = digi.order_details(digi.StarsOrder(stars=100, recipient="alice"))
+    with sqlite3.connect(path) as connection:
+        connection.executescript(LEGACY_SCHEMA)
+        connection.execute("INSERT INTO users (user_id) VALUES (7)")
+        connection.executemany(
+            "INSERT INTO orders (user_id, order_type, recipient, details, amount_rub, amount_usd, "
+            "payment_method, payment_status, completed_date) VALUES (7, 'stars', 'alice', ?, 150, 1.78, 'card', ?, ?)",
+            [(details, "completed", "2026-01-01 10:00:00"), (details, "pending", None)]
+        )
+    connection.close()
+
+
+def indexes(database):
+    return {row[0] for row in database.conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name IN ('orders', 'crypto_payments')"
+    )}
+
+
+def test_legacy_db_works_before_and_after_migrations(tmp_path):
+    path = tmp_path / "digi.db"
+    legacy_db(path)
+
+    database = digi.Database(str(path))
+    migrator = digi.Migrator(database, progress=lambda *args: None, pause=0)
+    # Запуск не строит индексы по заказам и не пересчитывает счетчики
+    assert migrator.current_version() == 0
+    assert indexes(database) == set()
+    # ...но код работает и на такой схеме
+    database.add_order(7, "stars", "alice", "{}", 150.0, 1.78, "card", idempotency_key="key")
+    assert database.add_order(7, "stars", "alice", "{}", 150.0, 1.78, "card", idempotency_key="key") == 3
+    assert [row[1:4] for row in database.get_sales_by_day(365 * 10)] == [("stars", 1, 100)]
+
+    assert migrator.run() == [migration.version for migration in digi.MIGRATIONS]
+    assert {"idx_orders_status_date", "idx_orders_idempotency", "idx_orders_sales"} <= indexes(database)
+    assert database.get_statistics()["pending_orders"] == 2
+    assert database.get_statistics()["completed_orders"] == 1
+    assert database.check_statistics() == {}
+    # Выполненный без подтверждения заказ получил дату оплаты (миграция 2), отчеты пересчитаны
+    assert database.conn.execute("SELECT payment_date FROM orders WHERE id = 1").fetchone() == ("2026-01-01 10:00:00",)
+    assert database.conn.execute(
+        "SELECT status, SUM(orders) FROM rollup_daily GROUP BY status ORDER BY status"
+    ).fetchall() == [("completed", 1), ("pending", 3)]
+    database.close()
+
+
+def test_new_db_starts_at_latest_version(tmp_path):
+    database = digi.Database(str(tmp_path / "digi.db"))
+    assert digi.Migrator(database).pending() == []
+    assert "idx_orders_sales" in indexes(database)
+    database.close()
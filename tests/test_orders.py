@@ -0,0 +1,101 @@
+"""Повторное нажатие «Перевод на карту»: тот же заказ, пока его можно оплатить"""
+import asyncio
+import sqlite3
+
+import pytest
+from aiogram import methods
+
+import digi
+from conftest import callback_update, make_app, query, running
+
+PAY_CARD = "pay_card_stars_100_alice"
+
+
+def orders(app):
+    return query(app.config.db_path, "SELECT id, payment_status FROM orders ORDER BY id")
+
+
+def age_orders(app, days):
+    """Сдвигает даты заказов в прошлое отдельным соединением"""
+    with sqlite3.connect(app.config.db_path) as connection:
+        connection.execute("UPDATE orders SET order_date = datetime('now', ?)", (f"-{days} days",))
+
+
+def card_captions(app):
+    """Подписи с реквизитами карты, которые увидел пользователь"""
+    return [call.caption for call in app.bot.session.calls
+            if isinstance(call, methods.EditMessageCaption) and "Перевод на карту" in call.caption]
+
+
+def test_repeated_tap_shows_the_same_order(tmp_path):
+    async def scenario():
+        app = make_app(tmp_path / "digi.db")
+        async with running(app):
+            for _ in range(3):
+                await app.dp.feed_update(app.bot, callback_update(7, PAY_CARD))
+            assert orders(app) == [(1, "pending")]
+            assert all(caption.endswith("#1") for caption in card_captions(app))
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("archive", [False, True])
+def test_expired_order_is_not_offered_for_payment(tmp_path, archive):
+    async def scenario():
+        app = make_app(tmp_path / "digi.db")
+        async with running(app):
+            app.sweeper.archive = archive
+            await app.dp.feed_update(app.bot, callback_update(7, PAY_CARD))
+            age_orders(app, 2)
+            assert await app.sweeper.sweep() == 1
+
+            # С архивом и без него повторное нажатие дает новый заказ, а не реквизиты истекшего
+            await app.dp.feed_update(app.bot, callback_update(7, PAY_CARD))
+            captions = card_captions(app)
+            assert len(captions) == 2 and captions[-1].endswith("#2")
+            expected = [(2, "pending")] if archive else [(1, "expired"), (2, "pending")]
+            assert orders(app) == expected
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("status, answer", [
+    ("paid", "✅ Этот заказ уже оплачен"),
+    ("cancelled", "❌ Заказ отменен, оформите его заново"),
+])
+def test_closed_order_answers_instead_of_card_details(tmp_path, status, answer):
+    async def scenario():
+        app = make_app(tmp_path / "digi.db")
+        async with running(app):
+            await app.dp.feed_update(app.bot, callback_update(7, PAY_CARD))
+            # Заказ еще в кэше недавних, но статус берется из базы
+            await app.db.update_order_status(1, status)
+            await app.dp.feed_update(app.bot, callback_update(7, PAY_CARD))
+
+            assert len(card_captions(app)) == 1
+            assert app.bot.session.answers() == [answer]
+            assert orders(app) == [(1, status)]
+
+    asyncio.run(scenario())
+
+
+def test_migration_frees_keys_of_orders_expired_before_upgrade(tmp_path):
+    async def scenario():
+        app = make_app(tmp_path / "digi.db")
+        async with running(app):
+            await app.dp.feed_update(app.bot, callback_update(7, PAY_CARD))
+            # Так истекали заказы до миграции 3: ключ оставался у истекшего заказа
+            with sqlite3.connect(app.config.db_path) as connection:
+                connection.execute("UPDATE orders SET payment_status = 'expired'")
+                connection.execute("DELETE FROM schema_version WHERE version >= 3")
+            await app.recent_orders.delete(digi.order_idempotency_key(7, "stars", "100_alice", 1))
+            await app.dp.feed_update(app.bot, callback_update(7, PAY_CARD))
+            assert app.bot.session.answers() == ["⌛ Заказ истек, оформите его заново"]
+
+            database = digi.Database(app.config.db_path)
+            digi.Migrator(database, progress=lambda *args: None, pause=0).run()
+            database.close()
+            await app.dp.feed_update(app.bot, callback_update(7, PAY_CARD))
+            assert orders(app) == [(1, "expired"), (2, "pending")]
+
+    asyncio.run(scenario())
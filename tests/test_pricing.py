@@ -0,0 +1,137 @@
+"""Цены: снимок из источника попадает в заказ и price_snapshots, сбой источника не меняет цены"""
+import asyncio
+import dataclasses
+import json
+
+import pytest
+from aiohttp import web
+
+import digi
+from conftest import callback_update, make_app, query, running
+
+PAY_CARD = "pay_card_stars_100_alice"
+
+
+class FakeRates:
+    """Источник курсов на локальном порту: GET /rates отдает rates, при fail - 500"""
+
+    def __init__(self, rates):
+        self.rates = rates
+        self.fail = False
+        self.runner = None
+        self.url = None
+
+    async def handle(self, request):
+        if self.fail:
+            return web.json_response({"error": "unavailable"}, status=500)
+        return web.json_response(self.rates)
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_get("/rates", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", 0).start()
+        self.url = f"http://127.0.0.1:{self.runner.addresses[0][1]}/rates"
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.runner.cleanup()
+
+
+def orders(app):
+    return query(app.config.db_path, "SELECT id, amount_rub, price_version FROM orders ORDER BY id")
+
+
+def snapshots(app):
+    rows = query(app.config.db_path, "SELECT version, data FROM price_snapshots")
+    return {version: json.loads(data) for version, data in rows}
+
+
+def test_http_rates_are_recorded_with_orders(tmp_path):
+    async def scenario():
+        async with FakeRates({"star_rate": 2.0}) as rates:
+            app = make_app(tmp_path / "digi.db", pricing_source=rates.url)
+            async with running(app):
+                first = app.pricing.current
+                assert first.star_rate == 2.0 and first.usd_rate == digi.USD_RATE
+                await app.dp.feed_update(app.bot, callback_update(7, PAY_CARD))
+
+                rates.rates = {"star_rate": 3.0}
+                assert await app.pricing.refresh()
+                second = app.pricing.current
+                await app.dp.feed_update(app.bot, callback_update(7, PAY_CARD, message_id=2))
+
+                # Каждый заказ помнит версию цен, по которой он посчитан, и версия сохранена
+                assert orders(app) == [(1, 200.0, first.version), (2, 300.0, second.version)]
+                saved = snapshots(app)
+                assert saved[first.version]["star_rate"] == 2.0
+                assert saved[second.version]["star_rate"] == 3.0
+                # Прежний снимок не изменился: его могли читать в момент замены
+                assert first.star_rate == 2.0
+                with pytest.raises(dataclasses.FrozenInstanceError):
+                    first.star_rate = 3.0
+                with pytest.raises(TypeError):
+                    first.premium["3m"] = {}
+
+    asyncio.run(scenario())
+
+
+def test_failed_fetch_keeps_previous_prices(tmp_path):
+    async def scenario():
+        async with FakeRates({"star_rate": 2.0}) as rates:
+            app = make_app(tmp_path / "digi.db", pricing_source=rates.url)
+            async with running(app):
+                before = app.pricing.current
+                rates.fail = True
+                rates.rates = {"star_rate": 5.0}
+                assert not await app.pricing.refresh()
+                await rates.runner.cleanup()
+                assert not await app.pricing.refresh()
+
+                assert app.pricing.current is before
+                assert app.pricing.failed == 2
+                await app.dp.feed_update(app.bot, callback_update(7, PAY_CARD))
+                assert orders(app) == [(1, 200.0, before.version)]
+                assert list(snapshots(app)) == [before.version]
+
+    asyncio.run(scenario())
+
+
+def test_orders_match_their_snapshot_while_prices_change(tmp_path):
+    async def scenario():
+        # Любой источник, кроме db и http, - StaticRatesProvider
+        app = make_app(tmp_path / "digi.db", pricing_source="static")
+        provider = app.pricing.provider
+        assert isinstance(provider, digi.StaticRatesProvider)
+
+        async def change_prices(done):
+            step = 0
+            while not done.is_set():
+                step += 1
+                provider.rates = {"star_rate": 2.0 + step % 3}
+                await app.pricing.refresh()
+                await asyncio.sleep(0.001)
+
+        async def tap(user_id):
+            # Нажатия растянуты во времени, чтобы попадать между сменами цен
+            await asyncio.sleep(user_id % 10 * 0.005)
+            await app.dp.feed_update(app.bot, callback_update(user_id, PAY_CARD))
+
+        async def tap_all(done):
+            await asyncio.gather(*(tap(user_id) for user_id in range(100, 140)))
+            done.set()
+
+        async with running(app):
+            done = asyncio.Event()
+            await asyncio.gather(change_prices(done), tap_all(done))
+
+        # Сумма и версия заказа взяты из одного снимка, как бы цены ни менялись между ними
+        saved = snapshots(app)
+        rows = orders(app)
+        assert len(rows) == 40
+        for _, amount_rub, version in rows:
+            assert amount_rub == 100 * saved[version]["star_rate"]
+        assert len({version for _, _, version in rows}) > 1
+
+    asyncio.run(scenario())
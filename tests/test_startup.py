@@ -0,0 +1,54 @@
+"""Запуск: импорт без побочных эффектов укладывается в бюджет, create_app() дает независимые приложения"""
+import asyncio
+import os
+import time
+
+import pytest
+from aiogram import methods
+
+import digi
+from conftest import make_app, message_update, query, running
+
+
+def sent_texts(app):
+    """Первые строки отправленных текстовых сообщений"""
+    return [call.text.split("\n")[0] for call in app.bot.session.calls if isinstance(call, methods.SendMessage)]
+
+
+def test_import_fits_budget_and_creates_no_files(capsys):
+    # Чистый процесс без BOT_TOKEN во временной папке: SystemExit при файлах или превышении бюджета
+    digi.check_import(digi.IMPORT_BUDGET)
+    line = capsys.readouterr().out
+    own = float(line.split("digi ")[1].split()[0])
+    assert own <= digi.IMPORT_BUDGET, line
+
+
+def test_create_app_without_token_fails_cleanly(tmp_path):
+    with pytest.raises(ValueError, match="BOT_TOKEN"):
+        digi.create_app(digi.AppConfig(bot_token=None, db_path=str(tmp_path / "digi.db")))
+    # Ошибка до открытия базы
+    assert os.listdir(tmp_path) == []
+
+
+def test_two_apps_are_independent(tmp_path):
+    async def scenario():
+        first = make_app(tmp_path / "first.db")
+        second = make_app(tmp_path / "second.db", admin_ids=[2])
+        assert first.dp is not second.dp and first.db is not second.db
+        assert first.user_states is not second.user_states
+
+        started = time.perf_counter()
+        async with running(first), running(second):
+            assert time.perf_counter() - started < digi.STARTUP_BUDGET
+            await first.dp.feed_update(first.bot, message_update(7, "/start"))
+            await second.dp.feed_update(second.bot, message_update(8, "/start"))
+            for app in (first, second):
+                await app.dp.feed_update(app.bot, message_update(2, "/admin"))
+
+        # Каждое приложение ответило своим ботом, пишет в свою базу и знает своих админов
+        assert sent_texts(first) == ["❌ Доступ запрещен"]
+        assert sent_texts(second) == ["🛠️ **Админ панель**"]
+        assert query(tmp_path / "first.db", "SELECT user_id FROM users") == [(7,)]
+        assert query(tmp_path / "second.db", "SELECT user_id FROM users") == [(8,)]
+
+    asyncio.run(scenario())
@@ -0,0 +1,96 @@
+"""Состояния пользователей: память не растет с числом пользователей, просроченное удаляется"""
+import asyncio
+import os
+import tracemalloc
+
+import pytest
+
+import digi
+from conftest import make_app, query, running
+
+# Сколько разных пользователей в долгом прогоне и сколько состояний держит память
+SOAK_USERS = int(os.getenv("DIGI_SOAK_USERS", "1000000"))
+MAX_USERS = 10_000
+# Насколько может вырасти память после заполнения до MAX_USERS
+GROWTH_LIMIT = 1024 * 1024
+
+
+async def soak(users):
+    """Каждый пользователь проходит антифлуд и нажимает «Купить звезды» - как в хендлере.
+    Возвращает хранилище, корзины и рост памяти с момента, когда они заполнились"""
+    states = digi.MemoryStateStore(ttl=3600, max_size=MAX_USERS)
+    buckets = digi.TokenBuckets(max_size=MAX_USERS)
+    baseline = None
+    tracemalloc.start()
+    try:
+        for user_id in range(1, users + 1):
+            buckets.acquire(user_id, "callback")
+            await states.set(user_id, {"action": "waiting_stars_recipient"})
+            if user_id == MAX_USERS * 2:
+                baseline = tracemalloc.get_traced_memory()[0]
+        growth = tracemalloc.get_traced_memory()[0] - baseline
+    finally:
+        tracemalloc.stop()
+    return states, buckets, growth
+
+
+@pytest.mark.parametrize("users", [100_000, pytest.param(SOAK_USERS, marks=pytest.mark.slow)])
+def test_memory_is_bounded_by_max_users(users):
+    states, buckets, growth = asyncio.run(soak(users))
+    print(f"\n{users} пользователей: рост памяти {growth / 1024:.1f} КБ, {asyncio.run(states.stats())}")
+
+    assert growth < GROWTH_LIMIT
+    assert asyncio.run(states.stats()) == {"live": MAX_USERS, "evicted": users - MAX_USERS, "expired": 0}
+    assert len(buckets) == MAX_USERS and buckets.evicted == users - MAX_USERS
+    # Вытеснены самые давние, последние пользователи на месте
+    assert asyncio.run(states.get(1)) is None
+    assert asyncio.run(states.get(users)) == {"action": "waiting_stars_recipient"}
+
+
+def test_memory_store_drops_expired_states():
+    async def scenario():
+        states = digi.MemoryStateStore(ttl=-1, max_size=MAX_USERS)
+        for user_id in range(1000):
+            await states.set(user_id, {"action": "waiting_exchange_amount"})
+        assert await states.get(999) is None
+        return await states.stats()
+
+    # Каждая запись сразу просрочена: в памяти не больше одной
+    assert asyncio.run(scenario()) == {"live": 0, "evicted": 0, "expired": 1000}
+
+
+def test_sqlite_store_purges_expired_rows(tmp_path):
+    async def scenario():
+        database = digi.AsyncDatabase(str(tmp_path / "digi.db"))
+        try:
+            states = digi.SQLiteStateStore(database, ttl=-1, purge_every=100)
+            for user_id in range(1000):
+                await states.set(user_id, {"action": "waiting_exchange_amount"})
+            assert await states.get(999) is None
+            return await states.stats()
+        finally:
+            database.close()
+
+    stats = asyncio.run(scenario())
+    # Таблица чистится каждые purge_every записей и не копит пользователей
+    assert query(tmp_path / "digi.db", "SELECT COUNT(*) FROM user_states") == [(0,)]
+    assert stats == {"live": 0, "evicted": 0, "expired": 1000}
+
+
+@pytest.mark.parametrize("storage", ["memory", "sqlite"])
+def test_state_counters_are_exported_as_metrics(tmp_path, storage):
+    async def scenario():
+        app = make_app(tmp_path / "digi.db", state_storage=storage)
+        async with running(app):
+            states = app.user_states
+            states.ttl, states.purge_every = -1, 11
+            for user_id in range(10):
+                await states.set(user_id, {"action": "waiting_exchange_amount"})
+            states.ttl = 3600
+            await states.set(10, {"action": "waiting_exchange_amount"})
+            return app.metrics.render().splitlines()
+
+    lines = asyncio.run(scenario())
+    assert "digi_user_states 1" in lines
+    assert 'digi_user_states_dropped_total{reason="expired"} 10' in lines
+    assert 'digi_user_states_dropped_total{reason="evicted"} 0' in lines
@@ -0,0 +1,23 @@
+"""Четыре воркера webhook на одной базе: заказы не теряются и не дублируются.
+
+Бот запускается как в проде (python digi.py, WORKERS=4, общий порт), апдейты
+приходят POST-запросами через bench.py. «Перевод на карту» нажимается дважды
+одновременно, и нажатия могут попасть в разные воркеры.
+"""
+import bench
+
+USERS = 40
+
+
+def test_four_workers_neither_lose_nor_duplicate_orders(tmp_path):
+    result = bench.main([
+        "flow", "--webhook", "--workers", "4", "--double-tap",
+        "--users", str(USERS), "--concurrency", "20", "--warmup", "0",
+        "--db", str(tmp_path / "digi.db"),
+    ])
+
+    assert result["errors"] == 0
+    assert result["orders"] == {"missing": 0, "duplicated": 0, "wrong_status": 0}
+    assert result["db_rows"]["orders"] == USERS
+    # Каждое нажатие получило ответ, а не отказ антифлуда или ошибку
+    assert result["steps"]["pay_card"]["count"] == USERS * 2